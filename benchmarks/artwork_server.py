@@ -0,0 +1,69 @@
+"""Local HTTP server that serves deterministic artwork files for benchmarks."""
+import hashlib
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# Size of every served artwork file. Real artwork is usually a few hundred KB to a few MB.
+ARTWORK_BYTES = 256 * 1024
+
+
+def artwork_bytes(name, size=ARTWORK_BYTES):
+    """Returns size pseudo-random bytes derived from name, so repeated downloads are identical."""
+    seed = hashlib.sha256(name.encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class ArtworkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        name = query.get('filename', ['artwork.png'])[0]
+        size = int(query.get('size', [self.server.artwork_size])[0])
+        if self.server.fail_every and artwork_bytes(name, 1)[0] % self.server.fail_every == 0:
+            self.send_error(503)
+            return
+        body = artwork_bytes(name, size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_served += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ArtworkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), artwork_size=ARTWORK_BYTES, fail_every=0):
+        super().__init__(address, ArtworkHandler)
+        self.artwork_size = artwork_size
+        self.fail_every = fail_every
+        self.bytes_served = 0
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Cancelled downloads hang up mid-transfer; that is expected here and not worth a traceback.
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/artwork"
+
+
+def start_artwork_server(artwork_size=ARTWORK_BYTES, fail_every=0, host='127.0.0.1', port=0):
+    """Starts the server on a daemon thread and returns it. Call shutdown() to stop it.
+
+    fail_every makes roughly one in fail_every file names answer 503, to exercise download error paths.
+    """
+    server = ArtworkServer((host, port), artwork_size, fail_every)
+    threading.Thread(target=server.serve_forever, name="ArtworkServer", daemon=True).start()
+    return server
@@ -0,0 +1,70 @@
+"""Stand-ins for wkhtmltopdf, SumatraPDF and lpr used by the benchmarks.
+
+Usage: python fake_tools.py <wkhtmltopdf|sumatra|lpr> <original arguments...>
+
+FAKE_TOOL_DELAY (seconds, default 0) simulates rendering/spooling time. Print jobs are appended as
+"<tool>\t<printer>\t<absolute file path>" lines to FAKE_PRINT_LOG when it is set.
+"""
+import os
+import sys
+import time
+
+
+def minimal_pdf(pages=1):
+    """Returns a small but structurally valid PDF with the given number of blank Letter pages."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               "<< /Type /Pages /Kids [%s] /Count %d >>" % (' '.join(f"{3 + n} 0 R" for n in range(pages)), pages)]
+    objects += ["<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>"] * pages
+
+    body = b"%PDF-1.4\n"
+    offsets = []
+    for number, content in enumerate(objects, 1):
+        offsets.append(len(body))
+        body += f"{number} 0 obj\n{content}\nendobj\n".encode()
+    xref = len(body)
+    body += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    body += ''.join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    body += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return body
+
+
+def log_print(tool, printer, file_path):
+    log_path = os.environ.get('FAKE_PRINT_LOG')
+    if log_path:
+        with open(log_path, 'a') as f:
+            f.write(f"{tool}\t{printer}\t{os.path.abspath(file_path)}\n")
+
+
+def wkhtmltopdf(arguments):
+    source, target = arguments[-2], arguments[-1]
+    html = sys.stdin.buffer.read() if source == '-' else open(source, 'rb').read()
+    # Roughly one page per 40 table rows, like the real renderer on order bodies.
+    pages = max(1, html.count(b'<tr') // 40 + 1)
+    with open(target, 'wb') as f:
+        f.write(minimal_pdf(pages))
+
+
+def sumatra(arguments):
+    printer = arguments[arguments.index('-print-to') + 1] if '-print-to' in arguments else ''
+    log_print('sumatra', printer, arguments[-1])
+
+
+def lpr(arguments):
+    printer = arguments[arguments.index('-P') + 1] if '-P' in arguments else ''
+    log_print('lpr', printer, arguments[-1])
+
+
+TOOLS = {'wkhtmltopdf': wkhtmltopdf, 'sumatra': sumatra, 'lpr': lpr}
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in TOOLS:
+        sys.stderr.write(__doc__)
+        return 2
+    time.sleep(float(os.environ.get('FAKE_TOOL_DELAY', '0')))
+    TOOLS[argv[1]](argv[2:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
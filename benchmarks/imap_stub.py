@@ -0,0 +1,263 @@
+"""Minimal in-process IMAP4rev1 server for offline benchmarks.
+
+Implements the subset of commands the engine uses: CAPABILITY, LOGIN, SELECT, NOOP, SEARCH, FETCH, STORE,
+EXPUNGE, their UID forms and LOGOUT. Every connection shares one mailbox, so several clients, in this process
+or connecting from others, see each other's flag changes. EXPUNGE removes \\Deleted messages and renumbers
+the rest at once in every session, as when another station expunges; UIDs never change. Any user name and
+password are accepted.
+"""
+import re
+import socketserver
+import sys
+import threading
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+
+class Mailbox:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = []
+        self._next_uid = 1
+        self._fetch_failures = set()
+
+    def add(self, raw_message, flags=()):
+        """Appends a message and returns its UID."""
+        with self.lock:
+            uid = self._next_uid
+            self._next_uid += 1
+            self.messages.append({'uid': uid, 'raw': raw_message, 'flags': set(flags),
+                                  'date': _message_date(raw_message)})
+            return uid
+
+    def expunge(self):
+        """Removes the \\Deleted messages and returns their sequence numbers, highest first."""
+        with self.lock:
+            removed = [number for number, message in enumerate(self.messages, 1) if '\\Deleted' in message['flags']]
+            self.messages = [message for message in self.messages if '\\Deleted' not in message['flags']]
+            return removed[::-1]
+
+    def drop_seen_bodies(self):
+        """Frees the bodies of seen messages, keeping sequence numbers, so long runs do not grow the mailbox."""
+        with self.lock:
+            for message in self.messages:
+                if '\\Seen' in message['flags']:
+                    message['raw'] = b''
+
+    def fail_fetch(self, uid):
+        """Drops the connection the next time the body of message uid is fetched, like a network failure."""
+        with self.lock:
+            self._fetch_failures.add(uid)
+
+    def count_with_flag(self, flag):
+        with self.lock:
+            return sum(1 for message in self.messages if flag in message['flags'])
+
+
+def _message_date(raw_message):
+    match = re.search(rb'^Date: (.+?)\r?$', raw_message, re.MULTILINE | re.IGNORECASE)
+    try:
+        return parsedate_to_datetime(match.group(1).decode()).date() if match else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _tokenize(arguments):
+    """Splits IMAP arguments on spaces, keeping quoted strings and parenthesised lists together."""
+    return re.findall(r'"(?:[^"\\]|\\.)*"|\([^)]*\)|\S+', arguments)
+
+
+def _unquote(token):
+    if token.startswith('"') and token.endswith('"'):
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+    return token
+
+
+def _matches(message, criteria):
+    index = 0
+    while index < len(criteria):
+        key = criteria[index].upper()
+        index += 1
+        if key == 'ALL':
+            continue
+        if key == 'UNSEEN' and '\\Seen' in message['flags']:
+            return False
+        if key == 'SEEN' and '\\Seen' not in message['flags']:
+            return False
+        if key in ('SINCE', 'BEFORE', 'ON', 'KEYWORD', 'UNKEYWORD', 'BODY', 'TEXT'):
+            value = _unquote(criteria[index])
+            index += 1
+            if key in ('SINCE', 'BEFORE', 'ON'):
+                day = datetime.strptime(value, '%d-%b-%Y').date()
+                date = message['date']
+                if date is None or (key == 'SINCE' and date < day) or (key == 'BEFORE' and date >= day) \
+                        or (key == 'ON' and date != day):
+                    return False
+            elif key == 'KEYWORD' and value not in message['flags']:
+                return False
+            elif key == 'UNKEYWORD' and value in message['flags']:
+                return False
+            elif key in ('BODY', 'TEXT') and value.encode().lower() not in message['raw'].lower():
+                return False
+    return True
+
+
+def _sequence(spec, count):
+    numbers = []
+    for part in spec.split(','):
+        if ':' in part:
+            start, end = part.split(':')
+            end = count if end == '*' else int(end)
+            numbers.extend(range(int(start), end + 1))
+        else:
+            numbers.append(count if part == '*' else int(part))
+    return [number for number in numbers if 1 <= number <= count]
+
+
+def _select(messages, spec, by_uid):
+    """Returns [(sequence number, message)] for a sequence set, or for a UID set when by_uid is set."""
+    if not by_uid:
+        return [(number, messages[number - 1]) for number in _sequence(spec, len(messages))]
+    highest = messages[-1]['uid'] if messages else 0
+    uids = set(_sequence(spec, highest))
+    return [(number, message) for number, message in enumerate(messages, 1) if message['uid'] in uids]
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    # Responses are buffered and flushed once per command; unbuffered small writes hit delayed-ACK stalls.
+    wbufsize = -1
+
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode())
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send('* OK [CAPABILITY IMAP4rev1] Stub IMAP ready\r\n')
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode(errors='replace').rstrip('\r\n').split(' ', 2)
+            if len(parts) < 2:
+                continue
+            tag, command = parts[0], parts[1].upper()
+            arguments = parts[2] if len(parts) > 2 else ''
+            by_uid = command == 'UID'
+            if by_uid:
+                command, _, arguments = arguments.partition(' ')
+                command = command.upper()
+
+            handler = getattr(self, f'cmd_{command}', None)
+            if handler is None or (by_uid and command not in ('SEARCH', 'FETCH', 'STORE')):
+                self.send(f'{tag} BAD Unknown command {command}\r\n')
+                self.wfile.flush()
+                continue
+            try:
+                keep_open = handler(tag, arguments, mailbox, *((True,) if by_uid else ())) is not False
+            except Exception as e:
+                self.send(f'{tag} BAD {e}\r\n')
+                keep_open = True
+            self.wfile.flush()
+            if not keep_open:
+                return
+
+    def cmd_CAPABILITY(self, tag, arguments, mailbox):
+        self.send('* CAPABILITY IMAP4rev1\r\n')
+        self.send(f'{tag} OK CAPABILITY completed\r\n')
+
+    def cmd_LOGIN(self, tag, arguments, mailbox):
+        self.send(f'{tag} OK LOGIN completed\r\n')
+
+    def cmd_SELECT(self, tag, arguments, mailbox):
+        with mailbox.lock:
+            count = len(mailbox.messages)
+        self.send(f'* {count} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Seen \\Deleted)\r\n')
+        self.send(f'{tag} OK [READ-WRITE] SELECT completed\r\n')
+
+    def cmd_NOOP(self, tag, arguments, mailbox):
+        self.send(f'{tag} OK NOOP completed\r\n')
+
+    def cmd_SEARCH(self, tag, arguments, mailbox, by_uid=False):
+        criteria = _tokenize(arguments)
+        if criteria and criteria[0].upper() == 'CHARSET':
+            criteria = criteria[2:]
+        with mailbox.lock:
+            found = [str(message['uid'] if by_uid else number) for number, message in enumerate(mailbox.messages, 1)
+                     if _matches(message, criteria)]
+        self.send(f'* SEARCH {" ".join(found)}\r\n'.replace(' \r\n', '\r\n'))
+        self.send(f'{tag} OK SEARCH completed\r\n')
+
+    def cmd_FETCH(self, tag, arguments, mailbox, by_uid=False):
+        spec, items = arguments.split(' ', 1)
+        items = items.upper()
+        with mailbox.lock:
+            for number, message in _select(mailbox.messages, spec, by_uid):
+                # UID FETCH responses always carry the UID.
+                uid = f'UID {message["uid"]} ' if by_uid else ''
+                if re.search(r'BODY(\.PEEK)?\[|RFC822', items):
+                    if message['uid'] in mailbox._fetch_failures:
+                        mailbox._fetch_failures.discard(message['uid'])
+                        return False
+                    raw = message['raw']
+                    self.send(f'* {number} FETCH ({uid}BODY[] {{{len(raw)}}}\r\n'.encode() + raw + b')\r\n')
+                    if 'PEEK' not in items:
+                        message['flags'].add('\\Seen')
+                elif items.strip('()') == 'UID':
+                    self.send(f'* {number} FETCH (UID {message["uid"]})\r\n')
+                else:
+                    self.send(f'* {number} FETCH ({uid}FLAGS ({" ".join(sorted(message["flags"]))}))\r\n')
+        self.send(f'{tag} OK FETCH completed\r\n')
+
+    def cmd_STORE(self, tag, arguments, mailbox, by_uid=False):
+        spec, mode, flags = arguments.split(' ', 2)
+        flags = flags.strip('()').split()
+        mode = mode.upper()
+        with mailbox.lock:
+            for number, message in _select(mailbox.messages, spec, by_uid):
+                if 'X-GM-LABELS' in mode:
+                    continue
+                if mode.startswith('+'):
+                    message['flags'].update(flags)
+                elif mode.startswith('-'):
+                    message['flags'].difference_update(flags)
+                else:
+                    message['flags'] = set(flags)
+                uid = f'UID {message["uid"]} ' if by_uid else ''
+                self.send(f'* {number} FETCH ({uid}FLAGS ({" ".join(sorted(message["flags"]))}))\r\n')
+        self.send(f'{tag} OK STORE completed\r\n')
+
+    def cmd_EXPUNGE(self, tag, arguments, mailbox):
+        for number in mailbox.expunge():
+            self.send(f'* {number} EXPUNGE\r\n')
+        self.send(f'{tag} OK EXPUNGE completed\r\n')
+
+    def cmd_LOGOUT(self, tag, arguments, mailbox):
+        self.send('* BYE Stub IMAP closing\r\n')
+        self.send(f'{tag} OK LOGOUT completed\r\n')
+        return False
+
+
+class IMAPStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), mailbox=None):
+        super().__init__(address, IMAPHandler)
+        self.mailbox = mailbox or Mailbox()
+
+    def handle_error(self, request, client_address):
+        # Dropped clients and bare reachability probes are expected here and not worth a traceback.
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def start_imap_stub(mailbox=None, host='127.0.0.1', port=0):
+    """Starts the stub on a daemon thread and returns the server. Call shutdown() to stop it."""
+    server = IMAPStubServer((host, port), mailbox)
+    threading.Thread(target=server.serve_forever, name="IMAPStub", daemon=True).start()
+    return server
@@ -0,0 +1,82 @@
+"""Synthetic Moretranz-format order emails for benchmarks."""
+import io
+import random
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime, make_msgid
+from datetime import datetime, timezone
+
+from PIL import Image
+
+
+SENDER = "steve@moretranz.com"
+
+# Number of order lines, inline images and artwork links per order size.
+ORDER_SIZES = {
+    'small': {'lines': 3, 'inline_images': 1, 'links': 1},
+    'medium': {'lines': 15, 'inline_images': 3, 'links': 4},
+    'large': {'lines': 60, 'inline_images': 8, 'links': 12},
+}
+
+CUSTOMERS = ["John Smith", "Maria Garcia", "Wei Chen", "Amara Okafor", "Liam Murphy"]
+
+
+def make_png(width, height, seed=0):
+    """Returns PNG bytes of a noisy image, so compression does not make every size look the same."""
+    rng = random.Random(seed)
+    image = Image.frombytes('RGB', (width, height), rng.randbytes(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', dpi=(203, 203))
+    return buffer.getvalue()
+
+
+def build_order(index, size='small', artwork_base_url=None, replacement_of=None, date=None):
+    """Builds one order email as bytes.
+
+    artwork_base_url points at an artwork server; links are rendered as "<base>?filename=art_<po>_<n>.png".
+    replacement_of turns the order into an "Original PO / Replacement PO" email for that PO number.
+    """
+    profile = ORDER_SIZES[size]
+    po_number = str(100000 + index)
+    customer = CUSTOMERS[index % len(CUSTOMERS)]
+
+    message = MIMEMultipart('related')
+    message['From'] = f"Moretranz Orders <{SENDER}>"
+    message['To'] = "orders@example.com"
+    message['Subject'] = f"New order {po_number}"
+    message['Date'] = format_datetime(date or datetime.now(timezone.utc))
+    message['Message-ID'] = make_msgid(domain='moretranz.example')
+
+    if replacement_of:
+        header = f"<p>Original PO - {replacement_of}</p>\n<p>Replacement PO - {replacement_of}-R</p>"
+    else:
+        header = f"<p>PO Number: {po_number}</p>"
+
+    rows = '\n'.join(f"<tr><td>SKU-{index}-{line}</td><td>DTF Transfer {line}</td><td>{line % 5 + 1}</td></tr>"
+                   for line in range(profile['lines']))
+    images = '\n'.join(f'<img src="cid:inline{n}@moretranz">' for n in range(profile['inline_images']))
+    links = ''
+    if artwork_base_url:
+        links = '\n'.join(f'<p><a href="{artwork_base_url}?filename=art_{po_number}_{n}.png">Artwork {n}</a></p>'
+                        for n in range(profile['links']))
+
+    html = (f"<html><body>\n{header}\n<p>Delivery address: {customer}</p>\n<p>{index % 900 + 1} Main Street</p>\n{images}\n"
+            f"<table>\n{rows}\n</table>\n{links}\n</body></html>")
+    message.attach(MIMEText(html, 'html'))
+
+    for n in range(profile['inline_images']):
+        image = MIMEImage(make_png(64, 64, seed=index * 100 + n), 'png')
+        image.add_header('Content-ID', f'<inline{n}@moretranz>')
+        image.add_header('Content-Disposition', 'inline')
+        message.attach(image)
+
+    label = MIMEBase('image', 'png')
+    label.set_payload(make_png(400, 600, seed=index))
+    encoders.encode_base64(label)
+    label.add_header('Content-Disposition', 'attachment', filename=f"label_{po_number}.png")
+    message.attach(label)
+
+    return message.as_bytes()
@@ -0,0 +1,191 @@
+"""End-to-end benchmark of the order pipeline, fully offline.
+
+Starts a stub IMAP server seeded with synthetic orders, a local artwork HTTP server and fake
+wkhtmltopdf/SumatraPDF backends, runs the real engine against them in a scratch directory and reports
+orders per minute, p50/p99 latency and peak RSS.
+
+    python -m benchmarks.run_benchmark --orders 100 --sizes small,medium,large
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# The benchmark changes into a scratch directory, so resolve the repo modules up front.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.artwork_server import start_artwork_server
+from benchmarks.imap_stub import Mailbox, start_imap_stub
+from benchmarks.orders import SENDER, build_order
+from scripts import config_store
+from scripts import engine
+from scripts import logging_setup
+from scripts import metrics
+
+
+FAKE_TOOLS = os.path.join(REPO_ROOT, 'benchmarks', 'fake_tools.py')
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where it cannot be measured."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, macOS reports bytes.
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+
+def seed_mailbox(mailbox, count, sizes, artwork_base_url):
+    for index in range(count):
+        mailbox.add(build_order(index, sizes[index % len(sizes)], artwork_base_url))
+
+
+def benchmark_config(imap_port, **overrides):
+    config = config_store.validate_config({
+        "email": {
+            "address": "bench@example.com",
+            "password": "bench",
+            "imap_server": "127.0.0.1",
+            "imap_port": imap_port,
+            "imap_ssl": False
+        },
+        "allowed_senders": [SENDER],
+        "sleep_time": 1,
+        "body_printer": "BenchBodyPrinter",
+        "attachment_printer": "BenchLabelPrinter",
+        "metrics_port": 0,
+        "log_level": "WARNING"
+    })
+    config.update(overrides)
+    return config
+
+
+def use_fake_tools(print_log, tool_delay):
+    engine.WKHTMLTOPDF_COMMAND = [sys.executable, FAKE_TOOLS, 'wkhtmltopdf']
+    engine.SUMATRA_COMMAND = [sys.executable, FAKE_TOOLS, 'sumatra']
+    os.environ['FAKE_PRINT_LOG'] = print_log
+    os.environ['FAKE_TOOL_DELAY'] = str(tool_delay)
+    # Keep requests away from any proxy configured on the machine.
+    os.environ['NO_PROXY'] = '127.0.0.1,localhost'
+
+
+def run_benchmark(orders=50, sizes=('small', 'medium', 'large'), tool_delay=0.0, fail_every=0, timeout=600,
+                  workdir=None, config_overrides=None):
+    """Runs the engine until every seeded order is processed and returns a dict of results."""
+    workdir = workdir or tempfile.mkdtemp(prefix='moretranz-bench-')
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    os.makedirs('logs', exist_ok=True)
+
+    mailbox = Mailbox()
+    imap_server = start_imap_stub(mailbox)
+    artwork_server = start_artwork_server(fail_every=fail_every)
+    seed_mailbox(mailbox, orders, list(sizes), artwork_server.base_url)
+
+    print_log = os.path.join(workdir, 'print_jobs.log')
+    use_fake_tools(print_log, tool_delay)
+    config_store.save_config(benchmark_config(imap_server.port, **(config_overrides or {})))
+    logging_setup.setup_logging('WARNING', log_dir='logs')
+    metrics.HISTOGRAM_WINDOW = max(metrics.HISTOGRAM_WINDOW, orders)
+
+    done = threading.Event()
+    completed = []
+
+    def on_event(event, data):
+        if event == 'order':
+            completed.append(data['po_number'])
+            if len(completed) >= orders:
+                done.set()
+        elif event == 'stopped':
+            done.set()
+
+    engine.add_listener(on_event)
+    started = time.perf_counter()
+    try:
+        engine.start()
+        done.wait(timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        engine.stop()
+        if engine.processing_thread is not None:
+            engine.processing_thread.join()
+        imap_server.shutdown()
+        artwork_server.shutdown()
+        logging_setup.shutdown_logging()
+        os.chdir(previous_cwd)
+
+    stages = metrics.stage_summary()
+    order_latency = stages.get('process_single_email', {})
+    print_jobs = 0
+    if os.path.exists(print_log):
+        with open(print_log) as f:
+            print_jobs = sum(1 for _ in f)
+
+    return {
+        'orders': orders,
+        'completed': len(completed),
+        'elapsed_seconds': round(elapsed, 3),
+        'orders_per_minute': round(len(completed) / elapsed * 60, 1) if elapsed else 0.0,
+        'latency_p50_ms': round(order_latency.get('p50', 0.0) * 1000, 1),
+        'latency_p99_ms': round(order_latency.get('p99', 0.0) * 1000, 1),
+        'stages_p50_ms': {stage: round(summary['p50'] * 1000, 1) for stage, summary in stages.items()},
+        'stages_p99_ms': {stage: round(summary['p99'] * 1000, 1) for stage, summary in stages.items()},
+        'bytes_downloaded': metrics.counters().get('bytes_downloaded', 0),
+        'print_jobs': print_jobs,
+        'failures': metrics.counters().get('failures', 0),
+        'peak_rss_mb': peak_rss_mb(),
+        'workdir': workdir,
+    }
+
+
+def print_report(results):
+    print(f"Orders:            {results['completed']}/{results['orders']}")
+    print(f"Elapsed:           {results['elapsed_seconds']} s")
+    print(f"Throughput:        {results['orders_per_minute']} orders/min")
+    print(f"Latency p50 / p99: {results['latency_p50_ms']} ms / {results['latency_p99_ms']} ms")
+    for stage in sorted(results['stages_p50_ms']):
+        print(f"  {stage:<32} p50 {results['stages_p50_ms'][stage]:>9} ms   p99 {results['stages_p99_ms'][stage]:>9} ms")
+    print(f"Downloaded:        {results['bytes_downloaded'] / 1048576:.1f} MB")
+    print(f"Print jobs:        {results['print_jobs']}")
+    print(f"Failures:          {results['failures']}")
+    rss = results['peak_rss_mb']
+    print(f"Peak RSS:          {f'{rss:.1f} MB' if rss is not None else 'n/a'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=50, help="Number of synthetic orders to seed.")
+    parser.add_argument('--sizes', default='small,medium,large',
+                        help="Comma separated order sizes, cycled over the orders (small, medium, large).")
+    parser.add_argument('--tool-delay', type=float, default=0.0,
+                        help="Seconds each fake wkhtmltopdf/SumatraPDF call sleeps.")
+    parser.add_argument('--fail-every', type=int, default=0,
+                        help="Make roughly one in N artwork downloads fail with HTTP 503.")
+    parser.add_argument('--timeout', type=float, default=600, help="Give up after this many seconds.")
+    parser.add_argument('--workdir', help="Scratch directory. Defaults to a new temp directory.")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.orders, [size.strip() for size in args.sizes.split(',')], args.tool_delay,
+                            args.fail_every, args.timeout, args.workdir)
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0 if results['completed'] == results['orders'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
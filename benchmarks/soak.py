@@ -0,0 +1,268 @@
+"""Soak test: feeds synthetic orders to the real engine for hours and flags memory growth.
+
+Orders arrive at a steady rate through the stub IMAP server, as on a shop PC running unattended. Every
+checkpoint waits briefly for the orders in flight to finish, then records RSS, tracemalloc's traced memory and
+the per-stage allocation counters. After a warm-up, growth is fitted per hour; growth over the threshold,
+with the stages keeping the most memory per call, and a feed the engine cannot keep up with are flagged and
+the exit status is 1.
+
+    python -m benchmarks.soak --minutes 240 --rate 20
+    python -m benchmarks.soak --minutes 60 --rate 5 --tracemalloc-frames 1 --json soak.json
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# The soak test changes into a scratch directory, so resolve the repo modules up front.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.artwork_server import start_artwork_server
+from benchmarks.imap_stub import Mailbox, start_imap_stub
+from benchmarks.orders import build_order
+from benchmarks.run_benchmark import benchmark_config, use_fake_tools
+from scripts import config_store
+from scripts import engine
+from scripts import folder_index
+from scripts import logging_setup
+from scripts import metrics
+from scripts import profiling
+
+
+# Stages checked for memory they keep per call: the order as a whole and the parsing and rendering steps.
+WATCHED_STAGES = ('process_single_email', 'parse_order', 'process_and_print_email_body', 'convert_html_to_pdf',
+                  'convert_image_to_4x6_pdf')
+# PO folders older than this are deleted at each checkpoint so the disk does not fill up during long runs.
+FOLDER_TTL_SECONDS = 60
+# Below this much measured time, a few MB of allocator and cache warm-up extrapolate to hundreds of MB per
+# hour, so shorter runs report their growth without flagging it.
+MIN_MEASURED_MINUTES = 30
+
+
+def growth_per_hour(points):
+    """Least-squares slope of [(seconds, value)] scaled to one hour, or 0.0 with fewer than two points."""
+    if len(points) < 2:
+        return 0.0
+    n = len(points)
+    mean_t = sum(t for t, v in points) / n
+    mean_v = sum(v for t, v in points) / n
+    variance = sum((t - mean_t) ** 2 for t, v in points)
+    if not variance:
+        return 0.0
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / variance * 3600
+
+
+def _wait_idle(fed, completed, timeout):
+    """Waits up to timeout seconds for every fed order to finish, so a checkpoint does not count orders in
+    flight as growth. Returns whether the engine went idle."""
+    deadline = time.monotonic() + timeout
+    while len(completed) < len(fed):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    gc.collect()
+    return True
+
+
+def _remove_old_folders(root, now):
+    if not os.path.isdir(root):
+        return
+    for shard in os.listdir(root):
+        shard_path = os.path.join(root, shard)
+        if not (os.path.isdir(shard_path) and folder_index.SHARD_PATTERN.match(shard)):
+            continue
+        for name in os.listdir(shard_path):
+            path = os.path.join(shard_path, name)
+            if now - os.stat(path).st_mtime > FOLDER_TTL_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def run_soak(minutes=60, rate=20, sizes=('small', 'medium', 'large'), interval=60, warmup_minutes=None,
+             tool_delay=0.0, max_growth_mb_per_hour=10.0, max_stage_bytes=4096, tracemalloc_frames=0, workdir=None):
+    """Runs the soak test and returns a dict of checkpoints, growth figures and flagged findings."""
+    workdir = workdir or tempfile.mkdtemp(prefix='moretranz-soak-')
+    warmup = (minutes * 0.1 if warmup_minutes is None else warmup_minutes) * 60
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    os.makedirs('logs', exist_ok=True)
+
+    mailbox = Mailbox()
+    imap_server = start_imap_stub(mailbox)
+    artwork_server = start_artwork_server()
+    use_fake_tools(os.path.join(workdir, 'print_jobs.log'), tool_delay)
+    config = benchmark_config(imap_server.port)
+    config_store.save_config(config)
+    logging_setup.setup_logging('WARNING', log_dir='logs')
+    if tracemalloc_frames:
+        profiling.start_tracing(tracemalloc_frames)
+    metrics.reset_stage_allocations()
+
+    stop = threading.Event()
+    completed = []
+    fed = []
+    engine.add_listener(lambda event, data: completed.append(1) if event == 'order' else None)
+
+    def feed():
+        index = 0
+        while not stop.wait(60 / rate):
+            mailbox.add(build_order(index, sizes[index % len(sizes)], artwork_server.base_url))
+            fed.append(1)
+            index += 1
+
+    feeder = threading.Thread(target=feed, name="SoakFeeder", daemon=True)
+    checkpoints, baseline, heap_growth = [], None, []
+    started = time.monotonic()
+    try:
+        engine.start()
+        feeder.start()
+        while time.monotonic() - started < minutes * 60:
+            time.sleep(min(interval, max(0.0, minutes * 60 - (time.monotonic() - started))))
+            mailbox.drop_seen_bodies()
+            _remove_old_folders(config['attachments_folder'], time.time())
+            idle = _wait_idle(fed, completed, interval / 2)
+            status = profiling.memory_status()
+            elapsed = time.monotonic() - started
+            checkpoint = {'seconds': round(elapsed, 1), 'fed': len(fed), 'completed': len(completed),
+                          'idle': idle, 'rss_mb': status['rss_mb'],
+                          'traced_mb': status['traced_bytes'] / 1048576 if status['tracing'] else None,
+                          'stages': status['stages']}
+            checkpoints.append(checkpoint)
+            rss = f"{checkpoint['rss_mb']:.1f} MB" if checkpoint['rss_mb'] is not None else 'n/a'
+            traced = f"{checkpoint['traced_mb']:.1f} MB" if checkpoint['traced_mb'] is not None else 'n/a'
+            print(f"[{elapsed / 60:6.1f} min] {checkpoint['completed']}/{checkpoint['fed']} orders, RSS {rss}, "
+                  f"traced {traced}", file=sys.stderr)
+            if baseline is None and elapsed >= warmup:
+                baseline = checkpoint
+                if status['tracing']:
+                    profiling.heap_snapshot(save=False)
+        if baseline is not None and profiling.tracemalloc.is_tracing():
+            heap_growth = profiling.heap_snapshot()['growth']
+    finally:
+        stop.set()
+        engine.stop()
+        if engine.processing_thread is not None:
+            engine.processing_thread.join()
+        imap_server.shutdown()
+        artwork_server.shutdown()
+        profiling.stop_tracing()
+        logging_setup.shutdown_logging()
+        os.chdir(previous_cwd)
+
+    return analyse(checkpoints, baseline, heap_growth, max_growth_mb_per_hour, max_stage_bytes, workdir)
+
+
+def analyse(checkpoints, baseline, heap_growth, max_growth_mb_per_hour, max_stage_bytes, workdir=None):
+    """Fits memory growth after the warm-up and lists the findings over the thresholds."""
+    steady = [checkpoint for checkpoint in checkpoints if baseline and checkpoint['seconds'] >= baseline['seconds']]
+    # Memory is compared at idle checkpoints where possible; elsewhere it includes the orders in flight.
+    idle = [checkpoint for checkpoint in steady if checkpoint['idle']]
+    measured = idle if len(idle) >= 2 else steady
+    growth = {}
+    for key in ('rss_mb', 'traced_mb'):
+        points = [(checkpoint['seconds'], checkpoint[key]) for checkpoint in measured if checkpoint[key] is not None]
+        growth[key.replace('_mb', '_mb_per_hour')] = round(growth_per_hour(points), 2)
+
+    stages = {}
+    if len(steady) >= 2:
+        first, last = steady[0]['stages'], steady[-1]['stages']
+        for stage in WATCHED_STAGES:
+            calls = last.get(stage, {}).get('calls', 0) - first.get(stage, {}).get('calls', 0)
+            net = last.get(stage, {}).get('net_bytes', 0) - first.get(stage, {}).get('net_bytes', 0)
+            if calls:
+                stages[stage] = {'calls': calls, 'net_bytes_per_call': round(net / calls)}
+
+    # Waiting orders hold their whole message, so memory grows with a backlog without any leak.
+    backlog = [(checkpoint['seconds'], checkpoint['fed'] - checkpoint['completed']) for checkpoint in steady]
+    growth['backlog_per_hour'] = round(growth_per_hour(backlog), 1)
+
+    measured_minutes = (measured[-1]['seconds'] - measured[0]['seconds']) / 60 if measured else 0
+    judged = measured_minutes >= MIN_MEASURED_MINUTES
+    findings = [f"{key} grows {value} MB/hour (limit {max_growth_mb_per_hour})"
+                for key, value in growth.items()
+                if judged and key != 'backlog_per_hour' and value > max_growth_mb_per_hour]
+    # Orders fed during one checkpoint interval may still be in flight without the engine falling behind.
+    per_interval = (steady[-1]['fed'] - steady[0]['fed']) / (len(steady) - 1) if len(steady) >= 2 else 0
+    if len(backlog) >= 2 and backlog[-1][1] > backlog[0][1] + max(2, per_interval):
+        findings.insert(0, f"The engine fell behind the feed ({backlog[-1][1]} orders waiting at the end); "
+                           f"memory growth includes the queued orders. Lower --rate.")
+    # A stage's net bytes include what it returns and garbage not yet collected, so they only point at the
+    # cause of growth already seen in traced memory.
+    if judged and growth['traced_mb_per_hour'] > max_growth_mb_per_hour:
+        findings += [f"{stage} keeps {summary['net_bytes_per_call']} bytes per call (limit {max_stage_bytes})"
+                     for stage, summary in stages.items() if summary['net_bytes_per_call'] > max_stage_bytes]
+    if baseline is None:
+        findings.append("The run ended before the warm-up; nothing was measured.")
+    return {
+        'checkpoints': checkpoints,
+        'fed': checkpoints[-1]['fed'] if checkpoints else 0,
+        'completed': checkpoints[-1]['completed'] if checkpoints else 0,
+        'warmup_seconds': baseline['seconds'] if baseline else None,
+        'idle_checkpoints': len(idle),
+        'measured_minutes': round(measured_minutes, 1),
+        'judged': judged,
+        'growth': growth,
+        'stages': stages,
+        'heap_growth': heap_growth[:10],
+        'findings': findings,
+        'workdir': workdir,
+    }
+
+
+def print_report(results):
+    print(f"Orders:            {results['completed']}/{results['fed']}")
+    print(f"Warm-up:           {results['warmup_seconds']} s")
+    print(f"Idle checkpoints:  {results['idle_checkpoints']}")
+    print(f"Measured:          {results['measured_minutes']} min"
+          + ("" if results['judged'] else f" (under {MIN_MEASURED_MINUTES} min: growth is not judged)"))
+    for key, value in results['growth'].items():
+        print(f"{key + ':':<18} {value}")
+    for stage, summary in results['stages'].items():
+        print(f"  {stage:<32} {summary['net_bytes_per_call']:>10} bytes/call over {summary['calls']} calls")
+    if results['heap_growth']:
+        print("Largest heap growth since the warm-up:")
+        for entry in results['heap_growth']:
+            print(f"  {entry['bytes']:>10} bytes  {entry['blocks']:>6} blocks  {entry['site']}")
+    print("Findings:" if results['findings'] else "No memory growth found.")
+    for finding in results['findings']:
+        print(f"  {finding}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, default=60, help="Length of the run.")
+    parser.add_argument('--rate', type=float, default=20, help="Orders per minute fed to the mailbox.")
+    parser.add_argument('--sizes', default='small,medium,large',
+                        help="Comma separated order sizes, cycled over the orders (small, medium, large).")
+    parser.add_argument('--interval', type=float, default=60, help="Seconds between memory checkpoints.")
+    parser.add_argument('--warmup-minutes', type=float, help="Ignored start of the run (default: 10%% of it).")
+    parser.add_argument('--tool-delay', type=float, default=0.0,
+                        help="Seconds each fake wkhtmltopdf/SumatraPDF call sleeps.")
+    parser.add_argument('--max-growth', type=float, default=10.0, help="Flag RSS or traced growth above this MB/hour.")
+    parser.add_argument('--max-stage-bytes', type=int, default=4096,
+                        help="Flag watched stages keeping more than this many bytes per call.")
+    parser.add_argument('--tracemalloc-frames', type=int, default=0,
+                        help="Trace allocations with this traceback depth, for per-stage figures and heap growth. "
+                             "Slows processing several times, so lower --rate to match. 0 measures RSS only.")
+    parser.add_argument('--workdir', help="Scratch directory. Defaults to a new temp directory.")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    results = run_soak(args.minutes, args.rate, [size.strip() for size in args.sizes.split(',')], args.interval,
+                       args.warmup_minutes, args.tool_delay, args.max_growth, args.max_stage_bytes,
+                       args.tracemalloc_frames, args.workdir)
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 1 if results['findings'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""Multi-station test: several engine processes share one stub mailbox through a lease database.
+
+The stub IMAP server, the artwork server and the lease database live in this process; every station is a
+separate Python process with its own working directory, as on separate shop PCs. --kill-after crashes one
+station once that many orders are done, and the others must take over its leased orders after
+--lease-seconds. The report counts the body prints of every order: each must be printed exactly once,
+except orders the crashed station was printing when it died.
+
+    python -m benchmarks.stations --stations 3 --orders 60
+    python -m benchmarks.stations --stations 2 --orders 40 --kill-after 10 --lease-seconds 15 --tool-delay 0.5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+# Stations change into scratch directories, so resolve the repo modules up front.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.artwork_server import start_artwork_server
+from benchmarks.imap_stub import Mailbox, start_imap_stub
+from benchmarks.run_benchmark import benchmark_config, seed_mailbox, use_fake_tools
+from scripts import config_store
+from scripts import engine
+from scripts import logging_setup
+
+
+def run_station(imap_port, lease_db, station, workdir, print_log, tool_delay, lease_seconds):
+    """Runs one station until its stdin is closed. Prints one JSON line per processed order."""
+    os.makedirs(os.path.join(workdir, 'logs'), exist_ok=True)
+    os.chdir(workdir)
+    use_fake_tools(print_log, tool_delay)
+    config_store.save_config(benchmark_config(imap_port, coordination_db=lease_db, station_id=station,
+                                              lease_seconds=lease_seconds))
+    logging_setup.setup_logging('WARNING', log_dir='logs')
+
+    def on_event(event, data):
+        if event == 'order':
+            print(json.dumps({'station': station, 'po_number': data['po_number']}), flush=True)
+
+    engine.add_listener(on_event)
+    engine.start()
+    try:
+        sys.stdin.read()
+    finally:
+        engine.stop()
+        engine.processing_thread.join()
+        logging_setup.shutdown_logging()
+
+
+def body_prints(print_log):
+    """Returns {po_number: [station, ...]} of the order bodies in the fake print log."""
+    prints = {}
+    if not os.path.exists(print_log):
+        return prints
+    with open(print_log) as f:
+        for line in f:
+            tool, printer, file_path = line.rstrip('\n').split('\t')
+            if os.path.basename(file_path) != 'email_body.pdf':
+                continue
+            folder = os.path.dirname(file_path)
+            po_number = os.path.basename(folder).split('_')[0]
+            # Station folders are <workdir>/<station>/attachments/<shard>/<PO>_<customer>.
+            station = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(folder))))
+            prints.setdefault(po_number, []).append(station)
+    return prints
+
+
+def run_stations(stations=3, orders=60, sizes=('small', 'medium', 'large'), tool_delay=0.0, lease_seconds=15,
+                 kill_after=0, timeout=600, workdir=None):
+    """Runs the stations until every order is marked as read and returns a dict of results."""
+    workdir = workdir or tempfile.mkdtemp(prefix='moretranz-stations-')
+    mailbox = Mailbox()
+    imap_server = start_imap_stub(mailbox)
+    artwork_server = start_artwork_server()
+    seed_mailbox(mailbox, orders, list(sizes), artwork_server.base_url)
+    lease_db = os.path.join(workdir, 'leases.db')
+    print_log = os.path.join(workdir, 'print_jobs.log')
+
+    names = [f"station{number}" for number in range(1, stations + 1)]
+    completed = Counter()
+    lock = threading.Lock()
+    processes = {}
+
+    def follow(name, process):
+        for line in process.stdout:
+            try:
+                json.loads(line)
+            except ValueError:
+                continue
+            with lock:
+                completed[name] += 1
+
+    started = time.perf_counter()
+    for name in names:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.stations', '--station', name, '--imap-port', str(imap_server.port),
+             '--lease-db', lease_db, '--workdir', os.path.join(workdir, name), '--print-log', print_log,
+             '--tool-delay', str(tool_delay), '--lease-seconds', str(lease_seconds)],
+            cwd=REPO_ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        processes[name] = process
+        threading.Thread(target=follow, args=(name, process), daemon=True).start()
+
+    killed = None
+    try:
+        while mailbox.count_with_flag('\\Seen') < orders and time.perf_counter() - started < timeout:
+            time.sleep(0.2)
+            if kill_after and killed is None and sum(completed.values()) >= kill_after:
+                killed = names[0]
+                processes[killed].kill()
+                print(f"Killed {killed} after {sum(completed.values())} orders", file=sys.stderr)
+        elapsed = time.perf_counter() - started
+    finally:
+        for name, process in processes.items():
+            if name != killed:
+                process.stdin.close()
+        for process in processes.values():
+            process.wait()
+        imap_server.shutdown()
+        artwork_server.shutdown()
+
+    prints = body_prints(print_log)
+    expected = {str(100000 + index) for index in range(orders)}
+    duplicates = {po_number: printed for po_number, printed in prints.items() if len(printed) > 1}
+    return {
+        'stations': stations,
+        'orders': orders,
+        'marked_read': mailbox.count_with_flag('\\Seen'),
+        'elapsed_seconds': round(elapsed, 3),
+        'orders_per_minute': round(len(prints) / elapsed * 60, 1) if elapsed else 0.0,
+        'per_station': dict(completed),
+        'killed': killed,
+        'missing': sorted(expected - set(prints)),
+        # Orders the crashed station printed before dying are printed again by the station that took them over.
+        'reprinted_after_crash': sorted(po for po, printed in duplicates.items() if killed in printed),
+        'duplicates': sorted(po for po, printed in duplicates.items() if killed not in printed),
+        'workdir': workdir,
+    }
+
+
+def print_report(results):
+    print(f"Stations:          {results['stations']}" + (f" ({results['killed']} killed)" if results['killed'] else ""))
+    print(f"Orders:            {results['marked_read']}/{results['orders']} marked as read")
+    print(f"Elapsed:           {results['elapsed_seconds']} s")
+    print(f"Throughput:        {results['orders_per_minute']} orders/min")
+    for station, count in sorted(results['per_station'].items()):
+        print(f"  {station:<16} {count} orders")
+    print(f"Missing:           {', '.join(results['missing']) or 'none'}")
+    print(f"Printed twice:     {', '.join(results['duplicates']) or 'none'}")
+    if results['killed']:
+        print(f"Reprinted after the crash: {', '.join(results['reprinted_after_crash']) or 'none'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stations', type=int, default=3, help="Number of station processes.")
+    parser.add_argument('--orders', type=int, default=60, help="Number of synthetic orders to seed.")
+    parser.add_argument('--sizes', default='small,medium,large',
+                        help="Comma separated order sizes, cycled over the orders (small, medium, large).")
+    parser.add_argument('--tool-delay', type=float, default=0.0,
+                        help="Seconds each fake wkhtmltopdf/SumatraPDF call sleeps.")
+    parser.add_argument('--lease-seconds', type=int, default=15, help="Lease length of the stations.")
+    parser.add_argument('--kill-after', type=int, default=0,
+                        help="Kill the first station once this many orders are done (0: never).")
+    parser.add_argument('--timeout', type=float, default=600, help="Give up after this many seconds.")
+    parser.add_argument('--workdir', help="Scratch directory. Defaults to a new temp directory.")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    # Used by run_stations() to start the station processes.
+    parser.add_argument('--station', help=argparse.SUPPRESS)
+    parser.add_argument('--imap-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--lease-db', help=argparse.SUPPRESS)
+    parser.add_argument('--print-log', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.station:
+        run_station(args.imap_port, args.lease_db, args.station, args.workdir, args.print_log, args.tool_delay,
+                    args.lease_seconds)
+        return 0
+
+    results = run_stations(args.stations, args.orders, [size.strip() for size in args.sizes.split(',')],
+                           args.tool_delay, args.lease_seconds, args.kill_after, args.timeout, args.workdir)
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=4)
+    ok = results['marked_read'] == results['orders'] and not results['missing'] and not results['duplicates']
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +0,0 @@
-CONFIG = {
-    "email": {
-        "address": "your_email@gmail.com",
-        "password": "password",
-        "imap_server": "imap.gmail.com"
-    },
-    "allowed_senders": [
-        "steve@moretranz.com"
-    ],
-    "max_email_age_days": 10,
-    "processed_emails_file": "logs/processed_emails.txt",
-    "attachments_folder": "attachments",
-    "sleep_time": 5,
-    "body_printer": "BodyPrinter",
-    "attachment_printer": "AttachmentPrinter",
-    "auto_start": False
-}
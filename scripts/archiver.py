@@ -0,0 +1,335 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+import zipfile
+import zlib
+from datetime import datetime
+
+from scripts import config_store
+from scripts import folder_index
+
+
+INDEX_NAME = 'index.json'
+# Folders touched more recently than this are never archived, not even to meet the disk budget,
+# so an order that is still being processed or reprinted keeps its folder.
+MIN_AGE_DAYS = 1
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_listeners = []
+_thread = None
+_stop = threading.Event()
+
+
+def add_listener(callback):
+    """Registers callback(summary) called after every archiving pass that changed something."""
+    _listeners.append(callback)
+
+
+def _notify(summary):
+    for callback in list(_listeners):
+        try:
+            callback(summary)
+        except Exception:
+            logger.exception("Archiver listener failed")
+
+
+def _index_path(config):
+    return os.path.join(config['archive_folder'], INDEX_NAME)
+
+
+def load_index(config=None):
+    """Returns {folder relative to attachments_folder: {'archives', 'files', 'bytes', 'archived'}}.
+
+    'archives' lists the month archives holding the folder's files, oldest first. A folder that was
+    recreated while archived and archived again is spread over several months.
+    """
+    config = config or config_store.get_config()
+    try:
+        with open(_index_path(config), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.error("Archive index %s is corrupt; rebuilding it from the archives", _index_path(config))
+        return rebuild_index(config)
+
+
+def _members(config, archives, relative):
+    """Returns {member name: (archive name, ZipInfo)} of a folder's files. Later copies win."""
+    members = {}
+    for name in archives:
+        archive_path = os.path.join(config['archive_folder'], name)
+        if not os.path.exists(archive_path):
+            continue
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if os.path.dirname(info.filename) == relative:
+                    members[info.filename] = (name, info)
+    return members
+
+
+def _save_index(index, config):
+    path = _index_path(config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.index-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def rebuild_index(config=None):
+    """Recreates the index from the month archives on disk."""
+    config = config or config_store.get_config()
+    sizes = {}
+    index = {}
+    folder = config['archive_folder']
+    for name in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+        if not name.endswith('.zip'):
+            continue
+        with zipfile.ZipFile(os.path.join(folder, name)) as archive:
+            for info in archive.infolist():
+                relative = os.path.dirname(info.filename)
+                entry = index.setdefault(relative, {'archives': [], 'files': 0, 'bytes': 0, 'archived': None})
+                if name not in entry['archives']:
+                    entry['archives'].append(name)
+                sizes.setdefault(relative, {})[info.filename] = info.file_size
+    for relative, files in sizes.items():
+        index[relative].update(files=len(files), bytes=sum(files.values()))
+    _save_index(index, config)
+    return index
+
+
+def _folder_stats(path):
+    """Returns (newest mtime, total bytes, file count) of the files directly inside a PO folder."""
+    newest, total, count = os.stat(path).st_mtime, 0, 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                newest = max(newest, stat.st_mtime)
+                total += stat.st_size
+                count += 1
+    return newest, total, count
+
+
+def _live_folders(config, root=None):
+    """Returns [(newest mtime, bytes, path)] for every PO folder in the attachments folder, oldest first.
+
+    Month shard directories are descended into; see folder_index.
+    """
+    root = root or config['attachments_folder']
+    folders = []
+    if os.path.isdir(root):
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir() and folder_index.SHARD_PATTERN.match(entry.name):
+                    folders.extend(_live_folders(config, entry.path))
+                elif entry.is_dir():
+                    newest, total, count = _folder_stats(entry.path)
+                    folders.append((newest, total, entry.path))
+    return sorted(folders)
+
+
+def _crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _archive_bytes(config):
+    folder = config['archive_folder']
+    if not os.path.isdir(folder):
+        return 0
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder) if name.endswith('.zip'))
+
+
+def archive_folder(path, config=None, index=None):
+    """Compresses one PO folder into the archive of the month it was last touched and removes it.
+
+    A folder that is already in the index keeps its earlier archives, so files that were never restored
+    into it are not lost.
+    """
+    config = config or config_store.get_config()
+    relative = os.path.relpath(path, config['attachments_folder'])
+    newest, total, count = _folder_stats(path)
+    archive_name = datetime.fromtimestamp(newest).strftime('%Y-%m') + '.zip'
+    archive_path = os.path.join(config['archive_folder'], archive_name)
+    os.makedirs(config['archive_folder'], exist_ok=True)
+
+    with _lock:
+        save = index is None
+        index = load_index(config) if index is None else index
+        with zipfile.ZipFile(archive_path, 'a', zipfile.ZIP_DEFLATED) as archive:
+            # Later copies of a member come last in infolist(), so this holds the copy restore() would extract.
+            existing = {info.filename: (info.file_size, info.CRC) for info in archive.infolist()}
+            for name in sorted(os.listdir(path)):
+                file_path = os.path.join(path, name)
+                if not os.path.isfile(file_path):
+                    continue
+                member = f"{relative}/{name}".replace(os.sep, '/')
+                # A restored folder that is archived again only adds what changed since. The size alone
+                # misses a file rewritten with other bytes of the same length, so the content is compared too.
+                if member in existing and existing[member] == (os.path.getsize(file_path), _crc32(file_path)):
+                    continue
+                with warnings.catch_warnings():
+                    # Changed files are appended under their old name; restore() takes the last copy.
+                    warnings.simplefilter('ignore', UserWarning)
+                    archive.write(file_path, member)
+        shutil.rmtree(path)
+        parent = os.path.dirname(path)
+        if folder_index.SHARD_PATTERN.match(os.path.basename(parent)) and not os.listdir(parent):
+            os.rmdir(parent)
+        key = relative.replace(os.sep, '/')
+        archives = [name for name in (index[key]['archives'] if key in index else []) if name != archive_name]
+        archives.append(archive_name)
+        members = _members(config, archives, key)
+        index[key] = {'archives': archives, 'files': len(members),
+                      'bytes': sum(info.file_size for name, info in members.values()),
+                      'archived': datetime.now().isoformat(timespec='seconds')}
+        if save:
+            _save_index(index, config)
+    logger.info("Archived %s (%d files, %d bytes) into %s", path, count, total, archive_name)
+    return archive_name
+
+
+def is_archived(folder_path, config=None):
+    config = config or config_store.get_config()
+    relative = os.path.relpath(folder_path, config['attachments_folder']).replace(os.sep, '/')
+    return relative in load_index(config)
+
+
+def restore(folder_path, config=None):
+    """Extracts an archived PO folder back into place. Returns True when the folder exists afterwards.
+
+    A folder that was recreated while archived, e.g. by a re-send of the order, is merged with the archived
+    files; the files already in it are newer and are kept. The folder is then no longer in the index.
+    """
+    config = config or config_store.get_config()
+    relative = os.path.relpath(folder_path, config['attachments_folder']).replace(os.sep, '/')
+    with _lock:
+        index = load_index(config)
+        entry = index.get(relative)
+        if entry is None:
+            return os.path.isdir(folder_path)
+        archives = entry['archives']
+        try:
+            # Later archives and later copies win, so a folder archived twice comes back in its latest state.
+            members = _members(config, archives, relative)
+            for name in archives:
+                infos = [info for archive_name, info in members.values() if archive_name == name
+                         and not os.path.exists(os.path.join(config['attachments_folder'], info.filename))]
+                if not infos:
+                    continue
+                with zipfile.ZipFile(os.path.join(config['archive_folder'], name)) as archive:
+                    for info in infos:
+                        archive.extract(info, config['attachments_folder'])
+        except (OSError, zipfile.BadZipFile):
+            logger.exception("Failed to restore %s from %s", folder_path, ', '.join(archives))
+            return False
+        del index[relative]
+        _save_index(index, config)
+    logger.info("Restored %s from %s", folder_path, ', '.join(archives))
+    return os.path.isdir(folder_path)
+
+
+def run_once(config=None, now=None):
+    """Archives folders older than archive_after_days, then enforces disk_budget_mb. Returns a summary dict."""
+    config = config or config_store.get_config()
+    now = now or time.time()
+    summary = {'archived': 0, 'archived_bytes': 0, 'deleted_archives': []}
+    after_days = config['archive_after_days']
+    budget = config['disk_budget_mb'] * 1024 * 1024
+    if not after_days and not budget:
+        return summary
+
+    with _lock:
+        index = load_index(config)
+        folders = _live_folders(config)
+        live_bytes = sum(total for newest, total, path in folders)
+        used = live_bytes + _archive_bytes(config)
+        for newest, total, path in folders:
+            age_days = (now - newest) / 86400
+            expired = after_days and age_days >= after_days
+            over_budget = budget and used > budget and age_days >= MIN_AGE_DAYS
+            if not (expired or over_budget):
+                continue
+            try:
+                archive_folder(path, config, index)
+            except (OSError, zipfile.BadZipFile):
+                logger.exception("Failed to archive %s", path)
+                continue
+            summary['archived'] += 1
+            summary['archived_bytes'] += total
+            used = live_bytes - summary['archived_bytes'] + _archive_bytes(config)
+        if summary['archived']:
+            _save_index(index, config)
+
+        # Compression alone rarely meets the budget for PDFs and images; drop the oldest months, never this one.
+        current_month = datetime.fromtimestamp(now).strftime('%Y-%m') + '.zip'
+        if budget and used > budget and os.path.isdir(config['archive_folder']):
+            archives = sorted(name for name in os.listdir(config['archive_folder']) if name.endswith('.zip'))
+            for name in archives:
+                if used <= budget or name >= current_month:
+                    break
+                archive_path = os.path.join(config['archive_folder'], name)
+                used -= os.path.getsize(archive_path)
+                os.remove(archive_path)
+                for key, entry in list(index.items()):
+                    archives = [archive for archive in entry['archives'] if archive != name]
+                    if archives:
+                        entry['archives'] = archives
+                    else:
+                        del index[key]
+                summary['deleted_archives'].append(name)
+                logger.warning("Deleted archive %s to stay within the %d MB disk budget", name,
+                               config['disk_budget_mb'])
+            _save_index(index, config)
+        if used > budget > 0:
+            logger.warning("Attachments and archives use %d MB, over the %d MB budget", used // 1048576,
+                           config['disk_budget_mb'])
+
+    if summary['archived'] or summary['deleted_archives']:
+        _notify(summary)
+    return summary
+
+
+def _run(interval):
+    while True:
+        try:
+            run_once()
+        except Exception:
+            logger.exception("Archiving pass failed")
+        if _stop.wait(interval or config_store.get_config()['archive_interval_minutes'] * 60):
+            return
+
+
+def start(interval=None):
+    """Runs an archiving pass now and then every archive_interval_minutes on a daemon thread.
+
+    The setting is read again after every pass, so a change applies from the next wait. interval, in seconds,
+    overrides it.
+    """
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, args=(interval,), name="Archiver", daemon=True)
+    _thread.start()
+
+
+def stop():
+    _stop.set()
@@ -0,0 +1,333 @@
+import ast
+import copy
+import json
+import os
+import tempfile
+import logging
+import threading
+from types import MappingProxyType
+
+
+CONFIG_PATH = 'config/config.json'
+LEGACY_CONFIG_PATH = 'config/config.py'
+
+DEFAULT_CONFIG = {
+    "email": {
+        "address": "",
+        "password": "",
+        "imap_server": "imap.gmail.com",
+        "imap_port": 0,
+        "imap_ssl": True
+    },
+    "allowed_senders": [],
+    "max_email_age_days": 10,
+    "processed_emails_file": "logs/processed_emails.txt",
+    "attachments_folder": "attachments",
+    "sleep_time": 5,
+    "body_printer": "",
+    "attachment_printer": "",
+    "auto_start": False,
+    "metrics_port": 9108,
+    "log_level": "INFO",
+    "log_max_bytes": 5242880,
+    "log_backup_count": 5,
+    "max_concurrent_orders": 4,
+    "download_workers": 8,
+    "download_attempts": 3,
+    "retry_max_delay": 60,
+    "circuit_failure_threshold": 3,
+    "priority_keywords": ["rush", "urgent", "expedite", "asap"],
+    "priority_senders": [],
+    "priority_aging_per_minute": 10,
+    "archive_folder": "archive",
+    "archive_after_days": 30,
+    "archive_interval_minutes": 60,
+    "disk_budget_mb": 0,
+    "keep_render_files": False,
+    "control_port": 0,
+    "control_host": "127.0.0.1",
+    "control_token": "",
+    "tracemalloc_frames": 0,
+    "coordination_db": "",
+    "station_id": "",
+    "lease_seconds": 120
+}
+
+# Expected type of every field. Nested dicts describe nested sections, lists describe lists of that type.
+SCHEMA = {
+    "email": {
+        "address": str,
+        "password": str,
+        "imap_server": str,
+        "imap_port": int,
+        "imap_ssl": bool
+    },
+    "allowed_senders": [str],
+    "max_email_age_days": int,
+    "processed_emails_file": str,
+    "attachments_folder": str,
+    "sleep_time": int,
+    "body_printer": str,
+    "attachment_printer": str,
+    "auto_start": bool,
+    "metrics_port": int,
+    "log_level": str,
+    "log_max_bytes": int,
+    "log_backup_count": int,
+    "max_concurrent_orders": int,
+    "download_workers": int,
+    "download_attempts": int,
+    "retry_max_delay": int,
+    "circuit_failure_threshold": int,
+    "priority_keywords": [str],
+    "priority_senders": [str],
+    "priority_aging_per_minute": int,
+    "archive_folder": str,
+    "archive_after_days": int,
+    "archive_interval_minutes": int,
+    "disk_budget_mb": int,
+    "keep_render_files": bool,
+    "control_port": int,
+    "control_host": str,
+    "control_token": str,
+    "tracemalloc_frames": int,
+    "coordination_db": str,
+    "station_id": str,
+    "lease_seconds": int
+}
+
+# Lower bounds for numeric fields.
+MINIMUMS = {
+    "max_email_age_days": 0,
+    "sleep_time": 1,
+    "metrics_port": 0,
+    "log_max_bytes": 1024,
+    "log_backup_count": 0,
+    "max_concurrent_orders": 1,
+    "download_workers": 1,
+    "download_attempts": 1,
+    "retry_max_delay": 1,
+    "circuit_failure_threshold": 1,
+    "priority_aging_per_minute": 0,
+    "archive_after_days": 0,
+    "archive_interval_minutes": 1,
+    "disk_budget_mb": 0,
+    "control_port": 0,
+    "tracemalloc_frames": 0,
+    "lease_seconds": 15,
+}
+
+# Allowed values for enumerated fields.
+CHOICES = {
+    "log_level": ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"),
+}
+
+
+class ConfigError(ValueError):
+    """Raised when a configuration file cannot be parsed or does not match SCHEMA."""
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_snapshot = None
+_mtime = None
+_listeners = []
+_watch_thread = None
+_watch_stop = threading.Event()
+
+
+def _check(value, expected, name):
+    if isinstance(expected, dict):
+        if not isinstance(value, dict):
+            raise ConfigError(f"'{name}' must be a section, got {type(value).__name__}")
+        for key, sub_expected in expected.items():
+            if key not in value:
+                raise ConfigError(f"'{name}.{key}' is missing")
+            _check(value[key], sub_expected, f"{name}.{key}")
+    elif isinstance(expected, list):
+        if not isinstance(value, list):
+            raise ConfigError(f"'{name}' must be a list, got {type(value).__name__}")
+        for index, item in enumerate(value):
+            _check(item, expected[0], f"{name}[{index}]")
+    # bool is a subclass of int, so it has to be rejected explicitly for numeric fields.
+    elif not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+        raise ConfigError(f"'{name}' must be of type {expected.__name__}, got {type(value).__name__}")
+
+
+def _merge_defaults(data, defaults):
+    merged = copy.deepcopy(defaults)
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge_defaults(value, merged[key])
+        else:
+            merged[key] = value
+    return merged
+
+
+def validate_config(data):
+    """Fills in missing fields from DEFAULT_CONFIG and checks the result against SCHEMA.
+
+    Returns the completed, still mutable dict. Unknown keys are kept so newer files load on older builds.
+    """
+    if not isinstance(data, dict):
+        raise ConfigError("Configuration must be a JSON object.")
+    config = _merge_defaults(data, DEFAULT_CONFIG)
+    for key, expected in SCHEMA.items():
+        _check(config[key], expected, key)
+    for key, minimum in MINIMUMS.items():
+        if config[key] < minimum:
+            raise ConfigError(f"'{key}' must be at least {minimum}, got {config[key]}")
+    for key, choices in CHOICES.items():
+        if config[key] not in choices:
+            raise ConfigError(f"'{key}' must be one of {', '.join(choices)}, got {config[key]!r}")
+    return config
+
+
+def freeze(value):
+    """Returns a read-only deep copy: dicts become mappingproxies and lists become tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """Returns a mutable deep copy of a snapshot, suitable for editing and passing to save_config."""
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+def read_legacy_config(path=LEGACY_CONFIG_PATH):
+    """Reads the CONFIG dict literal out of the old config.py without executing it."""
+    with open(path, 'r') as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(target, 'id', None) == 'CONFIG' for target in node.targets):
+            try:
+                return ast.literal_eval(node.value)
+            except ValueError as e:
+                raise ConfigError(f"CONFIG in {path} is not a plain literal: {e}")
+    raise ConfigError(f"No CONFIG assignment found in {path}")
+
+
+def _write_atomic(path, data):
+    """Writes JSON to a temp file next to path and renames it over path, so readers never see a partial file."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.config-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return validate_config(json.load(f))
+    except json.JSONDecodeError as e:
+        raise ConfigError(f"{path} is not valid JSON: {e}")
+
+
+def _publish(config, mtime):
+    global _snapshot, _mtime
+    snapshot = freeze(config)
+    with _lock:
+        _snapshot = snapshot
+        _mtime = mtime
+    return snapshot
+
+
+def _notify(snapshot, error):
+    for callback in list(_listeners):
+        try:
+            callback(snapshot, error)
+        except Exception:
+            logger.exception("Config listener failed")
+
+
+def load_config(path=CONFIG_PATH):
+    """Loads, validates and publishes the configuration, returning the new snapshot.
+
+    A missing file is created from the legacy config.py when present, otherwise from DEFAULT_CONFIG.
+    """
+    if not os.path.exists(path):
+        if os.path.exists(LEGACY_CONFIG_PATH):
+            config = validate_config(read_legacy_config())
+        else:
+            config = validate_config({})
+        _write_atomic(path, config)
+    config = _read(path)
+    return _publish(config, os.stat(path).st_mtime_ns)
+
+
+def get_config():
+    """Returns the current immutable snapshot. Hold on to it for the duration of one unit of work."""
+    with _lock:
+        return _snapshot
+
+
+def save_config(config, path=CONFIG_PATH):
+    """Validates config, writes it atomically and publishes it to every listener. Returns the new snapshot."""
+    config = validate_config(thaw(config))
+    _write_atomic(path, config)
+    snapshot = _publish(config, os.stat(path).st_mtime_ns)
+    _notify(snapshot, None)
+    return snapshot
+
+
+def add_listener(callback):
+    """Registers callback(snapshot, error) to run whenever a new configuration is published.
+
+    On a failed reload the previous snapshot stays active and callback receives it together with the error.
+    Callbacks run on the thread that published the change.
+    """
+    _listeners.append(callback)
+
+
+def _watch(path, interval):
+    global _mtime
+    while not _watch_stop.wait(interval):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        with _lock:
+            unchanged = mtime == _mtime
+        if unchanged:
+            continue
+        try:
+            config = _read(path)
+        except (ConfigError, OSError) as e:
+            with _lock:
+                # Remember the broken version so the error is reported once, not on every poll.
+                _mtime = mtime
+                snapshot = _snapshot
+            _notify(snapshot, e)
+            continue
+        _notify(_publish(config, mtime), None)
+
+
+def start_watching(path=CONFIG_PATH, interval=1.0):
+    """Polls the config file in a daemon thread and publishes every valid change."""
+    global _watch_thread
+    if _watch_thread is not None and _watch_thread.is_alive():
+        return
+    _watch_stop.clear()
+    _watch_thread = threading.Thread(target=_watch, args=(path, interval), name="ConfigWatcher", daemon=True)
+    _watch_thread.start()
+
+
+def stop_watching():
+    _watch_stop.set()
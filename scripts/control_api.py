@@ -0,0 +1,378 @@
+import hmac
+import ipaddress
+import json
+import logging
+import queue
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from scripts import archiver
+from scripts import config_store
+from scripts import engine
+from scripts import folder_index
+from scripts import leases
+from scripts import metrics
+from scripts import printers as printer_registry
+from scripts import profiling
+from scripts import resilience
+
+
+# Seconds between keep-alive comments on idle event streams, so proxies and clients notice dead connections.
+KEEPALIVE_SECONDS = 15
+# Events buffered per stream client. A client that falls this far behind is disconnected rather than slowing
+# down the threads that publish events.
+CLIENT_QUEUE_SIZE = 1000
+# Default number of history entries returned by GET /orders.
+ORDERS_LIMIT = 50
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_server = None
+# Queues of the connected /events clients.
+_clients = set()
+_listening = False
+
+
+def publish(event, data):
+    """Sends an event to every /events client. Never blocks; safe from any thread."""
+    message = f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode()
+    with _lock:
+        clients = list(_clients)
+    for client in clients:
+        try:
+            client.put_nowait(message)
+        except queue.Full:
+            with _lock:
+                _clients.discard(client)
+            logger.warning("Disconnected an event stream client that stopped reading")
+
+
+def _listen():
+    """Forwards engine, circuit breaker and archiver events to the event stream, once per process."""
+    global _listening
+    if _listening:
+        return
+    _listening = True
+    engine.add_listener(publish)
+    resilience.add_listener(lambda endpoint, state: publish('circuit', {'endpoint': endpoint, 'state': state}))
+    archiver.add_listener(lambda summary: publish('archived', summary))
+
+
+def _check_po(po_number):
+    """PO numbers end up in IMAP commands and file lookups, so anything else is rejected with 400."""
+    if not engine.PO_NUMBER.match(po_number):
+        raise ValueError(f"Not a PO number: {po_number!r}")
+
+
+def _history(po_number=None):
+    entries = []
+    for line in engine.load_log_history():
+        parts = line.split(' - ', 2)
+        if len(parts) == 3 and po_number in (None, parts[0]):
+            entries.append({'po_number': parts[0], 'processed_time': parts[1], 'folder_path': parts[2]})
+    return entries
+
+
+def get_status(query):
+    state = engine.snapshot()
+    return 200, {
+        'running': engine.is_running,
+        'queued': len(state['queued']),
+        'processing': state['processing'],
+        'in_flight': state['in_flight'],
+        'emails_per_minute': metrics.emails_per_minute(),
+        'counters': metrics.counters(),
+        'circuits': resilience.breaker_states(),
+        'paused_printers': printer_registry.paused_printers(),
+        'station': leases.current_station() if leases.enabled() else None,
+    }
+
+
+def get_queue(query):
+    state = engine.snapshot()
+    return 200, {'queued': state['queued'], 'processing': state['processing']}
+
+
+def get_orders(query):
+    limit = int(query.get('limit', [ORDERS_LIMIT])[0])
+    return 200, {'orders': _history()[::-1][:limit]}
+
+
+def get_order(query, po_number):
+    _check_po(po_number)
+    state = engine.snapshot()
+    history = _history(po_number)
+    folder_path = folder_index.lookup(po_number)
+    if any(entry['po_number'] == po_number for entry in state['processing']):
+        status = 'processing'
+    elif any(entry['label'] == po_number for entry in state['queued']):
+        status = 'queued'
+    elif history:
+        status = 'processed'
+    else:
+        return 404, {'error': f"Unknown PO {po_number}"}
+    folder_path = folder_path or (history[-1]['folder_path'] if history else None)
+    return 200, {
+        'po_number': po_number,
+        'status': status,
+        'history': history,
+        'folder_path': folder_path,
+        'archived': bool(folder_path) and archiver.is_archived(folder_path),
+        'timings': metrics.get_order_timings(po_number),
+    }
+
+
+def post_reprint(query, po_number):
+    _check_po(po_number)
+    if folder_index.lookup(po_number) is None:
+        return 404, {'error': f"No folder found for PO {po_number}"}
+
+    def run():
+        try:
+            publish('reprint', {'po_number': po_number, 'printed': engine.reprint(po_number)})
+        except Exception as e:
+            logger.exception("Reprint of PO %s failed", po_number)
+            publish('reprint', {'po_number': po_number, 'error': str(e)})
+
+    threading.Thread(target=run, name="Reprint", daemon=True).start()
+    return 202, {'po_number': po_number, 'status': 'reprinting'}
+
+
+def post_requeue(query, po_number):
+    _check_po(po_number)
+    try:
+        future = engine.requeue(po_number)
+    except RuntimeError as e:
+        return 409, {'error': str(e)}
+
+    def done(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            publish('requeue', {'po_number': po_number, 'error': str(error)})
+        else:
+            publish('requeue', {'po_number': po_number, 'processed': future.result() is not None})
+
+    future.add_done_callback(done)
+    return 202, {'po_number': po_number, 'status': 'requeued'}
+
+
+def get_printers(query):
+    config = config_store.get_config()
+    return 200, {
+        'body_printer': config['body_printer'],
+        'attachment_printer': config['attachment_printer'],
+        'installed': printer_registry.get_printers(),
+        'paused': printer_registry.paused_printers(),
+    }
+
+
+def post_pause(query, printer_name):
+    engine.pause_printer(printer_name)
+    publish('printer', {'printer': printer_name, 'paused': True})
+    return 200, {'printer': printer_name, 'paused': True}
+
+
+def post_resume(query, printer_name):
+    held = engine.resume_printer(printer_name)
+    publish('printer', {'printer': printer_name, 'paused': False, 'held_jobs': held})
+    return 200, {'printer': printer_name, 'paused': False, 'held_jobs': held}
+
+
+def get_leases(query):
+    if not leases.enabled():
+        return 409, {'error': "This station does not share orders (coordination_db is not set)."}
+    return 200, {'station': leases.current_station(), 'leases': leases.active()}
+
+
+def get_memory(query):
+    return 200, profiling.memory_status()
+
+
+def get_heap(query):
+    try:
+        return 200, profiling.heap_snapshot(int(query.get('limit', [profiling.TOP_ALLOCATIONS])[0]))
+    except RuntimeError as e:
+        return 409, {'error': str(e)}
+
+
+def post_tracing_start(query):
+    profiling.start_tracing(int(query.get('frames', [10])[0]))
+    return 200, {'tracing': True}
+
+
+def post_tracing_stop(query):
+    profiling.stop_tracing()
+    return 200, {'tracing': False}
+
+
+def post_sampling_start(query):
+    profiling.start_sampling(float(query.get('interval_ms', [profiling.SAMPLE_INTERVAL * 1000])[0]) / 1000)
+    return 200, {'sampling': True}
+
+
+def post_sampling_stop(query):
+    result = profiling.stop_sampling()
+    if result is None:
+        return 409, {'error': "Sampling is not running."}
+    return 200, result
+
+
+# (method, path pattern, handler). Captured groups are URL-decoded and passed after the query.
+ROUTES = (
+    ('GET', re.compile(r'^/status$'), get_status),
+    ('GET', re.compile(r'^/queue$'), get_queue),
+    ('GET', re.compile(r'^/orders$'), get_orders),
+    ('GET', re.compile(r'^/orders/([^/]+)$'), get_order),
+    ('POST', re.compile(r'^/orders/([^/]+)/reprint$'), post_reprint),
+    ('POST', re.compile(r'^/orders/([^/]+)/requeue$'), post_requeue),
+    ('GET', re.compile(r'^/printers$'), get_printers),
+    ('POST', re.compile(r'^/printers/([^/]+)/pause$'), post_pause),
+    ('POST', re.compile(r'^/printers/([^/]+)/resume$'), post_resume),
+    ('GET', re.compile(r'^/leases$'), get_leases),
+    ('GET', re.compile(r'^/profile/memory$'), get_memory),
+    ('GET', re.compile(r'^/profile/heap$'), get_heap),
+    ('POST', re.compile(r'^/profile/tracemalloc/start$'), post_tracing_start),
+    ('POST', re.compile(r'^/profile/tracemalloc/stop$'), post_tracing_stop),
+    ('POST', re.compile(r'^/profile/sampling/start$'), post_sampling_start),
+    ('POST', re.compile(r'^/profile/sampling/stop$'), post_sampling_stop),
+)
+
+
+class _ControlHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _same_origin(self):
+        """Rejects requests from web pages of other sites and, without a token, any Host but loopback.
+
+        Browsers send Origin with cross-site POSTs, and a page that rebinds its own DNS name to 127.0.0.1
+        still sends its own name as Host.
+        """
+        host = self.headers.get('Host', '')
+        origin = self.headers.get('Origin')
+        if origin is not None and urlparse(origin).netloc.lower() != host.lower():
+            return False
+        if not self.server.token:
+            hostname = urlparse(f"//{host}").hostname or ''
+            return _is_loopback(hostname) or hostname == self.server.host
+        return True
+
+    def _authorized(self, query):
+        token = self.server.token
+        if not token:
+            return True
+        header = self.headers.get('Authorization', '')
+        supplied = header[len('Bearer '):] if header.startswith('Bearer ') else query.get('token', [''])[0]
+        return hmac.compare_digest(supplied.encode(), token.encode())
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if not self._same_origin():
+            self._send_json(403, {'error': "Cross-origin requests are not allowed."})
+            return
+        if not self._authorized(query):
+            self._send_json(401, {'error': "Missing or wrong token."})
+            return
+        if method == 'GET' and url.path == '/events':
+            self._stream_events()
+            return
+        for route_method, pattern, handler in ROUTES:
+            match = pattern.match(url.path)
+            if match and route_method == method:
+                try:
+                    status, payload = handler(query, *(unquote(group) for group in match.groups()))
+                except ValueError as e:
+                    status, payload = 400, {'error': str(e)}
+                except Exception as e:
+                    logger.exception("Control API request %s %s failed", method, self.path)
+                    status, payload = 500, {'error': str(e)}
+                self._send_json(status, payload)
+                return
+        self._send_json(404, {'error': f"No route for {method} {url.path}"})
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_events(self):
+        client = queue.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        with _lock:
+            _clients.add(client)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            self.wfile.write(b": connected\n\n")
+            self.wfile.flush()
+            while True:
+                with _lock:
+                    if client not in _clients:
+                        return
+                try:
+                    message = client.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    message = b": keep-alive\n\n"
+                self.wfile.write(message)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with _lock:
+                _clients.discard(client)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def start_server(port, host='127.0.0.1', token=''):
+    """Serves the control API on daemon threads. A server with other settings is replaced; port 0 stops it.
+
+    Anything but a loopback host requires a token, since the API can print and requeue orders.
+    """
+    global _server
+    if _server is not None:
+        if (_server.server_address[1], _server.host, _server.token) == (port, host, token):
+            return
+        stop_server()
+    if not port:
+        return
+    if not token and not _is_loopback(host):
+        raise ValueError(f"control_token must be set to serve the control API on {host}")
+    _listen()
+    server = ThreadingHTTPServer((host, port), _ControlHandler)
+    server.daemon_threads = True
+    server.host, server.token = host, token
+    _server = server
+    threading.Thread(target=server.serve_forever, name="ControlAPI", daemon=True).start()
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+        # Ends the open event streams.
+        with _lock:
+            _clients.clear()
@@ -0,0 +1,1119 @@
+import asyncio
+import base64
+import cgi
+import email
+import imaplib
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse, parse_qs
+
+import pytz
+from bs4 import BeautifulSoup
+from PIL import Image
+from reportlab.lib.units import inch
+from reportlab.pdfgen import canvas
+
+from scripts import archiver
+from scripts import config_store
+from scripts import folder_index
+from scripts import leases
+from scripts import metrics
+from scripts import order_index
+from scripts import printers as printer_registry
+from scripts import resilience
+from scripts.scheduler import PriorityScheduler, order_priority
+from scripts.utils import (count_pdf_pages, download_and_save_attachment, message_text, read_processed_emails,
+                           save_processed_email)
+
+
+SUMATRA_PDF_PATH = "lib/sumatrapdf.exe"
+WKHTMLTOPDF_PATH = "lib/wkhtmltox/bin/wkhtmltopdf.exe"
+
+# Executables are kept as argument prefixes so alternative backends (e.g. the benchmark fakes) can be swapped in.
+SUMATRA_COMMAND = [os.path.normpath(SUMATRA_PDF_PATH)]
+WKHTMLTOPDF_COMMAND = [WKHTMLTOPDF_PATH]
+
+LOG_HISTORY_PATH = 'logs/processed_emails_history.txt'
+
+# Attachments with these extensions are printed as shipping labels.
+LABEL_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg')
+# Copies of the files sent to paused printers, in a folder per paused printer; printed and deleted when it resumes.
+HELD_JOBS_FOLDER = 'logs/held_jobs'
+
+# src attributes of inline images, e.g. src="cid:image001@01D9"; groups are prefix, content id and closing quote.
+_CID_SRC = re.compile(r'''(src\s*=\s*["']?)cid:([^"'\s>]+)(["']?)''', re.IGNORECASE)
+
+# PO numbers as parse_po() finds them: digits, plus one "-R" per replacement.
+PO_NUMBER = re.compile(r'^\d+(-R)*$')
+
+# Seconds start() waits for the previous run to finish stopping before it refuses to start another.
+STOP_TIMEOUT = 10
+
+# Socket timeout in seconds for IMAP connections, so a dead server fails fast instead of hanging the IMAP thread.
+IMAP_TIMEOUT = 30
+
+# Failures of the connection rather than of the order: IMAP errors and aborts, dropped connections and socket
+# timeouts, open circuits. Emails failing with these stay unread and are retried on a later poll. Other OSErrors,
+# e.g. a full disk or a locked file, come from the order and would fail again on every poll.
+RETRYABLE_ERRORS = (socket.timeout, ConnectionError, imaplib.IMAP4.abort, imaplib.IMAP4.error,
+                    resilience.CircuitOpenError)
+
+# Emails a station leases per processing slot when it shares the mailbox: one running and one waiting. The rest
+# are left to the other stations.
+CLAIM_AHEAD = 2
+
+logger = logging.getLogger(__name__)
+
+mail = None
+is_running = False
+processing_thread = None
+_listeners = []
+# Serializes start(), which may wait for the previous run, and counts stop() calls so that a stop during that
+# wait cancels the start.
+_start_lock = threading.Lock()
+_stops = 0
+
+# Event loop state of the current run, owned by the processing thread.
+_loop = None
+_main_task = None
+# Set by stop(); checked by blocking work running in executor threads, such as chunked downloads.
+_cancel_event = threading.Event()
+# imaplib connections are not thread-safe, so every IMAP call goes through this single thread.
+_imap_executor = None
+# Downloads and attachment writes.
+_io_executor = None
+# Parsing, wkhtmltopdf, label rendering and printing.
+_render_executor = None
+# Ranks fetched orders and hands out the max_concurrent_orders processing slots.
+_scheduler = None
+# Sequence numbers of emails that are queued or being processed, so the next poll does not pick them up again.
+_in_flight = set()
+# {po_number: start time} of the orders being downloaded, rendered and printed. Owned by the event loop.
+_processing = {}
+# {sequence number: lease key} of the queued and running emails leased from coordination_db.
+_leases = {}
+
+
+def add_listener(callback):
+    """Registers callback(event, data) for engine events.
+
+    Events are 'status' (data: message), 'order' (data: dict with po_number, processed_time, folder_path)
+    and 'stopped' (data: None). Callbacks run on the processing thread.
+    """
+    _listeners.append(callback)
+
+
+def _notify(event, data):
+    for callback in list(_listeners):
+        try:
+            callback(event, data)
+        except Exception:
+            logger.exception("Engine listener failed")
+
+
+def update_status(message):
+    logger.info(message)
+    _notify('status', message)
+
+
+def start():
+    """Starts process_emails on a background thread. Returns whether a run was started.
+
+    After stop(), the previous run's thread is given STOP_TIMEOUT seconds to finish first, so two runs never
+    share the engine's state. Nothing is started while it is already running or still stopping, or when stop()
+    is called during the wait. GUI code should call it off the Tk thread.
+    """
+    global is_running, processing_thread
+    with _start_lock:
+        if is_running:
+            return False
+        stops = _stops
+        previous = processing_thread
+        if previous is not None and previous.is_alive():
+            previous.join(STOP_TIMEOUT)
+            if previous.is_alive():
+                update_status("The previous run is still stopping. Try again in a moment.")
+                return False
+        if _stops != stops:
+            return False
+        is_running = True
+        _cancel_event.clear()
+        processing_thread = threading.Thread(target=process_emails, name="EmailProcessor")
+        processing_thread.start()
+        return True
+
+
+def stop():
+    """Stops processing now: pending sleeps, in-flight downloads and queued orders are cancelled.
+
+    A wkhtmltopdf or SumatraPDF call that is already running finishes in the background.
+    """
+    global is_running, _stops
+    is_running = False
+    _stops += 1
+    _cancel_event.set()
+    loop, task = _loop, _main_task
+    if loop is not None and task is not None:
+        loop.call_soon_threadsafe(task.cancel)
+
+
+def _submit(coro):
+    """Schedules coro on the engine's event loop from another thread. Returns a concurrent.futures.Future."""
+    loop = _loop
+    if loop is None or loop.is_closed():
+        coro.close()
+        raise RuntimeError("The processor is not running.")
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+
+async def _snapshot():
+    return {
+        'queued': _scheduler.pending(),
+        'processing': [{'po_number': po_number, 'started': started} for po_number, started in _processing.items()],
+        'in_flight': len(_in_flight),
+    }
+
+
+def snapshot(timeout=2):
+    """Returns the waiting orders (see PriorityScheduler.pending), the orders being processed and the number of
+    emails in flight. Safe to call from any thread; taken on the event loop so it is consistent.
+    """
+    try:
+        return _submit(_snapshot()).result(timeout)
+    except RuntimeError:
+        return {'queued': [], 'processing': [], 'in_flight': 0}
+
+
+def requeue(po_number):
+    """Fetches the newest email mentioning po_number again and runs it through the pipeline in full.
+
+    Safe to call from any thread while processing runs. Returns a concurrent.futures.Future of the PO number
+    processed, or of None when no email matched. Raises ValueError for anything but a PO number, since it
+    ends up in an IMAP command.
+    """
+    if not PO_NUMBER.match(po_number):
+        raise ValueError(f"Not a PO number: {po_number!r}")
+    return _submit(_requeue(po_number, config_store.get_config()))
+
+
+async def _requeue(po_number, config):
+    if mail is None:
+        raise ConnectionError("Not connected to the email server.")
+    status, data = await _imap(_mail_command, config, 'SEARCH', None, 'TEXT', f'"{po_number}"')
+    email_ids = data[0].split()
+    if not email_ids:
+        update_status(f"No email found for PO {po_number}. Nothing to requeue.")
+        return None
+    e_id = email_ids[-1]
+    with metrics.order_scope(), metrics.span('requeue'):
+        status, msg_data = await _imap(_mail_command, config, 'FETCH', e_id, '(BODY.PEEK[])')
+        raw_message = next(part[1] for part in msg_data if isinstance(part, tuple))
+        msg = await _run_in(None, email.message_from_bytes, raw_message)
+        priority, label = await _run_in(None, _rank, msg, config, po_number)
+        update_status(f"Requeued PO {po_number}.")
+        async with _scheduler.slot(priority, label):
+            return await process_message(raw_message, config, check_age=False, force=True, msg=msg)
+
+
+def reprint(po_number, config=None):
+    """Prints the saved body PDF and labels of a processed PO again, without fetching or downloading anything.
+
+    Labels are the files whose content the order index recorded as printed, so downloaded artwork is left
+    alone. Archived folders are restored first. Returns the number of files printed. Blocks until printed.
+    """
+    config = config or config_store.get_config()
+    folder_path = folder_index.lookup(po_number, config)
+    if folder_path is None or not archiver.restore(folder_path, config):
+        raise FileNotFoundError(f"No folder found for PO {po_number}")
+    labels = order_index.printed_items(po_number)
+    printed = 0
+    for name in sorted(os.listdir(folder_path)):
+        file_path = os.path.join(folder_path, name)
+        if name == 'email_body.pdf':
+            printed += print_with_sumatra(file_path, config['body_printer'], "fit")
+        elif name.endswith(LABEL_EXTENSIONS) and name != 'label.pdf' and _file_fingerprint(file_path) in labels:
+            printed += process_and_print_label(file_path, folder_path, config)
+    update_status(f"Reprinted {printed} file(s) of PO {po_number}.")
+    return printed
+
+
+def _file_fingerprint(file_path):
+    with open(file_path, 'rb') as f:
+        return order_index.fingerprint(f.read())
+
+
+def _held_jobs_folder(printer_name):
+    # Printer names such as \\server\labels are not valid file names; hex keeps them apart and reversible.
+    return os.path.join(HELD_JOBS_FOLDER, printer_name.encode().hex())
+
+
+def pause_printer(printer_name):
+    """Holds jobs for printer_name, e.g. while it is reloaded with labels, until resume_printer() is called.
+
+    The printer's folder in HELD_JOBS_FOLDER keeps it paused across restarts; see load_held_jobs().
+    """
+    os.makedirs(_held_jobs_folder(printer_name), exist_ok=True)
+    printer_registry.pause(printer_name)
+    update_status(f"Printer {printer_name} paused. New jobs are held.")
+
+
+def resume_printer(printer_name):
+    """Resumes printer_name and prints its held jobs, oldest first, on a background thread. Returns their number."""
+    jobs = printer_registry.resume(printer_name)
+    update_status(f"Printer {printer_name} resumed. Printing {len(jobs)} held job(s).")
+
+    def print_held():
+        for file_path, print_settings in jobs:
+            print_with_sumatra(file_path, printer_name, print_settings)
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        # Paused again meanwhile: the folder now belongs to the new pause.
+        if not printer_registry.is_paused(printer_name):
+            try:
+                os.rmdir(_held_jobs_folder(printer_name))
+            except OSError:
+                pass
+
+    if jobs:
+        threading.Thread(target=print_held, name="HeldJobs", daemon=True).start()
+    else:
+        print_held()
+    return len(jobs)
+
+
+def load_held_jobs():
+    """Pauses the printers that were paused when the app last closed and holds their jobs again, oldest first.
+
+    Call once at startup. Returns {printer name: number of held jobs}.
+    """
+    restored = {}
+    if not os.path.isdir(HELD_JOBS_FOLDER):
+        return restored
+    for folder in sorted(os.listdir(HELD_JOBS_FOLDER)):
+        folder_path = os.path.join(HELD_JOBS_FOLDER, folder)
+        try:
+            printer_name = bytes.fromhex(folder).decode()
+        except ValueError:
+            continue
+        if not os.path.isdir(folder_path):
+            continue
+        printer_registry.pause(printer_name)
+        restored[printer_name] = 0
+        # <time_ns>_<id>_<print settings>_<original name>, see _hold_job().
+        for name in sorted(os.listdir(folder_path)):
+            parts = name.split('_', 3)
+            if len(parts) == 4 and printer_registry.hold(printer_name, (os.path.join(folder_path, name), parts[2])):
+                restored[printer_name] += 1
+    for printer_name, held in restored.items():
+        update_status(f"Printer {printer_name} is still paused. Holding {held} job(s) from the last session.")
+    return restored
+
+
+def _hold_job(file_path, printer_name, print_settings):
+    """Keeps a copy of a job for a paused printer; the original may be overwritten before it resumes.
+
+    The copy is named so that load_held_jobs() restores it in order and with its print settings.
+    """
+    folder = _held_jobs_folder(printer_name)
+    os.makedirs(folder, exist_ok=True)
+    held_path = os.path.join(folder, f"{time.time_ns():020d}_{uuid.uuid4().hex[:8]}_{print_settings or 'noscale'}_"
+                                     f"{os.path.basename(file_path)}")
+    shutil.copyfile(file_path, held_path)
+    if printer_registry.hold(printer_name, (held_path, print_settings)):
+        update_status(f"Printer {printer_name} is paused. Holding {os.path.basename(file_path)}.")
+        return True
+    # Resumed while copying.
+    os.remove(held_path)
+    return False
+
+
+def load_log_history():
+    if os.path.exists(LOG_HISTORY_PATH):
+        with open(LOG_HISTORY_PATH, 'r') as file:
+            return [line.strip() for line in file.readlines()]
+    return []
+
+
+def save_log_history(po_number, processed_time, folder_path):
+    with open(LOG_HISTORY_PATH, 'a') as file:
+        file.write(f"{po_number} - {processed_time} - {folder_path}\n")
+
+
+def connect_to_email(email_settings):
+    try:
+        imap_class = imaplib.IMAP4_SSL if email_settings['imap_ssl'] else imaplib.IMAP4
+        if email_settings['imap_port']:
+            mail = imap_class(email_settings['imap_server'], email_settings['imap_port'], timeout=IMAP_TIMEOUT)
+        else:
+            mail = imap_class(email_settings['imap_server'], timeout=IMAP_TIMEOUT)
+        mail.login(email_settings['address'], email_settings['password'])
+        mail.select("inbox")
+        return mail
+    except Exception as e:
+        update_status(f"Failed to connect to email: {e}")
+        return None
+    
+def parse_po(email_body):
+    """Returns (po_number, customer_name) found in an order body, or (None, None). Has no side effects."""
+    original_po_match = re.search(r"Original PO - (\d+)", email_body)
+    replacement_po_match = re.search(r"Replacement PO - (\d+[-R]*)", email_body)
+    customer_name_match = re.search(r"Delivery address:\s*([A-Za-z\s]+)", email_body)
+
+    if original_po_match and replacement_po_match:
+        po_number = replacement_po_match.group(1)
+    elif po_number_match := re.search(r"PO Number: (\d+)", email_body):
+        po_number = po_number_match.group(1)
+    else:
+        return None, None
+    customer_name = customer_name_match.group(1).strip() if customer_name_match else "Unknown"
+    return po_number, customer_name
+
+
+def create_folder_structure(email_body, config):
+    po_number, customer_name = parse_po(email_body)
+    if po_number is None:
+        return None, None
+
+    folder_path = folder_index.folder_for(po_number, customer_name, config)
+
+    return folder_path, po_number
+
+
+def _worker_pools(config):
+    return [ThreadPoolExecutor(max_workers=config['download_workers'], thread_name_prefix="Download"),
+            ThreadPoolExecutor(max_workers=config['max_concurrent_orders'], thread_name_prefix="Render")]
+
+
+@contextmanager
+def executors(config):
+    """Creates the shared IMAP, download and render executors for one run of the pipeline.
+
+    process_message() and the helpers it awaits only work inside this block. Also used by scripts.replay.
+    Yields resize(config), which replaces the download and render executors when a new snapshot changes
+    download_workers or max_concurrent_orders. Work already submitted finishes on the old ones.
+    """
+    global _imap_executor, _io_executor, _render_executor
+    previous = (_imap_executor, _io_executor, _render_executor)
+    created = [ThreadPoolExecutor(max_workers=1, thread_name_prefix="IMAP")] + _worker_pools(config)
+    sizes = [(config['download_workers'], config['max_concurrent_orders'])]
+    retired = []
+    _imap_executor, _io_executor, _render_executor = created
+
+    def resize(new_config):
+        global _imap_executor, _io_executor, _render_executor
+        new_sizes = (new_config['download_workers'], new_config['max_concurrent_orders'])
+        if new_sizes == sizes[0] or [_imap_executor, _io_executor, _render_executor] != created:
+            return
+        for executor in created[1:]:
+            executor.shutdown(wait=False)
+            retired.append(executor)
+        created[1:] = _worker_pools(new_config)
+        sizes[0] = new_sizes
+        _imap_executor, _io_executor, _render_executor = created
+
+    try:
+        yield resize
+    finally:
+        # Only this block's executors are shut down and unpublished, whatever another run installed since.
+        for executor in created + retired:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if [_imap_executor, _io_executor, _render_executor] == created:
+            _imap_executor, _io_executor, _render_executor = previous
+
+
+def process_emails():
+    """Runs the asyncio engine on the calling thread until stop() is called."""
+    global is_running, _loop, _main_task, _scheduler
+    config = config_store.get_config()
+    loop = asyncio.new_event_loop()
+    try:
+        with executors(config) as resize_executors:
+            _scheduler = PriorityScheduler(config['max_concurrent_orders'], config['priority_aging_per_minute'])
+            _loop = loop
+            task = _main_task = loop.create_task(_poll_mailbox(resize_executors))
+            if not is_running:
+                task.cancel()
+            loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        # The shared state is only reset while it is still this run's.
+        if _loop is loop:
+            _main_task = None
+            _loop = None
+            _in_flight.clear()
+            _leases.clear()
+            is_running = False
+        loop.close()
+        _notify('stopped', None)
+
+
+async def _run_in(executor, func, *args):
+    """Runs func in executor with the caller's metrics/logging context."""
+    return await asyncio.get_running_loop().run_in_executor(executor, metrics.bind(func), *args)
+
+
+async def _imap(func, *args):
+    return await _run_in(_imap_executor, func, *args)
+
+
+async def _poll_mailbox(resize_executors):
+    global mail
+    connected_settings = None
+    orders = set()
+    heartbeat = asyncio.create_task(_renew_leases())
+
+    try:
+        while is_running:
+            # One snapshot per cycle; a settings change lands on the next cycle without a restart.
+            config = config_store.get_config()
+            resize_executors(config)
+            _scheduler.resize(config['max_concurrent_orders'], config['priority_aging_per_minute'])
+            breaker = resilience.get_breaker(f"imap:{config['email']['imap_server']}")
+            try:
+                if mail is not None and config['email'] != connected_settings:
+                    update_status("Email settings changed. Reconnecting...")
+                    try:
+                        await _imap(mail.logout)
+                    except Exception:
+                        pass
+                    mail = None
+
+                if mail is None:
+                    if not breaker.allow():
+                        await _wait_for_recovery(breaker, config['email'])
+                        continue
+                    mail = await _imap(connect_to_email, config['email'])
+                    connected_settings = config['email']
+                    if mail is None:
+                        raise Exception("Failed to connect to email server.")
+                else:
+                    await _imap(mail.noop)  # Check if the connection is still alive
+
+                # Search for unseen (unread) emails
+                status, messages = await _imap(_mail_command, config, 'SEARCH', None, 'UNSEEN')
+                if breaker.state != resilience.CLOSED:
+                    update_status("Connection to the email server restored.")
+                breaker.record_success()
+                email_ids = [e_id for e_id in messages[0].split() if e_id not in _in_flight]
+                if config['coordination_db'] or leases.enabled():
+                    email_ids = await _claim(email_ids, config)
+
+                if email_ids:
+                    update_status(f"Processing {len(email_ids)} email(s)...")
+                    for e_id in email_ids:
+                        _in_flight.add(e_id)
+                        task = asyncio.create_task(_run_order(e_id, config))
+                        orders.add(task)
+                        task.add_done_callback(orders.discard)
+                elif not orders:
+                    update_status("No new emails found. Waiting for new emails...")
+
+                await asyncio.sleep(config['sleep_time'])
+
+            except Exception as e:
+                # Drop the connection whatever went wrong; the next attempt starts from a fresh login.
+                mail = None
+                metrics.inc('imap_errors')
+                breaker.record_failure()
+                delay = breaker.retry_after() or resilience.backoff_delay(breaker.failures - 1)
+                error = str(e).rstrip('.')
+                if isinstance(e, (imaplib.IMAP4.abort, imaplib.IMAP4.error)):
+                    update_status(f"Connection error: {error}. Reconnecting in {delay:.1f} s...")
+                else:
+                    update_status(f"Error processing emails: {error}. Retrying in {delay:.1f} s...")
+                if breaker.state == resilience.OPEN:
+                    await _wait_for_recovery(breaker, config['email'])
+                else:
+                    await asyncio.sleep(delay)
+
+        # Leaving normally lets queued orders finish.
+        await asyncio.gather(*orders, return_exceptions=True)
+    except asyncio.CancelledError:
+        for task in orders:
+            task.cancel()
+        await asyncio.gather(*orders, return_exceptions=True)
+        raise
+    finally:
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+
+
+def _mail_command(config, command, *args):
+    """Runs SEARCH, FETCH or STORE on the IMAP thread.
+
+    Stations sharing the mailbox use UIDs: another station's EXPUNGE renumbers the sequence numbers of this
+    session, so after claiming, a sequence number may already point to a different email.
+    """
+    if config['coordination_db']:
+        return mail.uid(command, *args)
+    return getattr(mail, command.lower())(*args)
+
+
+def _processed_id(e_id, config):
+    # UIDs and sequence numbers overlap, so UIDs are recorded apart in the processed emails file.
+    return f"uid:{e_id.decode()}" if config['coordination_db'] else e_id.decode()
+
+
+def _lease_key(config, uid):
+    return f"{config['email']['address']}@{config['email']['imap_server']}/{uid.decode()}"
+
+
+async def _claim(email_ids, config):
+    """Leases as many of email_ids, which are UIDs, as this station has room for and returns those.
+
+    While the coordination database cannot be reached nothing is leased, so a station never prints an order
+    that another station may be printing.
+    """
+    try:
+        await _run_in(_io_executor, leases.configure, config['coordination_db'], leases.station_id(config))
+    except (sqlite3.Error, OSError) as e:
+        update_status(f"Cannot open the coordination database: {e}. Not taking new orders.")
+        return []
+    if not config['coordination_db']:
+        return email_ids
+    room = config['max_concurrent_orders'] * CLAIM_AHEAD - len(_in_flight)
+    if room <= 0 or not email_ids:
+        return []
+
+    claimed = []
+    for e_id in email_ids:
+        if len(claimed) >= room:
+            break
+        key = _lease_key(config, e_id)
+        try:
+            acquired = await _run_in(_io_executor, leases.acquire, key, config['lease_seconds'])
+        except (sqlite3.Error, OSError) as e:
+            update_status(f"Coordination database unavailable: {e}. Not taking new orders.")
+            break
+        if acquired:
+            _leases[e_id] = key
+            claimed.append(e_id)
+    return claimed
+
+
+async def _renew_leases():
+    """Extends the leases of queued and running emails every third of lease_seconds while the engine runs."""
+    while True:
+        config = config_store.get_config()
+        await asyncio.sleep(config['lease_seconds'] / 3)
+        held = dict(_leases)
+        if not held:
+            continue
+        try:
+            kept = await _run_in(_io_executor, leases.renew, held.values(), config['lease_seconds'])
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Could not renew order leases: %s", e)
+            continue
+        for key in set(held.values()) - kept:
+            logger.warning("Lost the lease on %s to another station", key)
+
+
+async def _check_lease(e_id, config):
+    """Renews e_id's lease right before it is processed. Raises LeaseLost when it is no longer this station's."""
+    key = _leases.get(e_id)
+    if key is None:
+        return
+    try:
+        held = await _run_in(_io_executor, leases.renew, [key], config['lease_seconds'])
+    except (sqlite3.Error, OSError) as e:
+        raise leases.LeaseLost(f"Could not confirm the lease on email {e_id.decode()}: {e}. Leaving it for now.")
+    if not held:
+        raise leases.LeaseLost(f"Another station took over email {e_id.decode()}. Leaving it to that station.")
+
+
+async def _end_lease(key, finished):
+    """Marks the lease done once its email was processed and marked, or gives it up for another station."""
+    try:
+        await _run_in(_io_executor, leases.complete if finished else leases.release, key)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning("Could not update the lease on %s: %s", key, e)
+
+
+async def _wait_for_recovery(breaker, email_settings):
+    """Sleeps while the IMAP circuit is open, ending early once a cheap TCP probe reaches the server."""
+    port = email_settings['imap_port'] or (imaplib.IMAP4_SSL_PORT if email_settings['imap_ssl'] else imaplib.IMAP4_PORT)
+    while breaker.retry_after() > 0:
+        await asyncio.sleep(min(resilience.PROBE_INTERVAL, breaker.retry_after()))
+        if breaker.retry_after() > 0 and await _imap(resilience.is_reachable, email_settings['imap_server'], port):
+            breaker.probe_now()
+
+
+async def _run_order(e_id, config):
+    finished = False
+    try:
+        try:
+            await process_single_email(e_id, config)
+        except leases.LeaseLost as e:
+            update_status(str(e))
+            return
+        except RETRYABLE_ERRORS as e:
+            update_status(f"Email {e_id.decode()} failed with a connection error and will be retried: {e}")
+            return
+        except Exception:
+            logger.exception("Failed to process email %s", e_id.decode())
+
+        # Emails that failed on their content are marked as well; retrying them would only repeat the failure.
+        try:
+            await _imap(mark_processed, e_id, config)
+        except Exception as e:
+            update_status(f"Failed to mark email {e_id.decode()} as processed: {e}")
+        finished = True
+    finally:
+        _in_flight.discard(e_id)
+        key = _leases.pop(e_id, None)
+        if key is not None:
+            await _end_lease(key, finished)
+
+
+def mark_processed(e_id, config):
+    """Records the email locally and marks it as read on the server. Runs on the IMAP thread."""
+    save_processed_email(config['processed_emails_file'], _processed_id(e_id, config))
+    _mail_command(config, 'STORE', e_id, '+FLAGS', '\\Seen')
+    _mail_command(config, 'STORE', e_id, '+X-GM-LABELS', 'Jiffy_Orders')
+    mail.expunge()
+
+
+@metrics.timed('convert_image_to_4x6_pdf')
+def convert_image_to_4x6_pdf(img_path, output_pdf, top_margin_inch=-0.5):
+    img = Image.open(img_path)
+    width_inch = 4
+    height_inch = 6
+
+    c = canvas.Canvas(output_pdf, pagesize=(width_inch * inch, height_inch * inch))
+
+    img_width, img_height = img.size
+    dpi = img.info.get('dpi', (203, 203))
+    dpi_x, dpi_y = dpi
+
+    img_width_inch = img_width / dpi_x
+    img_height_inch = img_height / dpi_y
+
+    scale_factor_width = width_inch / img_width_inch
+    scale_factor_height = height_inch / img_height_inch
+    scale_factor = min(scale_factor_width, scale_factor_height)
+
+    new_width = img_width_inch * scale_factor * inch
+    new_height = img_height_inch * scale_factor * inch
+
+    x_offset = (width_inch * inch - new_width) / 2
+    y_offset = top_margin_inch * inch + (height_inch * inch - new_height - top_margin_inch * inch) / 2
+
+    c.drawImage(img_path, x_offset, y_offset, width=new_width, height=new_height)
+    c.save()
+
+    logger.info("Label PDF created: %s", output_pdf)
+
+
+
+def convert_html_to_letter_pdf(html_content, output_pdf):
+    width_inch = 8.5
+    height_inch = 11
+
+    c = canvas.Canvas(output_pdf, pagesize=(width_inch * inch, height_inch * inch))
+
+    soup = BeautifulSoup(html_content, 'html.parser')
+    text_content = soup.get_text()
+
+    text_margin = 1 * inch
+    text = c.beginText(text_margin, height_inch * inch - text_margin)
+    text.setFont("Helvetica", 10)
+
+    for line in text_content.split("\n"):
+        text.textLine(line)
+
+    c.drawText(text)
+    c.save()
+
+    logger.info("Email body PDF created: %s", output_pdf)
+
+
+
+def process_and_print_label(img_path, folder_path, config):
+    """Converts a label to a 4x6 PDF and prints it. Returns whether it was printed or held."""
+    try:
+        pdf_file_path = os.path.join(folder_path, "label.pdf")
+        convert_image_to_4x6_pdf(img_path, pdf_file_path)
+        return print_with_sumatra(pdf_file_path, config['attachment_printer'], "noscale")
+    except Exception:
+        logger.exception("Error processing label %s", img_path)
+        return False
+
+
+
+@metrics.timed('print_with_sumatra')
+def print_with_sumatra(file_path, printer_name, print_settings=None):
+    """Prints file_path to printer_name. Returns whether it was printed or held for a paused printer."""
+    if not printer_name:
+        logger.info("No printer configured. Not printing %s", file_path)
+        return False
+    if printer_registry.is_paused(printer_name) and _hold_job(file_path, printer_name, print_settings):
+        return True
+    if not printer_registry.is_available(printer_name):
+        # The cache may predate the printer; SumatraPDF reports a printer that is really missing.
+        logger.warning("Printer %s was not found by the last discovery. Sending %s anyway", printer_name,
+                       file_path)
+
+    try:
+        command = SUMATRA_COMMAND + ['-print-to', printer_name, '-print-settings', print_settings or "noscale", file_path]
+        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        metrics.inc('pages_printed', count_pdf_pages(file_path))
+        logger.info("Printed %s to %s", file_path, printer_name)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("SumatraPDF output: %s", result.stdout.decode(errors='replace'))
+        return True
+    except subprocess.CalledProcessError as e:
+        metrics.record_failure('print_with_sumatra')
+        logger.error("Failed to print %s to %s: %s", file_path, printer_name, e.stderr.decode(errors='replace'))
+        return False
+
+
+
+def clean_html_body(body):
+    soup = BeautifulSoup(body, 'html.parser')
+    for img in soup.find_all('img'):
+        img.decompose()
+    return str(soup)
+
+async def process_single_email(e_id, config):
+    with metrics.order_scope(), metrics.span('process_single_email'):
+        processed_emails = read_processed_emails(config['processed_emails_file'])
+        if _processed_id(e_id, config) in processed_emails:
+            return
+
+        with metrics.span('imap_fetch'):
+            status, msg_data = await _imap(_mail_command, config, 'FETCH', e_id, '(BODY.PEEK[])')
+
+        for response_part in msg_data:
+            if isinstance(response_part, tuple):
+                raw_message = response_part[1]
+                # Ranked on the default executor; the render threads may all be busy with the orders ahead.
+                msg = await _run_in(None, email.message_from_bytes, raw_message)
+                priority, label = await _run_in(None, _rank, msg, config, e_id.decode())
+                async with _scheduler.slot(priority, label):
+                    await _check_lease(e_id, config)
+                    await process_message(raw_message, config, msg=msg)
+
+        update_status("Email processing completed.")
+
+
+def _rank(msg, config, fallback_label):
+    """Returns (priority, queue label) of a fetched order. The label is its PO number when one is found."""
+    text = message_text(msg)
+    po_number, customer_name = parse_po(text)
+    return order_priority(msg, config, text=text), po_number or msg.get('Subject') or fallback_label
+
+
+async def process_message(raw_message, config, check_age=True, force=False, msg=None, record=True):
+    """Runs one raw RFC 822 order through download, render and print on the running event loop.
+
+    check_age=False accepts emails older than max_email_age_days and force=True prints the whole order even
+    when the order index has seen it (both for replays). record=False leaves the order index as it was, for
+    replays that do not print. msg is raw_message already parsed, when the caller has it. Returns the PO
+    number, or None when nothing was done.
+    """
+    if msg is None:
+        # Orders with large inline images are slow to parse; keep that off the event loop.
+        msg = await _run_in(_render_executor, email.message_from_bytes, raw_message)
+
+    email_date = parsedate_to_datetime(msg.get("Date"))
+    current_time = datetime.now(pytz.utc)
+    if check_age and current_time - email_date > timedelta(days=config['max_email_age_days']):
+        return
+
+    sender = msg.get('From')
+    if not any(allowed_sender in sender for allowed_sender in config['allowed_senders']):
+        return
+
+    if not msg.is_multipart():
+        return
+
+    order = await _run_in(_render_executor, parse_order, msg, config)
+    if order is None:
+        return
+    folder_path, po_number = order['folder_path'], order['po_number']
+
+    labels = {file_path: item_fp for payload, file_path, item_fp in order['attachments']
+              if file_path.endswith(LABEL_EXTENSIONS)}
+    plan = order_index.claim(po_number, order['fingerprint'], labels.values(), force)
+    if plan['duplicate']:
+        metrics.inc('duplicates_skipped')
+        update_status(f"PO {po_number} has nothing new to print (already printed or in progress). Skipped duplicate.")
+        return
+    _processing[po_number] = time.time()
+    try:
+        printed_body, printed_items = await _fulfil_order(order, plan, labels, config)
+    except BaseException:
+        order_index.release(plan)
+        raise
+    finally:
+        _processing.pop(po_number, None)
+    if record:
+        order_index.commit(plan, printed_body, printed_items)
+    else:
+        order_index.release(plan)
+
+    processed_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    save_log_history(po_number, processed_time, folder_path)
+    metrics.inc('emails_processed')
+    _notify('order', {'po_number': po_number, 'processed_time': processed_time, 'folder_path': folder_path})
+    return po_number
+
+
+async def _fulfil_order(order, plan, labels, config):
+    """Saves and downloads the order's files, then prints what plan says is new.
+
+    Returns whether the body printed and the set of item fingerprints that printed.
+    """
+    folder_path, body = order['folder_path'], order['body']
+    saves = [_run_in(_io_executor, save_attachment, payload, file_path)
+             for payload, file_path, item_fp in order['attachments']]
+    downloads = [_run_in(_io_executor, download_and_save_attachment, url, folder_path, filename, _cancel_event,
+                         config['download_attempts'])
+                 for url, filename in order['links']]
+
+    saved_files = await asyncio.gather(*saves, return_exceptions=True)
+    for result in saved_files:
+        if isinstance(result, Exception):
+            update_status(f"Error during attachment download: {result}")
+    for result in await asyncio.gather(*downloads, return_exceptions=True):
+        if isinstance(result, Exception):
+            update_status(f"Error during link download: {result}")
+
+    printed_body = False
+    if body and plan['print_body']:
+        body = replace_cid_images(body, order['inline_images'])
+        printed_body = await _run_in(_render_executor, process_and_print_email_body, body, folder_path, config)
+    elif body:
+        update_status(f"Order body of PO {plan['po_number']} is unchanged. Not reprinting it.")
+
+    printed_items = set()
+    for file_path in saved_files:
+        if isinstance(file_path, str) and labels.get(file_path) in plan['new_items']:
+            if await _run_in(_render_executor, process_and_print_label, file_path, folder_path, config):
+                printed_items.add(labels[file_path])
+        elif isinstance(file_path, str) and file_path in labels:
+            metrics.inc('labels_skipped')
+    return printed_body, printed_items
+
+
+@metrics.timed('parse_order')
+def parse_order(msg, config):
+    """Walks a multipart order email and creates its PO folder.
+
+    Returns a dict with po_number, folder_path, body, fingerprint (see order_index.body_fingerprint),
+    attachments [(payload, file_path, content fingerprint)], links [(url, filename)] and
+    inline_images {content_id: (content_type, payload)}, or None when no PO number is found.
+    Every part is decoded once; inline images are only written to disk when keep_render_files is set.
+    """
+    folder_path, po_number = None, None
+    body = None
+    body_text = ''
+    inline_images = {}
+    inline_payloads = []
+    attachments = []
+    links = []
+
+    for part in msg.walk():
+        content_disposition = part.get("Content-Disposition", "")
+        content_type = part.get_content_type()
+        content_id = part.get("Content-ID")
+
+        if content_type == "text/html":
+            html_body = part.get_payload(decode=True).decode()
+            text_body = BeautifulSoup(html_body, 'html.parser').get_text()
+            body_text = text_body
+            if folder_path is None:
+                folder_path, po_number = create_folder_structure(text_body, config)
+                if not folder_path:
+                    update_status("No valid PO number found in the email body.")
+                    continue
+                metrics.set_order_po(po_number)
+                update_status(f"Processing email for PO: {po_number}")
+            body = html_body
+
+        elif content_type == "text/plain" and body is None:
+            body = part.get_payload(decode=True).decode()
+            body_text = body
+            if folder_path is None:
+                folder_path, po_number = create_folder_structure(body, config)
+                if not folder_path:
+                    update_status("No valid PO number found in the email body.")
+                    continue
+                metrics.set_order_po(po_number)
+                update_status(f"Processing email for PO: {po_number}")
+
+        elif content_disposition:
+            disposition, params = cgi.parse_header(content_disposition)
+            filename = part.get_filename()
+
+            if "attachment" in disposition and filename and folder_path:
+                file_path = os.path.join(folder_path, filename)
+                payload = part.get_payload(decode=True)
+                attachments.append((payload, file_path, order_index.fingerprint(payload)))
+                if not os.path.exists(file_path):
+                    update_status(f"Downloading attachment: {filename}")
+
+            elif "inline" in disposition and content_id and folder_path:
+                payload = part.get_payload(decode=True)
+                inline_payloads.append(payload)
+                inline_images[content_id.strip('<>')] = (content_type, payload)
+                if config['keep_render_files']:
+                    filename = part.get_filename()
+                    if not filename:
+                        ext = mimetypes.guess_extension(content_type)
+                        filename = f"inline_image_{len(inline_images) - 1}{ext}"
+                    with open(os.path.join(folder_path, filename), 'wb') as f:
+                        f.write(payload)
+
+    if not folder_path:
+        return None
+
+    soup = BeautifulSoup(body, 'html.parser') if body else None
+    if soup:
+        for link in soup.find_all('a', href=True):
+            url = link['href']
+            if "filename=" in url:
+                parsed_url = urlparse(url)
+                query_params = parse_qs(parsed_url.query)
+                if 'filename' in query_params:
+                    filename = query_params['filename'][0]
+                else:
+                    filename = os.path.basename(parsed_url.path)
+                links.append((url, filename))
+                update_status(f"Queuing external download for: {filename}")
+
+    return {'po_number': po_number, 'folder_path': folder_path, 'body': body,
+            'fingerprint': order_index.body_fingerprint(body_text, inline_payloads) if body else None,
+            'attachments': attachments, 'links': links, 'inline_images': inline_images}
+
+
+def replace_cid_images(html_body, inline_images):
+    """Points cid: image sources at data URIs built from the decoded parts, so the renderer needs no image files."""
+    def data_uri(match):
+        image = inline_images.get(match.group(2))
+        if image is None:
+            return match.group(0)
+        content_type, payload = image
+        encoded = base64.b64encode(payload).decode('ascii')
+        return f"{match.group(1)}data:{content_type};base64,{encoded}{match.group(3)}"
+
+    return _CID_SRC.sub(data_uri, html_body)
+
+
+@metrics.timed('process_and_print_email_body')
+def process_and_print_email_body(email_body, folder_path, config):
+    """Renders the order body to email_body.pdf and prints it. Returns whether it was printed or held."""
+    try:
+        if config['keep_render_files']:
+            html_file_path = os.path.join(folder_path, "email_body.html")
+            with open(html_file_path, 'w', encoding='utf-8') as f:
+                f.write(email_body)
+            logger.debug("HTML body written to %s", html_file_path)
+
+        pdf_file_path = os.path.join(folder_path, "email_body.pdf")
+        if convert_html_to_pdf(email_body, pdf_file_path):
+            return print_with_sumatra(pdf_file_path, config['body_printer'], "fit")
+        logger.error("Failed to convert email body to PDF for printing: %s", pdf_file_path)
+    except Exception:
+        logger.exception("Error processing email body in %s", folder_path)
+    return False
+
+
+@metrics.timed('convert_html_to_pdf')
+def convert_html_to_pdf(html, pdf_file_path):
+    """
+    Converts an HTML string to PDF using wkhtmltopdf, passing it on stdin instead of through a file.
+    """
+    try:
+        
+        if not os.path.exists(WKHTMLTOPDF_COMMAND[0]):
+            logger.error("wkhtmltopdf executable not found at %s", WKHTMLTOPDF_COMMAND[0])
+            return False
+
+        command = WKHTMLTOPDF_COMMAND + [
+            '--page-size', 'Letter',
+            '--enable-smart-shrinking',
+            '--no-outline',
+            '--print-media-type',
+            '--dpi', '300',
+            '--enable-local-file-access',
+            '-',
+            pdf_file_path
+        ]
+
+        logger.debug("Executing wkhtmltopdf: %s", command)
+        result = subprocess.run(command, input=html.encode('utf-8'), check=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+        # Decoding the tool output is only worth it when someone is going to read it.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("wkhtmltopdf output: %s", result.stdout.decode(errors='replace'))
+            logger.debug("wkhtmltopdf errors: %s", result.stderr.decode(errors='replace'))
+
+        logger.info("Converted HTML to PDF: %s", pdf_file_path)
+        return True
+    except subprocess.CalledProcessError as e:
+        metrics.record_failure('convert_html_to_pdf')
+        logger.error("Failed to convert HTML to PDF (exit code %s): %s", e.returncode, e.stderr.decode(errors='replace'))
+        return False
+    except Exception:
+        metrics.record_failure('convert_html_to_pdf')
+        logger.exception("Unexpected error during PDF conversion to %s", pdf_file_path)
+        return False
+
+
+def _has_content(file_path, payload):
+    """Whether file_path exists and holds exactly payload."""
+    try:
+        if os.path.getsize(file_path) != len(payload):
+            return False
+    except OSError:
+        return False
+    return _file_fingerprint(file_path) == order_index.fingerprint(payload)
+
+
+def save_attachment(payload, file_path):
+    """Saves payload to file_path and returns the path, or None on failure.
+
+    An existing file is only kept when it holds the same bytes, so a corrected attachment that reuses the
+    file name replaces the stale one. The payload is written to a temp file and renamed into place, so a
+    failed write never leaves a truncated file behind.
+    """
+    try:
+        if _has_content(file_path, payload):
+            return file_path
+        attachment_folder = os.path.dirname(file_path)
+        os.makedirs(attachment_folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=attachment_folder, prefix='.attachment-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        update_status(f"Downloaded attachment to {file_path}")
+        return file_path
+    except Exception as e:
+        update_status(f"Failed to save attachment {file_path}. Error: {e}")
+        return None
+
+
@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from datetime import datetime
+
+from scripts import config_store
+
+
+# Append-only JSON lines file kept in the attachments folder, mapping PO numbers to folders relative to it.
+INDEX_NAME = 'folder_index.jsonl'
+# Month shards, e.g. attachments/2024-05/123456_John Smith.
+SHARD_PATTERN = re.compile(r'^\d{4}-\d{2}$')
+_PO_FOLDER = re.compile(r'^(\d+(?:-R)*)_(.*)$')
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# {attachments folder: {po_number: relative path}}, loaded once per folder.
+_indexes = {}
+
+
+def _root(config):
+    return (config or config_store.get_config())['attachments_folder']
+
+
+def _load(root):
+    index = _indexes.get(root)
+    if index is not None:
+        return index
+    index = _indexes[root] = {}
+    path = os.path.join(root, INDEX_NAME)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    index[entry['po']] = entry['path']
+                except (ValueError, KeyError):
+                    logger.warning("Skipping corrupt folder index line: %r", line[:80])
+    return index
+
+
+def _append(root, entries):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, INDEX_NAME), 'a', encoding='utf-8') as f:
+        for po_number, relative in entries:
+            f.write(json.dumps({'po': po_number, 'path': relative}) + '\n')
+
+
+def shard_for(when=None):
+    """Returns the shard directory name for a folder created at when (default now)."""
+    return (when or datetime.now()).strftime('%Y-%m')
+
+
+def lookup(po_number, config=None):
+    """Returns the folder of po_number, or None when the PO has no folder yet. O(1) after the first call."""
+    root = _root(config)
+    with _lock:
+        relative = _load(root).get(po_number)
+    return os.path.join(root, relative) if relative else None
+
+
+def resolve(po_number, fallback_path, config=None):
+    """Returns the indexed folder of po_number, or fallback_path (e.g. the path in an old history line)."""
+    return lookup(po_number, config) or fallback_path
+
+
+def folder_for(po_number, customer_name, config=None, when=None):
+    """Returns the folder of po_number, creating it in the current month's shard on first use.
+
+    Every order email for the same PO lands in the same folder, whichever month it arrives in.
+    """
+    root = _root(config)
+    with _lock:
+        index = _load(root)
+        relative = index.get(po_number)
+        if relative is None:
+            relative = os.path.join(shard_for(when), f"{po_number}_{customer_name}")
+            index[po_number] = relative
+            _append(root, [(po_number, relative)])
+    folder_path = os.path.join(root, relative)
+    os.makedirs(folder_path, exist_ok=True)
+    return folder_path
+
+
+def migrate(config=None, dry_run=False):
+    """Moves flat PO folders into month shards by their last change and indexes them.
+
+    Folders already in a shard are indexed in place. Returns a list of (old path, new path) moves.
+    """
+    root = _root(config)
+    moves, entries = [], []
+    if not os.path.isdir(root):
+        return moves
+    with _lock:
+        index = _load(root)
+        with os.scandir(root) as children:
+            children = sorted((entry.name, entry.path) for entry in children if entry.is_dir())
+        for name, path in children:
+            if SHARD_PATTERN.match(name):
+                for folder in sorted(os.listdir(path)):
+                    match = _PO_FOLDER.match(folder)
+                    if match and index.get(match.group(1)) != os.path.join(name, folder):
+                        entries.append((match.group(1), os.path.join(name, folder)))
+                continue
+            match = _PO_FOLDER.match(name)
+            if not match:
+                continue
+            relative = os.path.join(shard_for(datetime.fromtimestamp(os.stat(path).st_mtime)), name)
+            target = os.path.join(root, relative)
+            if os.path.exists(target):
+                logger.warning("Not migrating %s: %s already exists", path, target)
+                continue
+            moves.append((path, target))
+            entries.append((match.group(1), relative))
+            if not dry_run:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(path, target)
+        if not dry_run and entries:
+            index.update(entries)
+            _append(root, entries)
+    return moves
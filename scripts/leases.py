@@ -0,0 +1,158 @@
+"""Order leases shared by stations that poll the same mailbox.
+
+A station processes an email only while it holds the email's lease in a SQLite database on a share every
+station can reach. Leases expire unless renewed, so the orders of a station that crashed or lost the
+network are picked up by the others after lease_seconds. Finished emails stay marked as done for
+DONE_RETENTION_SECONDS, which covers stations whose UNSEEN search ran before the email was marked as read.
+
+Every call blocks on the database file; the engine runs them on its download threads.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from scripts import metrics
+
+
+# Seconds a station waits for another station's write lock before the call fails with sqlite3.OperationalError.
+LOCK_TIMEOUT = 10
+DONE_RETENTION_SECONDS = 24 * 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    station TEXT NOT NULL,
+    expires REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 1
+)
+"""
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_connection = None
+_path = None
+_station = None
+
+
+class LeaseLost(metrics.NotAFailure):
+    """Raised when another station took over an order's lease before it was printed."""
+
+
+def station_id(config):
+    """The configured station_id, or host name and process id so that two processes never share leases."""
+    return config['station_id'] or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def configure(path, station):
+    """Opens the lease database at path for station, or closes it when path is empty. Idempotent."""
+    global _connection, _path, _station
+    with _lock:
+        if (path, station) == (_path, _station):
+            return
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+        _path, _station = path, station
+        if not path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Autocommit mode, so each call runs its own BEGIN IMMEDIATE transaction.
+        connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None, check_same_thread=False)
+        connection.execute(_SCHEMA)
+        _connection = connection
+    logger.info("Sharing orders through %s as station %s", path, station)
+
+
+def enabled():
+    return _connection is not None
+
+
+def current_station():
+    return _station
+
+
+def _transaction(work):
+    """Runs work(connection, now) in one write transaction, so stations see each other's claims atomically."""
+    with _lock:
+        if _connection is None:
+            raise RuntimeError("No lease database is configured.")
+        _connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = work(_connection, time.time())
+        except BaseException:
+            _connection.execute('ROLLBACK')
+            raise
+        _connection.execute('COMMIT')
+        return result
+
+
+def acquire(key, seconds):
+    """Leases key for seconds. Returns False while another station holds it or has finished it.
+
+    An expired lease of another station is taken over; the order is then processed again from the start.
+    """
+    def work(connection, now):
+        row = connection.execute('SELECT station, expires, done FROM leases WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            connection.execute('INSERT INTO leases (key, station, expires) VALUES (?, ?, ?)',
+                               (key, _station, now + seconds))
+            return True
+        station, expires, done = row
+        if station != _station and (done or expires > now):
+            return False
+        if station != _station:
+            logger.warning("Taking over %s from station %s, whose lease expired", key, station)
+        connection.execute('UPDATE leases SET station = ?, expires = ?, attempts = attempts + ? WHERE key = ?',
+                           (_station, now + seconds, int(station != _station), key))
+        return True
+
+    return _transaction(work)
+
+
+def renew(keys, seconds):
+    """Extends this station's leases on keys and returns the keys it still holds."""
+    keys = list(keys)
+
+    def work(connection, now):
+        held = set()
+        for key in keys:
+            cursor = connection.execute('UPDATE leases SET expires = ? WHERE key = ? AND station = ? AND done = 0',
+                                        (now + seconds, key, _station))
+            if cursor.rowcount:
+                held.add(key)
+        return held
+
+    return _transaction(work) if keys else set()
+
+
+def complete(key):
+    """Marks key as done, so no station processes it again, and forgets long finished leases."""
+    def work(connection, now):
+        connection.execute('UPDATE leases SET done = 1, expires = ? WHERE key = ? AND station = ?',
+                           (now, key, _station))
+        connection.execute('DELETE FROM leases WHERE done = 1 AND expires < ?', (now - DONE_RETENTION_SECONDS,))
+
+    _transaction(work)
+
+
+def release(key):
+    """Gives up an unfinished lease, so another station can take the order at once instead of after expiry."""
+    _transaction(lambda connection, now: connection.execute(
+        'DELETE FROM leases WHERE key = ? AND station = ? AND done = 0', (key, _station)))
+
+
+def active():
+    """Returns the unfinished leases of every station as dicts of key, station, expires_in and attempts."""
+    with _lock:
+        if _connection is None:
+            return []
+        rows = _connection.execute(
+            'SELECT key, station, expires, attempts FROM leases WHERE done = 0 ORDER BY key').fetchall()
+    now = time.time()
+    return [{'key': key, 'station': station, 'expires_in': round(expires - now, 1), 'attempts': attempts}
+            for key, station, expires, attempts in rows]
@@ -0,0 +1,90 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+from scripts import metrics
+
+
+LOG_FILE_NAME = 'processor.log'
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line. The PO of the current order is included when known."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'po': getattr(record, 'po', None),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class OrderQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue without formatting them.
+
+    The stock QueueHandler formats the message on the calling thread. Here the calling thread only tags
+    the record with the current PO; formatting and I/O happen on the listener thread.
+    """
+
+    def prepare(self, record):
+        record.po = metrics.current_po()
+        return record
+
+
+def setup_logging(level='INFO', log_dir='logs', max_bytes=5 * 1024 * 1024, backup_count=5):
+    """Routes all logging through a queue to a rotating JSON log file and, when one exists, the console.
+
+    Safe to call again; the previous listener is stopped and its handlers are closed.
+    """
+    global _listener
+    shutdown_logging()
+
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, LOG_FILE_NAME), maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+
+    # The windowed PyInstaller build has no console and sys.stderr is None there.
+    if sys.stderr is not None:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(po)s %(message)s'))
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, OrderQueueHandler):
+            root_logger.removeHandler(handler)
+    root_logger.addHandler(OrderQueueHandler(log_queue))
+    set_level(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def set_level(level):
+    """Changes the level of every logger that does not set its own. Accepts names such as 'DEBUG'."""
+    logging.getLogger().setLevel(level.upper() if isinstance(level, str) else level)
+
+
+def shutdown_logging():
+    """Flushes queued records and closes the log file."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,286 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Number of most recent samples per stage used for the percentiles shown in the GUI.
+HISTOGRAM_WINDOW = 500
+# Upper bounds (seconds) of the cumulative buckets exported on /metrics.
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Number of finished orders whose per-stage timings are kept for inspection.
+RECENT_ORDERS = 200
+
+_lock = threading.Lock()
+_samples = {}
+_buckets = {}
+_totals = {}
+_counters = {}
+_processed_times = deque()
+_recent_orders = OrderedDict()
+# {stage: [calls, net bytes]}, recorded while tracemalloc is tracing.
+_allocations = {}
+_current_order = contextvars.ContextVar('current_order', default=None)
+_server = None
+
+
+class NotAFailure(Exception):
+    """Base of exceptions that end a span without counting as a failure, e.g. leases.LeaseLost."""
+
+
+def inc(name, amount=1):
+    """Adds amount to a counter. Counters are exported as moretranz_<name>_total."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+        if name == 'emails_processed':
+            _processed_times.append(time.monotonic())
+
+
+def observe(stage, seconds):
+    """Records one duration for a stage, and against the current order if one is active."""
+    with _lock:
+        if stage not in _samples:
+            _samples[stage] = deque(maxlen=HISTOGRAM_WINDOW)
+            _buckets[stage] = [0] * (len(BUCKETS) + 1)
+            _totals[stage] = [0, 0.0]
+        _samples[stage].append(seconds)
+        _buckets[stage][bisect.bisect_left(BUCKETS, seconds)] += 1
+        _totals[stage][0] += 1
+        _totals[stage][1] += seconds
+
+    order = _current_order.get()
+    if order is not None:
+        with _lock:
+            order['stages'][stage] = order['stages'].get(stage, 0.0) + seconds
+
+
+def record_failure(stage):
+    """Counts a failure of stage. The failures total counts an order once, however many of its stages fail."""
+    inc(f'{stage}_failures')
+    order = _current_order.get()
+    if order is None:
+        inc('failures')
+    else:
+        order['failed'] = True
+
+
+def _record_allocation(stage, net_bytes):
+    with _lock:
+        allocation = _allocations.setdefault(stage, [0, 0])
+        allocation[0] += 1
+        allocation[1] += net_bytes
+
+
+@contextmanager
+def span(stage):
+    """Times the enclosed block as one sample of stage. Exceptions are counted as <stage> failures.
+
+    Cancellation and NotAFailure, such as a lease lost to another station, end the block without counting as
+    failures.
+
+    While tracemalloc is tracing, the change in traced memory over the block is added to the stage's
+    allocation counters as well (see stage_allocations()).
+    """
+    tracing = tracemalloc.is_tracing()
+    allocated = tracemalloc.get_traced_memory()[0] if tracing else 0
+    start = time.perf_counter()
+    try:
+        yield
+    except NotAFailure:
+        raise
+    except Exception:
+        record_failure(stage)
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+        if tracing and tracemalloc.is_tracing():
+            _record_allocation(stage, tracemalloc.get_traced_memory()[0] - allocated)
+
+
+def timed(stage):
+    """Decorator form of span()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def order_scope():
+    """Collects the stage timings of one email. Use bind() to carry the scope into executor threads."""
+    order = {'po': None, 'stages': {}, 'started': time.time(), 'failed': False}
+    token = _current_order.set(order)
+    try:
+        yield order
+    finally:
+        _current_order.reset(token)
+        if order['failed']:
+            inc('failures')
+        if order['po']:
+            with _lock:
+                _recent_orders[order['po']] = order
+                _recent_orders.move_to_end(order['po'])
+                while len(_recent_orders) > RECENT_ORDERS:
+                    _recent_orders.popitem(last=False)
+
+
+def set_order_po(po_number):
+    order = _current_order.get()
+    if order is not None:
+        order['po'] = po_number
+
+
+def current_po():
+    order = _current_order.get()
+    return order['po'] if order is not None else None
+
+
+def bind(func):
+    """Returns func wrapped to run in a copy of the caller's context, so its spans land on the caller's order."""
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def get_order_timings(po_number):
+    with _lock:
+        order = _recent_orders.get(po_number)
+        return dict(order['stages']) if order else None
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def emails_per_minute():
+    cutoff = time.monotonic() - 60
+    with _lock:
+        while _processed_times and _processed_times[0] < cutoff:
+            _processed_times.popleft()
+        return len(_processed_times)
+
+
+def stage_summary():
+    """Returns {stage: {'count', 'p50', 'p90', 'p99', 'max'}} over the rolling window, in seconds."""
+    with _lock:
+        samples = {stage: sorted(values) for stage, values in _samples.items()}
+        totals = {stage: total[0] for stage, total in _totals.items()}
+    return {
+        stage: {
+            'count': totals[stage],
+            'p50': _percentile(values, 0.50),
+            'p90': _percentile(values, 0.90),
+            'p99': _percentile(values, 0.99),
+            'max': values[-1] if values else 0.0,
+        }
+        for stage, values in samples.items()
+    }
+
+
+def rolling_histogram(stage):
+    """Returns [(upper_bound, count)] for the samples of stage in the rolling window. The last bound is inf."""
+    with _lock:
+        values = list(_samples.get(stage, ()))
+    counts = [0] * (len(BUCKETS) + 1)
+    for value in values:
+        counts[bisect.bisect_left(BUCKETS, value)] += 1
+    return list(zip(BUCKETS + (float('inf'),), counts))
+
+
+def stage_allocations():
+    """Returns {stage: {'calls', 'net_bytes', 'net_bytes_per_call'}} collected while tracemalloc was tracing.
+
+    net_bytes is what a stage left allocated when it returned: memory it holds on to, or that other threads
+    allocated meanwhile. Averaged over many calls, a stage that steadily keeps memory stands out.
+    """
+    with _lock:
+        return {stage: {'calls': calls, 'net_bytes': net, 'net_bytes_per_call': net / calls if calls else 0.0}
+                for stage, (calls, net) in _allocations.items()}
+
+
+def reset_stage_allocations():
+    with _lock:
+        _allocations.clear()
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def render_prometheus():
+    """Renders every counter and stage histogram in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counter_items = sorted(_counters.items())
+        histograms = {stage: (list(_buckets[stage]), list(_totals[stage])) for stage in sorted(_buckets)}
+        allocations = sorted((stage, list(allocation)) for stage, allocation in _allocations.items())
+
+    for name, value in counter_items:
+        lines.append(f"# TYPE moretranz_{name}_total counter")
+        lines.append(f"moretranz_{name}_total {value}")
+
+    lines.append("# TYPE moretranz_emails_per_minute gauge")
+    lines.append(f"moretranz_emails_per_minute {emails_per_minute()}")
+
+    lines.append("# TYPE moretranz_stage_duration_seconds histogram")
+    for stage, (buckets, (count, total)) in histograms.items():
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + (float('inf'),), buckets):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'moretranz_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'moretranz_stage_duration_seconds_sum{{stage="{stage}"}} {total}')
+        lines.append(f'moretranz_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+
+    if allocations:
+        lines.append("# TYPE moretranz_stage_net_allocated_bytes gauge")
+        for stage, (calls, net) in allocations:
+            lines.append(f'moretranz_stage_net_allocated_bytes{{stage="{stage}"}} {net}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """Serves /metrics on a daemon thread. A running server on another port is replaced; port 0 stops it."""
+    global _server
+    if _server is not None:
+        if _server.server_address[1] == port:
+            return
+        stop_http_server()
+    if not port:
+        return
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="MetricsServer", daemon=True).start()
+
+
+def stop_http_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
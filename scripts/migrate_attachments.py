@@ -0,0 +1,30 @@
+"""Moves PO folders from the flat attachments layout into month shards and indexes them.
+
+    python -m scripts.migrate_attachments --dry-run
+    python -m scripts.migrate_attachments
+
+Run it with the processor stopped. Folders are placed in the shard of the month they were last changed in.
+"""
+import argparse
+import sys
+
+from scripts import config_store
+from scripts import folder_index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help="Only print the moves that would be made.")
+    parser.add_argument('--config', default=config_store.CONFIG_PATH, help="Configuration file to read.")
+    args = parser.parse_args(argv)
+
+    config = config_store.load_config(args.config)
+    moves = folder_index.migrate(config, dry_run=args.dry_run)
+    for source, target in moves:
+        print(f"{source} -> {target}")
+    print(f"{'Would move' if args.dry_run else 'Moved'} {len(moves)} folder(s) in {config['attachments_folder']}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+
+
+# Append-only JSON lines file; replayed into memory on first use so every lookup is a dict access.
+INDEX_PATH = 'logs/order_index.jsonl'
+
+# Header lines that differ between an original order and its re-sends or replacements.
+_PO_HEADER = re.compile(r"(PO Number:|Original PO -|Replacement PO -)[^\n]*", re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_index = None
+
+
+def fingerprint(data):
+    """Returns the SHA-256 hex digest of bytes or str."""
+    return hashlib.sha256(data.encode() if isinstance(data, str) else data).hexdigest()
+
+
+def body_fingerprint(text, inline_images=()):
+    """Fingerprints an order body by its text and inline images, ignoring PO header lines and whitespace.
+
+    inline_images is an iterable of image bytes. Re-sends and replacements of an unchanged order therefore
+    get the same fingerprint as the original.
+    """
+    normalized = ' '.join(_PO_HEADER.sub('', text).split())
+    digest = hashlib.sha256(normalized.encode())
+    for image in sorted(fingerprint(image) for image in inline_images):
+        digest.update(image.encode())
+    return digest.hexdigest()
+
+
+def group_key(po_number):
+    """Replacement POs ("123-R") share the entry of their original PO ("123")."""
+    return po_number.rstrip('-R') or po_number
+
+
+def _load():
+    global _index
+    if _index is not None:
+        return _index
+    _index = {}
+    if os.path.exists(INDEX_PATH):
+        with open(INDEX_PATH, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    group = _index.setdefault(entry['group'], {'bodies': set(), 'items': set()})
+                except (ValueError, KeyError):
+                    logger.warning("Skipping corrupt order index line: %r", line[:80])
+                    continue
+                group['bodies'].update(entry.get('bodies', ()))
+                group['items'].update(entry.get('items', ()))
+    return _index
+
+
+def claim(po_number, body_fp, item_fps, force=False):
+    """Decides what an order still needs and reserves it, so a concurrent copy of the order does not print it too.
+
+    item_fps are the fingerprints of the printable attachments. Returns a plan dict with group, po_number,
+    duplicate (nothing new at all), print_body and new_items (the set of item fingerprints to print).
+    force plans the whole order regardless of the index. Pass the plan to commit() with what printed, or to
+    release() when the order failed.
+    """
+    group_id = group_key(po_number)
+    with _lock:
+        group = _load().setdefault(group_id, {'bodies': set(), 'items': set()})
+        print_body = body_fp is not None and (force or body_fp not in group['bodies'])
+        new_items = set(item_fps) if force else set(item_fps) - group['items']
+        # Only what was not in the index before is reserved, so release() never forgets earlier prints.
+        reserved_body = print_body and body_fp not in group['bodies']
+        reserved_items = new_items - group['items']
+        if print_body:
+            group['bodies'].add(body_fp)
+        group['items'].update(new_items)
+    return {'group': group_id, 'po_number': po_number, 'duplicate': not print_body and not new_items,
+            'print_body': print_body, 'body': body_fp if print_body else None, 'new_items': new_items,
+            'reserved_body': reserved_body, 'reserved_items': reserved_items}
+
+
+def printed_items(po_number):
+    """Returns the fingerprints of every label printed for po_number or its replacements."""
+    with _lock:
+        group = _load().get(group_key(po_number))
+        return set(group['items']) if group else set()
+
+
+def commit(plan, printed_body=True, printed_items=None):
+    """Persists what a claimed plan printed and releases the rest of it.
+
+    printed_body says whether the body printed and printed_items are the item fingerprints that printed
+    (default: all of new_items). Whatever did not print is released, so a re-send of the order prints it.
+    """
+    body = plan['body'] if printed_body else None
+    items = plan['new_items'] if printed_items is None else plan['new_items'] & set(printed_items)
+    release({**plan, 'reserved_body': plan['reserved_body'] and not body,
+             'reserved_items': plan['reserved_items'] - items})
+    if not body and not items:
+        return
+    entry = {'group': plan['group'], 'po': plan['po_number'], 'time': datetime.now().isoformat(timespec='seconds'),
+             'bodies': [body] if body else [], 'items': sorted(items)}
+    with _lock:
+        os.makedirs(os.path.dirname(INDEX_PATH) or '.', exist_ok=True)
+        with open(INDEX_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+def release(plan):
+    """Drops the reservation of a plan that was not printed, so a re-send of the order prints it."""
+    with _lock:
+        group = _load().get(plan['group'])
+        if group is None:
+            return
+        if plan['reserved_body']:
+            group['bodies'].discard(plan['body'])
+        group['items'].difference_update(plan['reserved_items'])
+
@@ -0,0 +1,200 @@
+import logging
+import platform
+import subprocess
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# How long a discovery result is trusted before a background refresh is started.
+PRINTER_CACHE_TTL = 300
+
+_lock = threading.Lock()
+_printers = {}
+_last_refresh = 0.0
+_refresh_thread = None
+_listeners = []
+# {printer name: [(file_path, print_settings)]} for paused printers, with the jobs held until they resume.
+_paused = {}
+
+
+def _run(command):
+    """Returns the output of command. A failed query raises, so the refresh keeps the previous cache."""
+    return subprocess.run(command, capture_output=True, text=True, timeout=30, check=True).stdout
+
+
+def _discover_windows():
+    printers = {}
+    output = _run(['wmic', 'printer', 'get', 'Name,HorizontalResolution,VerticalResolution,PrinterPaperNames',
+                   '/format:csv'])
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    if not lines:
+        return printers
+
+    header = [column.strip() for column in lines[0].split(',')]
+    for line in lines[1:]:
+        # PrinterPaperNames is rendered as "{Letter;A4;...}" and never contains commas.
+        row = dict(zip(header, (value.strip() for value in line.split(','))))
+        name = row.get('Name')
+        if not name:
+            continue
+        dpi = row.get('HorizontalResolution') or row.get('VerticalResolution')
+        printers[name] = {
+            'paper_sizes': [size for size in row.get('PrinterPaperNames', '').strip('{}').split(';') if size],
+            'dpi': [int(dpi)] if dpi and dpi.isdigit() else [],
+        }
+    return printers
+
+
+def _parse_lpoptions(output):
+    """Returns the choices of the PageSize and Resolution options reported by lpoptions -l."""
+    capabilities = {'paper_sizes': [], 'dpi': []}
+    for line in output.splitlines():
+        option, _, choices = line.partition(':')
+        key = option.split('/')[0].strip()
+        values = [choice.lstrip('*') for choice in choices.split()]
+        if key == 'PageSize':
+            capabilities['paper_sizes'] = values
+        elif key == 'Resolution':
+            # Choices look like "300dpi" or "600x600dpi".
+            for value in values:
+                horizontal = value.lower().removesuffix('dpi').split('x')[0]
+                if horizontal.isdigit():
+                    capabilities['dpi'].append(int(horizontal))
+    return capabilities
+
+
+def _discover_linux():
+    printers = {}
+    output = _run(['lpstat', '-p'])
+    for line in output.splitlines():
+        if line.startswith('printer'):
+            name = line.split()[1]
+            try:
+                printers[name] = _parse_lpoptions(_run(['lpoptions', '-p', name, '-l']))
+            except Exception:
+                printers[name] = {'paper_sizes': [], 'dpi': []}
+    return printers
+
+
+def discover_printers():
+    """Queries the OS for installed printers and their capabilities. Blocks for the duration of the query."""
+    system = platform.system()
+    if system == "Windows":
+        return _discover_windows()
+    if system == "Linux":
+        return _discover_linux()
+    raise OSError(f"Unsupported OS for printer discovery: {system}")
+
+
+def add_listener(callback):
+    """Registers callback(added, removed, error) to run after every background refresh.
+
+    The callback runs on the refresh thread; GUI code must marshal back to the Tk thread itself.
+    """
+    _listeners.append(callback)
+
+
+def _notify(added, removed, error=None):
+    for callback in list(_listeners):
+        try:
+            callback(added, removed, error)
+        except Exception:
+            logger.exception("Printer listener failed")
+
+
+def _refresh():
+    global _printers, _last_refresh, _refresh_thread
+    error = None
+    try:
+        discovered = discover_printers()
+    except Exception as e:
+        discovered = None
+        error = e
+
+    with _lock:
+        _refresh_thread = None
+        if discovered is None:
+            added, removed = [], []
+        else:
+            added = sorted(set(discovered) - set(_printers))
+            removed = sorted(set(_printers) - set(discovered))
+            _printers = discovered
+            _last_refresh = time.monotonic()
+
+    _notify(added, removed, error)
+
+
+def refresh_printers():
+    """Starts a background discovery unless one is already in flight. Never blocks the caller."""
+    global _refresh_thread
+    with _lock:
+        if _refresh_thread is not None:
+            return
+        _refresh_thread = threading.Thread(target=_refresh, name="PrinterDiscovery", daemon=True)
+        _refresh_thread.start()
+
+
+def get_printers():
+    """Returns the cached printer names, scheduling a background refresh when the cache is stale."""
+    with _lock:
+        names = sorted(_printers)
+        stale = time.monotonic() - _last_refresh > PRINTER_CACHE_TTL
+    if stale:
+        refresh_printers()
+    return names
+
+
+def get_capabilities(printer_name):
+    """Returns the cached {'paper_sizes': [...], 'dpi': [...]} of a printer, or None if it is unknown."""
+    with _lock:
+        capabilities = _printers.get(printer_name)
+        return dict(capabilities) if capabilities is not None else None
+
+
+def is_available(printer_name):
+    """True if the printer was present at the last discovery.
+
+    Also True while discovery has found no printers at all, whether it has not completed yet or the query
+    came back empty, as printing must not stop on a broken discovery. A stale cache, or one without the
+    printer, which may have been installed since, starts a background refresh.
+    """
+    with _lock:
+        known = not _printers or printer_name in _printers
+        stale = time.monotonic() - _last_refresh > PRINTER_CACHE_TTL
+    if stale or not known:
+        refresh_printers()
+    return known
+
+
+def pause(printer_name):
+    """Holds every job sent to printer_name from now on until resume() is called."""
+    with _lock:
+        _paused.setdefault(printer_name, [])
+
+
+def resume(printer_name):
+    """Stops holding jobs for printer_name and returns the held (file_path, print_settings) jobs, oldest first."""
+    with _lock:
+        return _paused.pop(printer_name, [])
+
+
+def hold(printer_name, job):
+    """Adds job to the held jobs of printer_name. Returns False, holding nothing, when it is not paused."""
+    with _lock:
+        if printer_name not in _paused:
+            return False
+        _paused[printer_name].append(job)
+        return True
+
+
+def is_paused(printer_name):
+    with _lock:
+        return printer_name in _paused
+
+
+def paused_printers():
+    """Returns {printer name: number of held jobs} for every paused printer."""
+    with _lock:
+        return {name: len(jobs) for name, jobs in _paused.items()}
@@ -0,0 +1,189 @@
+import linecache
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+from scripts import metrics
+
+
+# Heap snapshots and sampled stacks are written here.
+PROFILES_FOLDER = 'logs/profiles'
+# Allocation sites shown by heap_snapshot().
+TOP_ALLOCATIONS = 20
+SAMPLE_INTERVAL = 0.005
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_last_snapshot = None
+_sampler = None
+_sampler_stop = threading.Event()
+_samples = Counter()
+
+
+def _path(prefix, suffix):
+    os.makedirs(PROFILES_FOLDER, exist_ok=True)
+    return os.path.join(PROFILES_FOLDER, f"{prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}{suffix}")
+
+
+def start_tracing(frames=10):
+    """Starts tracemalloc with tracebacks of up to frames frames. Costs CPU and memory on every allocation."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        logger.info("tracemalloc started with %d frames", frames)
+
+
+def stop_tracing():
+    global _last_snapshot
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+        logger.info("tracemalloc stopped")
+    with _lock:
+        _last_snapshot = None
+
+
+def _site(statistic):
+    frame = statistic.traceback[0]
+    return f"{frame.filename}:{frame.lineno} {linecache.getline(frame.filename, frame.lineno).strip()}"
+
+
+def heap_snapshot(limit=TOP_ALLOCATIONS, save=True):
+    """Takes a tracemalloc snapshot and returns the largest allocation sites and the growth since the last call.
+
+    The snapshot is also dumped to PROFILES_FOLDER for tracemalloc.Snapshot.load(). Requires start_tracing().
+    """
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("tracemalloc is not tracing. Start it first.")
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    with _lock:
+        previous, _last_snapshot = _last_snapshot, snapshot
+    result = {
+        'traced_bytes': current,
+        'peak_bytes': peak,
+        'top': [{'site': _site(stat), 'bytes': stat.size, 'blocks': stat.count}
+                for stat in snapshot.statistics('lineno')[:limit]],
+        'growth': [{'site': _site(stat), 'bytes': stat.size_diff, 'blocks': stat.count_diff}
+                   for stat in snapshot.compare_to(previous, 'lineno')[:limit] if stat.size_diff > 0]
+                  if previous is not None else [],
+        'path': None,
+    }
+    if save:
+        result['path'] = _path('heap', '.tracemalloc')
+        snapshot.dump(result['path'])
+    return result
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+
+
+def _sample(interval):
+    names = {}
+    own = threading.get_ident()
+    while not _sampler_stop.wait(interval):
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            with _lock:
+                _samples[';'.join(reversed(stack))] += 1
+
+
+def start_sampling(interval=SAMPLE_INTERVAL):
+    """Samples the stacks of every thread every interval seconds until stop_sampling().
+
+    Unlike cProfile this covers the executor threads and does not slow down each call.
+    """
+    global _sampler
+    if _sampler is not None and _sampler.is_alive():
+        return
+    with _lock:
+        _samples.clear()
+    _sampler_stop.clear()
+    _sampler = threading.Thread(target=_sample, args=(interval,), name="Sampler", daemon=True)
+    _sampler.start()
+    logger.info("Stack sampling started every %.1f ms", interval * 1000)
+
+
+def is_sampling():
+    return _sampler is not None and _sampler.is_alive()
+
+
+def stop_sampling():
+    """Stops sampling and writes the stacks in collapsed format, one "frame;frame;... count" line per stack.
+
+    That is the format of py-spy record --format raw, read by flamegraph.pl and speedscope. Returns
+    {'path', 'samples', 'stacks'}, or None when no sampling was running.
+    """
+    global _sampler
+    if _sampler is None:
+        return None
+    _sampler_stop.set()
+    _sampler.join()
+    _sampler = None
+    with _lock:
+        samples = dict(_samples)
+        _samples.clear()
+    path = _path('stacks', '.folded')
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in sorted(samples.items()):
+            f.write(f"{stack} {count}\n")
+    logger.info("Wrote %d sampled stacks to %s", len(samples), path)
+    return {'path': path, 'samples': sum(samples.values()), 'stacks': len(samples)}
+
+
+def current_rss_mb():
+    """Resident set size of this process in MB, or None where it cannot be read without extra packages."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except (OSError, ValueError, AttributeError):
+        pass
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                       [(name, ctypes.c_size_t) for name in (
+                           'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                           'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage',
+                           'PeakPagefileUsage')]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize / 1048576
+    return None
+
+
+def memory_status():
+    """Returns RSS, traced memory and the per-stage allocation counters in one dict."""
+    current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (None, None)
+    return {
+        'time': time.time(),
+        'rss_mb': current_rss_mb(),
+        'tracing': tracemalloc.is_tracing(),
+        'traced_bytes': current,
+        'traced_peak_bytes': peak,
+        'sampling': is_sampling(),
+        'stages': metrics.stage_allocations(),
+    }
@@ -0,0 +1,191 @@
+"""Replays historical orders through the pipeline, e.g. after a printer outage or a configuration mistake.
+
+Orders come from the mailbox (read-only; nothing is marked as seen), an mbox file, a Maildir or a folder
+of saved .eml files, filtered by date range and/or PO numbers. Nothing is printed unless --print is given,
+and orders already in the order index are replayed in full.
+
+    python -m scripts.replay --since 2024-05-01 --until 2024-05-03 --dry-run
+    python -m scripts.replay --po 123456,123457 --print
+    python -m scripts.replay --source saved_orders --workers 8
+    python -m scripts.replay --source archive.mbox --dry-run --parse-processes 8
+"""
+import argparse
+import asyncio
+import email
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from email.parser import BytesHeaderParser
+from email.utils import parsedate_to_datetime
+
+from scripts import config_store
+from scripts import engine
+from scripts import logging_setup
+from scripts import metrics
+from scripts import order_index
+from scripts import sources
+from scripts.utils import message_text
+
+
+# The blank line that ends the top-level headers.
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+
+def _date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def inspect(raw_message, since=None, until=None, po_numbers=()):
+    """Returns (PO number, Date header), with PO None when the message fails the date or PO filters.
+
+    The filters are applied client-side too: IMAP dates are per day in the server's time zone and file
+    sources are not searched at all. Only plain values are returned so this can run in a worker process.
+    """
+    # Headers first: a message outside the date range is rejected without decoding its attachments.
+    header_end = _HEADER_END.search(raw_message)
+    headers = BytesHeaderParser().parsebytes(raw_message[:header_end.end()] if header_end else raw_message)
+    try:
+        sent = parsedate_to_datetime(headers.get('Date')).date()
+    except (TypeError, ValueError):
+        sent = None
+    if since and (sent is None or sent < since) or until and (sent is None or sent > until):
+        return None, headers.get('Date')
+    msg = email.message_from_bytes(raw_message)
+    po_number, customer_name = engine.parse_po(message_text(msg))
+    if po_number and po_numbers and po_number not in po_numbers and order_index.group_key(po_number) not in po_numbers:
+        return None, msg.get('Date')
+    return po_number, msg.get('Date')
+
+
+async def replay(config, source, since=None, until=None, po_numbers=(), dry_run=False, workers=4,
+                 parse_processes=0, print_orders=False):
+    """Runs the replay and returns a summary dict. source is one of the scripts.sources classes.
+
+    Only a replay with print_orders records its orders in the order index; otherwise the index is left as
+    it was, so a later re-send is not skipped as a duplicate of an order that never printed.
+
+    With parse_processes, messages are parsed and filtered in that many worker processes, so a dry run
+    over a large archive uses every core instead of one.
+    """
+    queue = asyncio.Queue(maxsize=workers * 2)
+    stats = {'found': 0, 'replayed': 0, 'skipped': 0, 'failed': 0}
+    started = time.perf_counter()
+    po_numbers = frozenset(po_numbers)
+    parser = ProcessPoolExecutor(max_workers=parse_processes) if parse_processes else engine._render_executor
+
+    async def produce():
+        try:
+            async with source:
+                stats['found'] = source.count
+                async for item in source.messages():
+                    await queue.put(item)
+        finally:
+            for _ in range(workers):
+                await queue.put(None)
+
+    def report(label, outcome):
+        done = stats['replayed'] + stats['skipped'] + stats['failed']
+        elapsed = time.perf_counter() - started
+        rate = stats['replayed'] / elapsed * 60 if elapsed else 0.0
+        print(f"[{done}/{stats['found']}] {label}: {outcome} ({rate:.1f} orders/min)", file=sys.stderr)
+
+    async def consume():
+        while (item := await queue.get()) is not None:
+            label, raw_message = item
+            if parse_processes:
+                po_number, sent = await asyncio.get_running_loop().run_in_executor(
+                    parser, inspect, raw_message, since, until, po_numbers)
+            else:
+                po_number, sent = await engine._run_in(parser, inspect, raw_message, since, until, po_numbers)
+            if po_number is None:
+                stats['skipped'] += 1
+                report(label, "skipped (outside the date range, not a listed PO or no PO number)")
+                continue
+            if dry_run:
+                stats['replayed'] += 1
+                report(label, f"would replay PO {po_number} from {sent}")
+                continue
+            try:
+                with metrics.order_scope(), metrics.span('replay_order'):
+                    result = await engine.process_message(raw_message, config, check_age=False, force=True,
+                                                          record=print_orders)
+            except Exception as e:
+                stats['failed'] += 1
+                report(label, f"failed: {e}")
+                continue
+            stats['replayed' if result else 'skipped'] += 1
+            report(label, f"replayed PO {result}" if result else "skipped by the pipeline (sender or format)")
+
+    try:
+        await asyncio.gather(produce(), *(consume() for _ in range(workers)))
+    finally:
+        if parse_processes:
+            parser.shutdown(cancel_futures=True)
+    stats['elapsed_seconds'] = round(time.perf_counter() - started, 3)
+    stats['orders_per_minute'] = round(stats['replayed'] / stats['elapsed_seconds'] * 60, 1) \
+        if stats['elapsed_seconds'] else 0.0
+    return stats
+
+
+def replay_config(config, print_orders, workers):
+    """The configuration a replay runs with: printers blanked unless printing, worker count applied."""
+    config = config_store.thaw(config)
+    if not print_orders:
+        config['body_printer'] = ''
+        config['attachment_printer'] = ''
+    config['max_concurrent_orders'] = workers
+    return config_store.freeze(config_store.validate_config(config))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--since', type=_date, help="First day to replay (YYYY-MM-DD).")
+    parser.add_argument('--until', type=_date, help="Last day to replay, inclusive (YYYY-MM-DD).")
+    parser.add_argument('--po', default='', help="Comma separated PO numbers to replay.")
+    parser.add_argument('--source', help="Replay an mbox file, a Maildir or a folder of .eml files instead of "
+                                         "the mailbox.")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the orders that would be replayed.")
+    parser.add_argument('--print', dest='print_orders', action='store_true',
+                        help="Send replayed orders to the printers.")
+    parser.add_argument('--workers', type=int, help="Orders processed in parallel (default: max_concurrent_orders).")
+    parser.add_argument('--parse-processes', type=int, default=0,
+                        help="Parse and filter messages in this many processes (0: on the render threads).")
+    parser.add_argument('--config', default=config_store.CONFIG_PATH, help="Configuration file to read.")
+    args = parser.parse_args(argv)
+
+    base_config = config_store.load_config(args.config)
+    workers = args.workers or base_config['max_concurrent_orders']
+    config = replay_config(base_config, args.print_orders, workers)
+    logging_setup.setup_logging(config['log_level'], max_bytes=config['log_max_bytes'],
+                                backup_count=config['log_backup_count'])
+    po_numbers = [po.strip() for po in args.po.split(',') if po.strip()]
+    invalid = [po for po in po_numbers if not engine.PO_NUMBER.match(po)]
+    if invalid:
+        print(f"Not a PO number: {', '.join(invalid)}", file=sys.stderr)
+        return 2
+    if args.source and not os.path.exists(args.source):
+        print(f"No such file or folder: {args.source}", file=sys.stderr)
+        return 2
+    source = sources.open_source(args.source, config, args.since, args.until, po_numbers)
+
+    try:
+        with engine.executors(config):
+            stats = asyncio.run(replay(config, source, args.since, args.until, po_numbers, args.dry_run, workers,
+                                       args.parse_processes, args.print_orders))
+    except ConnectionError as e:
+        print(e, file=sys.stderr)
+        return 2
+    finally:
+        logging_setup.shutdown_logging()
+
+    verb = "Would replay" if args.dry_run else "Replayed"
+    print(f"{verb} {stats['replayed']} of {stats['found']} message(s), skipped {stats['skipped']}, "
+          f"failed {stats['failed']} in {stats['elapsed_seconds']} s ({stats['orders_per_minute']} orders/min).")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
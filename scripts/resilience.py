@@ -0,0 +1,181 @@
+import logging
+import random
+import socket
+import threading
+import time
+
+from scripts import config_store
+from scripts import metrics
+
+
+# First retry delay in seconds; every further attempt doubles the ceiling up to the configured retry_max_delay.
+BASE_DELAY = 0.5
+# While a circuit is open, a cheap TCP connect is tried this often so recovery is noticed within seconds.
+PROBE_INTERVAL = 2
+PROBE_TIMEOUT = 2
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_breakers = {}
+_listeners = []
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit is open."""
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"{endpoint} is unavailable, next probe in {retry_after:.0f} s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+def backoff_delay(attempt, base=BASE_DELAY, cap=None):
+    """Full-jitter exponential backoff: a random delay between 0 and min(cap, base * 2**attempt)."""
+    if cap is None:
+        cap = config_store.get_config()['retry_max_delay']
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Tracks the health of one endpoint.
+
+    After circuit_failure_threshold consecutive failures the circuit opens and calls are refused until a jittered
+    backoff delay has passed. The first call after that is a probe: success closes the circuit, failure opens it
+    again with a longer delay, so a dead endpoint is tried less and less often.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True when a call may go ahead. Moves an expired open circuit to half-open for one probe."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() >= self.open_until:
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds until the next call is allowed, 0 when the circuit is closed."""
+        with self._lock:
+            if self.state == CLOSED:
+                return 0.0
+            return max(0.0, self.open_until - time.monotonic())
+
+    def probe_now(self):
+        """Ends the open period early, e.g. after a cheap reachability check succeeded."""
+        with self._lock:
+            if self.state == OPEN:
+                self.open_until = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            self.failures = 0
+            self.trips = 0
+        if recovered:
+            logger.warning("%s recovered, circuit closed", self.endpoint)
+            _notify(self.endpoint, CLOSED)
+
+    def record_failure(self):
+        config = config_store.get_config()
+        with self._lock:
+            self.failures += 1
+            if self.state == CLOSED and self.failures < config['circuit_failure_threshold']:
+                return
+            delay = backoff_delay(self.trips, cap=config['retry_max_delay'])
+            # Never probe sooner than the base delay, so a flapping endpoint is not hit in a tight loop.
+            self.open_until = time.monotonic() + max(BASE_DELAY, delay)
+            self.trips += 1
+            self.state = OPEN
+        metrics.inc('circuit_trips')
+        logger.warning("%s failed %d time(s), circuit open for %.1f s", self.endpoint, self.failures,
+                       self.open_until - time.monotonic())
+        _notify(self.endpoint, OPEN)
+
+
+def add_listener(callback):
+    """Registers callback(endpoint, state) for circuits opening and closing. Called on the failing thread."""
+    _listeners.append(callback)
+
+
+def _notify(endpoint, state):
+    for callback in list(_listeners):
+        try:
+            callback(endpoint, state)
+        except Exception:
+            logger.exception("Resilience listener failed")
+
+
+def get_breaker(endpoint):
+    """Returns the breaker for endpoint (e.g. "imap:imap.gmail.com" or an artwork host), creating it on first use."""
+    with _lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+        return breaker
+
+
+def breaker_states():
+    """Returns {endpoint: state} for every endpoint seen so far."""
+    with _lock:
+        breakers = list(_breakers.values())
+    return {breaker.endpoint: breaker.state for breaker in breakers}
+
+
+def is_reachable(host, port):
+    """Cheap recovery probe: True when a TCP connection to host:port can be opened."""
+    try:
+        with socket.create_connection((host, port), timeout=PROBE_TIMEOUT):
+            return True
+    except OSError:
+        return False
+
+
+def call_with_retry(endpoint, func, *args, attempts=3, is_transient=lambda e: True, cancel_event=None):
+    """Calls func(*args) through endpoint's circuit breaker, retrying transient failures with backoff.
+
+    Errors for which is_transient returns False are raised at once and do not count against the endpoint,
+    since the endpoint did answer. Waiting stops early when cancel_event is set; the last error is raised then.
+    """
+    breaker = get_breaker(endpoint)
+    last_error = None
+    for attempt in range(attempts):
+        if attempt:
+            delay = max(backoff_delay(attempt - 1), breaker.retry_after())
+            if cancel_event is not None:
+                if cancel_event.wait(delay):
+                    break
+            else:
+                time.sleep(delay)
+            metrics.inc('retries')
+
+        if not breaker.allow():
+            last_error = CircuitOpenError(endpoint, breaker.retry_after())
+            continue
+        try:
+            result = func(*args)
+        except Exception as e:
+            if not is_transient(e):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            last_error = e
+            logger.info("Attempt %d/%d against %s failed: %s", attempt + 1, attempts, endpoint, e)
+        else:
+            breaker.record_success()
+            return result
+    raise last_error
@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+import pytz
+
+from scripts import metrics
+from scripts.utils import message_text
+
+
+# Points added by each rule. An order's priority is the sum of the rules it matches.
+KEYWORD_PRIORITY = 100
+SENDER_PRIORITY = 50
+OVERDUE_PRIORITY = 120
+SHIP_TODAY_PRIORITY = 80
+SHIP_SOON_PRIORITY = 40
+# Ship-by dates within this many days count as "soon".
+SHIP_SOON_DAYS = 3
+# Up to this many points as an email approaches max_email_age_days, so it is printed before it is dropped.
+AGE_PRIORITY = 30
+
+_SHIP_BY = re.compile(r"(?:ship[\s-]*by|ship\s+date|must\s+ship)(?:\s+date)?\s*[:\-]?\s*"
+                      r"([A-Za-z]{3,9}\.?\s+\d{1,2},?\s+\d{4}|\d{4}-\d{2}-\d{2}|\d{1,2}/\d{1,2}/\d{2,4})",
+                      re.IGNORECASE)
+_DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%b %d %Y', '%B %d %Y')
+
+
+def parse_ship_by(text):
+    """Returns the ship-by date mentioned in an order body, or None."""
+    match = _SHIP_BY.search(text)
+    if not match:
+        return None
+    value = match.group(1).replace(',', '').replace('.', '')
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def order_priority(msg, config, today=None, text=None):
+    """Scores an order email by the configured rules. Higher runs sooner; routine orders score 0.
+
+    text is message_text(msg), when the caller already has it.
+    """
+    priority = 0
+    subject = (msg.get('Subject') or '').lower()
+    if any(keyword.lower() in subject for keyword in config['priority_keywords']):
+        priority += KEYWORD_PRIORITY
+
+    sender = msg.get('From') or ''
+    if any(priority_sender in sender for priority_sender in config['priority_senders']):
+        priority += SENDER_PRIORITY
+
+    ship_by = parse_ship_by(message_text(msg) if text is None else text)
+    if ship_by is not None:
+        today = today or datetime.now().date()
+        if ship_by < today:
+            priority += OVERDUE_PRIORITY
+        elif ship_by == today:
+            priority += SHIP_TODAY_PRIORITY
+        elif ship_by - today <= timedelta(days=SHIP_SOON_DAYS):
+            priority += SHIP_SOON_PRIORITY
+
+    try:
+        age = datetime.now(pytz.utc) - parsedate_to_datetime(msg.get('Date'))
+        max_age = timedelta(days=config['max_email_age_days'])
+        if max_age and age > timedelta(0):
+            priority += round(AGE_PRIORITY * min(1.0, age / max_age))
+    except (TypeError, ValueError):
+        pass
+    return priority
+
+
+class PriorityScheduler:
+    """Hands out a fixed number of processing slots to waiting orders, highest priority first.
+
+    Waiting orders sit in a heap keyed by aging_per_minute * enqueue_minute - priority. Every waiting order
+    ages at the same rate, so the key never has to be updated, and an order waiting long enough overtakes
+    any newer order however urgent. Must be used from a single event loop.
+    """
+
+    def __init__(self, slots, aging_per_minute):
+        self.slots = slots
+        self.free_slots = slots
+        self.aging_per_minute = aging_per_minute
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def _key(self, priority, enqueued):
+        return self.aging_per_minute * enqueued / 60 - priority
+
+    @asynccontextmanager
+    async def slot(self, priority, label=''):
+        """Waits for a processing slot and records the wait as the 'queue_wait' stage."""
+        enqueued = time.monotonic()
+        if self.free_slots > 0 and not self._heap:
+            self.free_slots -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            entry = [self._key(priority, enqueued), next(self._sequence), future, label, priority, enqueued]
+            heapq.heappush(self._heap, entry)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just as the wait was cancelled; pass it on.
+                    self._release()
+                elif entry in self._heap:
+                    # _release() drops cancelled entries it pops, so the entry may already be gone.
+                    self._heap.remove(entry)
+                    heapq.heapify(self._heap)
+                raise
+        metrics.observe('queue_wait', time.monotonic() - enqueued)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def resize(self, slots, aging_per_minute):
+        """Applies new settings. Running orders keep their slots; a lower limit takes effect as they finish."""
+        if aging_per_minute != self.aging_per_minute:
+            self.aging_per_minute = aging_per_minute
+            for entry in self._heap:
+                entry[0] = self._key(entry[4], entry[5])
+            heapq.heapify(self._heap)
+        self.free_slots += slots - self.slots
+        self.slots = slots
+        while self.free_slots > 0 and self._heap:
+            self.free_slots -= 1
+            self._release()
+
+    def _release(self):
+        if self.free_slots < 0:
+            # The limit was lowered while this slot was taken.
+            self.free_slots += 1
+            return
+        while self._heap:
+            future = heapq.heappop(self._heap)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free_slots += 1
+
+    def pending(self):
+        """Returns the waiting orders in the order they will run: dicts with label, priority and waited seconds."""
+        now = time.monotonic()
+        return [{'label': entry[3], 'priority': entry[4], 'waited': now - entry[5]} for entry in sorted(self._heap)]
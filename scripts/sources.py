@@ -0,0 +1,173 @@
+"""Message sources: where raw order emails come from in a batch run.
+
+Every source is an async context manager. Entering it opens the mailbox or file and sets count, and
+messages() then yields (label, raw RFC 822 bytes) pairs in mailbox order. Sources use engine's executors,
+so they only work inside engine.executors().
+
+    async with open_source('orders.mbox', config) as source:
+        async for label, raw_message in source.messages():
+            ...
+"""
+import asyncio
+import imaplib
+import mmap
+import os
+from datetime import timedelta
+
+from scripts import engine
+
+
+# Messages fetched per IMAP FETCH command; one round trip per batch instead of per message.
+FETCH_BATCH = 25
+# Maildir keeps delivered mail in new/ and cur/; tmp/ holds deliveries still being written.
+MAILDIR_SUBDIRS = ('new', 'cur')
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class ImapSource:
+    """Messages in the configured IMAP mailbox, optionally narrowed by a server-side search.
+
+    Read-only: messages are fetched with BODY.PEEK[] and never marked as seen.
+    """
+
+    def __init__(self, config, since=None, until=None, po_numbers=(), batch=FETCH_BATCH):
+        self.config = config
+        self.since, self.until, self.po_numbers = since, until, list(po_numbers)
+        self.batch = batch
+        self.count = 0
+        self._mail = None
+        self._ids = []
+
+    def search_criteria(self):
+        criteria = []
+        if self.since:
+            criteria += ['SINCE', self.since.strftime('%d-%b-%Y')]
+        if self.until:
+            criteria += ['BEFORE', (self.until + timedelta(days=1)).strftime('%d-%b-%Y')]
+        return criteria or ['ALL']
+
+    async def __aenter__(self):
+        self._mail = await engine._imap(engine.connect_to_email, self.config['email'])
+        if self._mail is None:
+            raise ConnectionError("Could not connect to the email server.")
+        ids = set()
+        for po_number in self.po_numbers or [None]:
+            search = self.search_criteria() + (['TEXT', f'"{po_number}"'] if po_number else [])
+            status, data = await engine._imap(self._mail.search, None, *search)
+            ids.update(data[0].split())
+        self._ids = sorted(ids, key=int)
+        self.count = len(self._ids)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        try:
+            await engine._imap(self._mail.logout)
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    async def messages(self):
+        for start in range(0, len(self._ids), self.batch):
+            batch = self._ids[start:start + self.batch]
+            status, data = await engine._imap(self._mail.fetch, b','.join(batch), '(BODY.PEEK[])')
+            for response_part in data:
+                if isinstance(response_part, tuple):
+                    yield response_part[0].split()[0].decode(), response_part[1]
+
+
+class FolderSource:
+    """Messages stored one per file: a Maildir (new/ and cur/) or any folder tree of .eml files."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._paths = []
+
+    def is_maildir(self):
+        return all(os.path.isdir(os.path.join(self.path, name)) for name in MAILDIR_SUBDIRS)
+
+    def _scan(self):
+        if self.is_maildir():
+            return sorted(os.path.join(self.path, subdir, name) for subdir in MAILDIR_SUBDIRS
+                          for name in os.listdir(os.path.join(self.path, subdir)) if not name.startswith('.'))
+        return sorted(os.path.join(folder, name) for folder, _, names in os.walk(self.path)
+                      for name in names if name.lower().endswith('.eml'))
+
+    async def __aenter__(self):
+        if not os.path.isdir(self.path):
+            raise FileNotFoundError(f"No such folder: {self.path}")
+        self._paths = await engine._run_in(engine._io_executor, self._scan)
+        self.count = len(self._paths)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def messages(self):
+        # Read ahead on the download threads so the next file is in memory when the consumer asks for it.
+        pending = None
+        for path in self._paths:
+            future = asyncio.ensure_future(engine._run_in(engine._io_executor, _read, path))
+            if pending is not None:
+                yield pending[0], await pending[1]
+            pending = (os.path.basename(path), future)
+        if pending is not None:
+            yield pending[0], await pending[1]
+
+
+class MboxSource:
+    """Messages in an mbox file, memory-mapped so archives larger than RAM are read at disk speed.
+
+    Messages start at lines beginning with "From ". The "From " line itself is not part of the message.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = None
+        self._map = None
+        self._offsets = []
+
+    def _scan(self):
+        self._file = open(self.path, 'rb')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            return []
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        starts = [0] if self._map[:5] == b'From ' else []
+        position = self._map.find(b'\nFrom ')
+        while position != -1:
+            starts.append(position + 1)
+            position = self._map.find(b'\nFrom ', position + 1)
+        ends = starts[1:] + [len(self._map)]
+        return list(zip(starts, ends))
+
+    async def __aenter__(self):
+        self._offsets = await engine._run_in(engine._io_executor, self._scan)
+        self.count = len(self._offsets)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._map is not None:
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+    async def messages(self):
+        for number, (start, end) in enumerate(self._offsets, 1):
+            body_start = self._map.find(b'\n', start, end) + 1
+            yield f"{os.path.basename(self.path)}:{number}", self._map[body_start:end]
+
+
+def open_source(path, config, since=None, until=None, po_numbers=()):
+    """Returns the source for path: an mbox file, a Maildir or .eml folder, or the IMAP mailbox when None.
+
+    since, until and po_numbers narrow the IMAP search; file sources return everything.
+    """
+    if path is None:
+        return ImapSource(config, since, until, po_numbers)
+    if os.path.isfile(path):
+        return MboxSource(path)
+    return FolderSource(path)
@@ -1,11 +1,22 @@
+import logging
 import os
 import re
-import threading
 
 import requests
+from bs4 import BeautifulSoup
 import os
 from urllib.parse import urlparse, parse_qs
 
+from scripts import folder_index
+from scripts import metrics
+from scripts import resilience
+
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds, so a stalled artwork host cannot hold a download thread forever.
+DOWNLOAD_TIMEOUT = (10, 60)
+
 
 def extract_filename_from_url(url, default_name):
     """Extracts the filename from a URL or uses a default name."""
@@ -24,48 +35,75 @@ def extract_filename_from_url(url, default_name):
 
     return file_name
 
-def create_folder(po_number, customer_name):
-    """Creates a folder based on PO Number and customer name."""
-    folder_name = f"{po_number}_{customer_name.replace(' ', '_')}"
-    folder_path = os.path.join('attachments', folder_name)  # Hardcoded path
-    os.makedirs(folder_path, exist_ok=True)
-    return folder_path
+def create_folder(po_number, customer_name, config=None):
+    """Creates (or finds) the folder of a PO in the sharded attachments folder. See folder_index.folder_for."""
+    return folder_index.folder_for(po_number, customer_name, config)
 
 def sanitize_filename(filename):
     """Remove or replace invalid characters for Windows file systems."""
     return re.sub(r'[<>:"/\\|?*]', '_', filename)
 
-def download_and_save_attachment(url, folder_path, file_name=None):
-    """Downloads an attachment from a URL and saves it to the specified folder."""
-    try:
-        response = requests.get(url, stream=True)
+def is_transient_http_error(error):
+    """True for failures worth retrying: connection problems, timeouts, 429 and 5xx answers."""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+def _fetch_to_file(url, file_path, cancel_event):
+    response = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    with response:
         response.raise_for_status()
+        # Write the content to the file in chunks
+        with open(file_path, 'wb') as file:
+            for chunk in response.iter_content(chunk_size=65536):
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                if chunk:
+                    file.write(chunk)
+                    metrics.inc('bytes_downloaded', len(chunk))
 
-        # Extract filename from URL and sanitize it
-        if not file_name:
-            parsed_url = urlparse(url)
-            file_name = os.path.basename(parsed_url.path) or "downloaded_file"
+@metrics.timed('download_and_save_attachment')
+def download_and_save_attachment(url, folder_path, file_name=None, cancel_event=None, attempts=1):
+    """Downloads an attachment from a URL and saves it to the specified folder.
 
-        file_name = sanitize_filename(file_name)
-        file_path = os.path.join(folder_path, file_name)
+    Transient failures are retried up to attempts times through the host's circuit breaker.
+    When cancel_event is set mid-download the partial file is removed and None is returned.
+    """
+    parsed_url = urlparse(url)
+    # Extract filename from URL and sanitize it
+    if not file_name:
+        file_name = os.path.basename(parsed_url.path) or "downloaded_file"
+    file_name = sanitize_filename(file_name)
+    file_path = os.path.join(folder_path, file_name)
 
+    try:
         # Create the folder if it doesn't exist
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
 
-        # Write the content to the file in chunks
-        with open(file_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    file.write(chunk)
+        resilience.call_with_retry(parsed_url.netloc, _fetch_to_file, url, file_path, cancel_event,
+                                   attempts=attempts, is_transient=is_transient_http_error,
+                                   cancel_event=cancel_event)
+
+        if cancel_event is not None and cancel_event.is_set():
+            os.remove(file_path)
+            logger.info("Download of %s cancelled", file_name)
+            return None
 
-        print(f"[Thread {threading.current_thread().name}] Downloaded {file_name} successfully to {file_path}.")
+        logger.info("Downloaded %s to %s", file_name, file_path)
         return file_path
-    except requests.RequestException as e:
-        print(f"[Thread {threading.current_thread().name}] Failed to download {file_name} from {url}. Request Error: {e}")
+    except (requests.RequestException, resilience.CircuitOpenError) as e:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        if cancel_event is not None and cancel_event.is_set():
+            logger.info("Download of %s cancelled", file_name)
+            return None
+        metrics.record_failure('download_and_save_attachment')
+        logger.error("Failed to download %s from %s: %s", file_name, url, e)
         return None
-    except Exception as e:
-        print(f"[Thread {threading.current_thread().name}] Failed to save {file_name}. Error: {e}")
+    except Exception:
+        metrics.record_failure('download_and_save_attachment')
+        logger.exception("Failed to save %s", file_name)
         return None
 
 def print_pdf(file_path, printer_name=None):
@@ -74,7 +112,25 @@ def print_pdf(file_path, printer_name=None):
         os.system(f'lpr -P {printer_name} {file_path}')
     else:
         os.system(f'lpr {file_path}')
-    print(f"Sent {file_path} to the printer.")
+    logger.info("Sent %s to the printer.", file_path)
+
+def count_pdf_pages(file_path):
+    """Counts the page objects of a PDF without a PDF library. Good enough for the files we generate."""
+    try:
+        with open(file_path, 'rb') as f:
+            return len(re.findall(rb'/Type\s*/Page(?!s)', f.read()))
+    except OSError:
+        return 0
+
+def message_text(msg):
+    """Returns the text of the first HTML or plain text part of an email.message.Message, or ''."""
+    for part in msg.walk():
+        content_type = part.get_content_type()
+        if content_type in ('text/html', 'text/plain'):
+            payload = part.get_payload(decode=True) or b''
+            text = payload.decode(errors='replace')
+            return BeautifulSoup(text, 'html.parser').get_text() if content_type == 'text/html' else text
+    return ''
 
 def read_processed_emails(file_path):
     """Reads the list of processed email IDs from a file."""
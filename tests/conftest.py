@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+
+import pytest
+
+from benchmarks.artwork_server import start_artwork_server
+from benchmarks.imap_stub import Mailbox, start_imap_stub
+from benchmarks.run_benchmark import benchmark_config, use_fake_tools
+from scripts import config_store
+from scripts import engine
+from scripts import folder_index
+from scripts import leases
+from scripts import order_index
+
+
+class EngineRun:
+    """The real engine against the stub IMAP server, the artwork server and the fake tools, in tmp_path."""
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.mailbox = Mailbox()
+        self.imap_server = start_imap_stub(self.mailbox)
+        self.artwork_server = start_artwork_server()
+        self.print_log = os.path.join(workdir, 'print_jobs.log')
+        self.orders = []
+        self._lock = threading.Lock()
+        engine.add_listener(self._on_event)
+
+    def _on_event(self, event, data):
+        if event == 'order':
+            with self._lock:
+                self.orders.append(data['po_number'])
+
+    def configure(self, **overrides):
+        return config_store.save_config(benchmark_config(self.imap_server.port, **overrides))
+
+    def run_until(self, condition, timeout=60):
+        """Runs the engine until condition() is true or timeout seconds passed. Returns condition()."""
+        deadline = time.monotonic() + timeout
+        engine.start()
+        try:
+            while not condition() and time.monotonic() < deadline:
+                time.sleep(0.1)
+        finally:
+            engine.stop()
+            engine.processing_thread.join()
+        return condition()
+
+    def body_prints(self):
+        """Returns the PO folder names of every order body printed, in print order."""
+        if not os.path.exists(self.print_log):
+            return []
+        with open(self.print_log) as f:
+            return [os.path.basename(os.path.dirname(line.rstrip('\n').split('\t')[2])) for line in f
+                    if line.rstrip('\n').endswith('email_body.pdf')]
+
+    def close(self):
+        engine._listeners.remove(self._on_event)
+        leases.configure('', None)
+        self.imap_server.shutdown()
+        self.artwork_server.shutdown()
+
+
+@pytest.fixture
+def engine_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('logs')
+    # Module level caches are keyed by relative paths, which now point into tmp_path.
+    monkeypatch.setattr(order_index, '_index', None)
+    monkeypatch.setattr(folder_index, '_indexes', {})
+    monkeypatch.setattr(engine, 'WKHTMLTOPDF_COMMAND', engine.WKHTMLTOPDF_COMMAND)
+    monkeypatch.setattr(engine, 'SUMATRA_COMMAND', engine.SUMATRA_COMMAND)
+    run = EngineRun(str(tmp_path))
+    use_fake_tools(run.print_log, 0)
+    run.configure()
+    yield run
+    run.close()
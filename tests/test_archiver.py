@@ -0,0 +1,77 @@
+import os
+import time
+
+import pytest
+
+from scripts import archiver
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {'attachments_folder': str(tmp_path / 'attachments'), 'archive_folder': str(tmp_path / 'archive')}
+
+
+def _write(folder, name, data, mtime=None):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name)
+    with open(path, 'w') as f:
+        f.write(data)
+    if mtime:
+        os.utime(path, (mtime, mtime))
+        os.utime(folder, (mtime, mtime))
+
+
+def _read(folder, name):
+    with open(os.path.join(folder, name)) as f:
+        return f.read()
+
+
+def test_restore_merges_into_a_folder_recreated_while_archived(config):
+    folder = os.path.join(config['attachments_folder'], '2024-05', '100_Customer')
+    _write(folder, 'email_body.pdf', 'old body')
+    _write(folder, 'label.png', 'label')
+    archiver.archive_folder(folder, config)
+    _write(folder, 'email_body.pdf', 'new body')
+
+    assert archiver.is_archived(folder, config)
+    assert archiver.restore(folder, config)
+    assert _read(folder, 'email_body.pdf') == 'new body'
+    assert _read(folder, 'label.png') == 'label'
+    assert not archiver.is_archived(folder, config)
+
+
+def test_archiving_a_recreated_folder_again_keeps_the_earlier_archive(config):
+    folder = os.path.join(config['attachments_folder'], '2024-05', '100_Customer')
+    _write(folder, 'label.png', 'label', mtime=time.mktime((2024, 5, 10, 12, 0, 0, 0, 0, -1)))
+    archiver.archive_folder(folder, config)
+    _write(folder, 'email_body.pdf', 'body')
+    current_month = archiver.archive_folder(folder, config)
+
+    entry = archiver.load_index(config)['2024-05/100_Customer']
+    assert entry['archives'] == ['2024-05.zip', current_month]
+    assert entry['files'] == 2
+    assert archiver.restore(folder, config)
+    assert sorted(os.listdir(folder)) == ['email_body.pdf', 'label.png']
+
+
+def test_archiving_again_keeps_a_changed_file_of_the_same_size(config):
+    folder = os.path.join(config['attachments_folder'], '2024-05', '100_Customer')
+    _write(folder, 'label.png', 'AAAA')
+    archiver.archive_folder(folder, config)
+    assert archiver.restore(folder, config)
+    _write(folder, 'label.png', 'BBBB')
+    archiver.archive_folder(folder, config)
+
+    assert archiver.restore(folder, config)
+    assert _read(folder, 'label.png') == 'BBBB'
+
+
+def test_a_changed_interval_applies_after_the_next_pass(config, monkeypatch):
+    snapshots = iter([{'archive_interval_minutes': 60}, {'archive_interval_minutes': 5}])
+    monkeypatch.setattr(archiver.config_store, 'get_config', lambda: next(snapshots))
+    monkeypatch.setattr(archiver, 'run_once', lambda: None)
+    waits = []
+    monkeypatch.setattr(archiver._stop, 'wait', lambda timeout: waits.append(timeout) or len(waits) == 2)
+
+    archiver._run(None)
+    assert waits == [3600, 300]
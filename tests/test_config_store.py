@@ -0,0 +1,95 @@
+import json
+import os
+import re
+import threading
+
+import pytest
+
+from scripts import config_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """An empty config store working in tmp_path; returns the path of its config.json."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config_store, '_snapshot', None)
+    monkeypatch.setattr(config_store, '_mtime', None)
+    monkeypatch.setattr(config_store, '_listeners', [])
+    monkeypatch.setattr(config_store, '_watch_thread', None)
+    return config_store.CONFIG_PATH
+
+
+def test_defaults_fill_in_missing_keys_and_unknown_keys_are_kept():
+    config = config_store.validate_config({'sleep_time': 30, 'email': {'address': 'a@example.com'},
+                                           'future_option': 'kept'})
+
+    assert config['sleep_time'] == 30
+    assert config['email']['address'] == 'a@example.com'
+    assert config['email']['imap_server'] == config_store.DEFAULT_CONFIG['email']['imap_server']
+    assert config['future_option'] == 'kept'
+
+
+@pytest.mark.parametrize('data, message', [
+    ({'sleep_time': True}, "'sleep_time' must be of type int, got bool"),
+    ({'auto_start': 1}, "'auto_start' must be of type bool"),
+    ({'sleep_time': 0}, "'sleep_time' must be at least 1"),
+    ({'log_level': 'VERBOSE'}, "'log_level' must be one of"),
+    ({'email': {'imap_port': '993'}}, "'email.imap_port' must be of type int"),
+    ({'email': 'imap.example.com'}, "'email' must be a section"),
+    ({'allowed_senders': ['a@example.com', 7]}, "'allowed_senders[1]' must be of type str"),
+    ([], "must be a JSON object"),
+])
+def test_invalid_values_are_rejected(data, message):
+    with pytest.raises(config_store.ConfigError, match=re.escape(message)):
+        config_store.validate_config(data)
+
+
+def test_a_legacy_config_is_migrated_without_executing_it(store):
+    os.makedirs('config')
+    with open(config_store.LEGACY_CONFIG_PATH, 'w') as f:
+        f.write("import os\nos.remove('config/config.py')\n"
+                "CONFIG = {'sleep_time': 12, 'email': {'address': 'a@example.com'}, 'auto_start': True}\n")
+
+    config = config_store.load_config()
+
+    assert os.path.exists(config_store.LEGACY_CONFIG_PATH)
+    assert config['sleep_time'] == 12 and config['auto_start']
+    assert config['email']['address'] == 'a@example.com'
+    with open(store) as f:
+        assert json.load(f)['sleep_time'] == 12
+
+
+def test_a_legacy_config_that_is_not_a_literal_is_refused(tmp_path):
+    path = tmp_path / 'config.py'
+    path.write_text("CONFIG = dict(sleep_time=12)\n")
+
+    with pytest.raises(config_store.ConfigError, match="not a plain literal"):
+        config_store.read_legacy_config(str(path))
+
+
+def test_the_watcher_keeps_the_previous_snapshot_when_an_edit_is_invalid(store):
+    previous = config_store.load_config()
+    events = []
+    notified = threading.Event()
+
+    def on_change(snapshot, error):
+        events.append((snapshot, error))
+        notified.set()
+
+    config_store.add_listener(on_change)
+    config_store.start_watching(store, interval=0.01)
+    try:
+        with open(store, 'w') as f:
+            json.dump({'sleep_time': 'soon'}, f)
+        # Some file systems keep the mtime within the same tick; the watcher only looks at the mtime.
+        stat = os.stat(store)
+        os.utime(store, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        assert notified.wait(5)
+    finally:
+        config_store.stop_watching()
+        config_store._watch_thread.join()
+
+    [(snapshot, error)] = events
+    assert isinstance(error, config_store.ConfigError)
+    assert snapshot is previous
+    assert config_store.get_config() is previous
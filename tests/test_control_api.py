@@ -0,0 +1,54 @@
+import http.client
+import json
+import socket
+
+import pytest
+
+from scripts import control_api
+
+
+@pytest.fixture
+def port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    control_api.start_server(port)
+    yield port
+    control_api.stop_server()
+
+
+def _request(port, method, path, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    connection.request(method, path, headers=headers or {})
+    response = connection.getresponse()
+    body = json.loads(response.read() or b'{}')
+    connection.close()
+    return response.status, body
+
+
+@pytest.mark.parametrize('path', [
+    '/orders/1%22%0D%0AA1%20STORE%201:*%20+FLAGS%20(%5CDeleted)/requeue',
+    '/orders/123%20OR%20ALL/requeue',
+    '/orders/..%2F..%2Fconfig/reprint',
+])
+def test_po_numbers_are_validated(port, path):
+    status, body = _request(port, 'POST', path)
+    assert status == 400
+    assert 'Not a PO number' in body['error']
+
+
+def test_valid_po_reaches_the_handler(port):
+    # The processor is not running, so the requeue is refused, but only after validation.
+    assert _request(port, 'POST', '/orders/123456-R/requeue')[0] == 409
+
+
+def test_cross_origin_requests_are_rejected(port):
+    status, body = _request(port, 'POST', '/orders/123456/requeue', {'Origin': 'http://evil.example'})
+    assert status == 403
+    assert _request(port, 'POST', '/orders/123456/requeue', {'Origin': 'null'})[0] == 403
+    assert _request(port, 'GET', '/status', {'Origin': f'http://127.0.0.1:{port}'})[0] == 200
+
+
+def test_rebound_host_names_are_rejected_without_a_token(port):
+    assert _request(port, 'GET', '/status', {'Host': f'evil.example:{port}'})[0] == 403
+    assert _request(port, 'GET', '/status', {'Host': f'localhost:{port}'})[0] == 200
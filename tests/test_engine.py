@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import formatdate
+
+from benchmarks.orders import build_order
+from scripts import engine
+from scripts import order_index
+from scripts import printers
+
+
+def _seed(run, count):
+    for index in range(count):
+        run.mailbox.add(build_order(index, 'small', run.artwork_server.base_url))
+
+
+def test_email_failing_on_a_dropped_connection_is_retried(engine_run):
+    _seed(engine_run, 3)
+    engine_run.mailbox.fail_fetch(2)
+
+    assert engine_run.run_until(lambda: len(engine_run.orders) == 3)
+    assert sorted(engine_run.orders) == ['100000', '100001', '100002']
+    assert engine_run.mailbox.count_with_flag('\\Seen') == 3
+
+
+def test_start_right_after_stop_waits_for_the_previous_run(engine_run):
+    assert engine.start()
+    engine.stop()
+    assert engine.start()
+    try:
+        thread = engine.processing_thread
+        time.sleep(1)
+        assert engine.is_running and thread.is_alive()
+        _seed(engine_run, 1)
+        deadline = time.monotonic() + 60
+        while not engine_run.orders and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert engine_run.orders == ['100000']
+    finally:
+        engine.stop()
+        engine.processing_thread.join()
+
+
+def test_save_attachment_replaces_a_stale_file_of_the_same_name(tmp_path):
+    file_path = str(tmp_path / 'PO' / 'label.png')
+    assert engine.save_attachment(b'first label', file_path) == file_path
+    assert engine.save_attachment(b'corrected label', file_path) == file_path
+    with open(file_path, 'rb') as f:
+        assert f.read() == b'corrected label'
+    assert os.listdir(tmp_path / 'PO') == ['label.png']
+
+
+def test_a_body_that_did_not_print_is_not_recorded_as_printed(engine_run):
+    engine_run.configure(body_printer='')
+    _seed(engine_run, 1)
+
+    assert engine_run.run_until(lambda: engine_run.orders == ['100000'])
+    assert order_index.printed_items('100000')
+    assert not order_index._load()['100000']['bodies']
+
+
+def test_shared_mailbox_follows_uids_when_another_session_expunges(engine_run, tmp_path):
+    engine_run.configure(coordination_db=str(tmp_path / 'leases.db'), max_concurrent_orders=1)
+    # Marking this email expunges it, which renumbers the orders that are already claimed.
+    notice = EmailMessage()
+    notice['From'] = 'notices@example.com'
+    notice['Date'] = formatdate()
+    notice.set_content('Not an order.')
+    engine_run.mailbox.add(notice.as_bytes(), flags={'\\Deleted'})
+    _seed(engine_run, 3)
+
+    assert engine_run.run_until(lambda: engine_run.mailbox.count_with_flag('\\Seen') == 3)
+    assert sorted(engine_run.body_prints()) == sorted(set(engine_run.body_prints()))
+    assert sorted(engine_run.orders) == ['100000', '100001', '100002']
+    assert len(engine_run.mailbox.messages) == 3
+
+
+def test_a_printer_missing_from_a_stale_cache_still_gets_the_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(printers, '_printers', {'Body': {'paper_sizes': [], 'dpi': []}})
+    monkeypatch.setattr(printers, '_last_refresh', time.monotonic() - printers.PRINTER_CACHE_TTL - 1)
+    monkeypatch.setattr(printers, 'refresh_printers', lambda: None)
+    commands = []
+    monkeypatch.setattr(engine.subprocess, 'run', lambda command, **kwargs: commands.append(command))
+    monkeypatch.setattr(engine, 'count_pdf_pages', lambda file_path: 1)
+    file_path = str(tmp_path / 'label.pdf')
+
+    assert engine.print_with_sumatra(file_path, 'Labels')
+    assert commands and commands[0][-1] == file_path
+
+
+def test_email_failing_with_a_local_os_error_is_not_retried(engine_run, monkeypatch):
+    attempts = []
+
+    async def process_single_email(e_id, config):
+        attempts.append(e_id)
+        raise PermissionError(13, 'Permission denied', 'label.pdf')
+
+    monkeypatch.setattr(engine, 'process_single_email', process_single_email)
+    _seed(engine_run, 1)
+
+    assert engine_run.run_until(lambda: engine_run.mailbox.count_with_flag('\\Seen') == 1)
+    assert len(attempts) == 1
+
+
+def test_executors_follow_changed_pool_sizes():
+    config = {'download_workers': 2, 'max_concurrent_orders': 1}
+    with engine.executors(config) as resize:
+        io_executor, render_executor = engine._io_executor, engine._render_executor
+        resize(config)
+        assert (engine._io_executor, engine._render_executor) == (io_executor, render_executor)
+
+        resize({'download_workers': 4, 'max_concurrent_orders': 3})
+        assert engine._io_executor is not io_executor
+        assert engine._render_executor._max_workers == 3
+    assert engine._io_executor is None
+
+
+def test_stop_while_start_waits_for_the_previous_run_cancels_the_start(monkeypatch):
+    previous = threading.Thread(target=time.sleep, args=(1,))
+    previous.start()
+    monkeypatch.setattr(engine, 'processing_thread', previous)
+    results = []
+    starting = threading.Thread(target=lambda: results.append(engine.start()))
+    starting.start()
+    time.sleep(0.2)
+    engine.stop()
+    starting.join()
+
+    assert results == [False]
+    assert not engine.is_running and engine.processing_thread is previous
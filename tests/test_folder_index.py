@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from scripts import folder_index
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    monkeypatch.setattr(folder_index, '_indexes', {})
+    return {'attachments_folder': str(tmp_path / 'attachments')}
+
+
+def test_migrate_indexes_folders_of_replacements_of_replacements(config):
+    flat = os.path.join(config['attachments_folder'], '100-R-R_Customer')
+    os.makedirs(flat)
+    os.makedirs(os.path.join(config['attachments_folder'], '2024-05', '200-R-R_Customer'))
+
+    moves = folder_index.migrate(config)
+
+    assert [os.path.basename(target) for source, target in moves] == ['100-R-R_Customer']
+    assert folder_index.lookup('100-R-R', config) == moves[0][1]
+    assert folder_index.lookup('200-R-R', config) == os.path.join(config['attachments_folder'], '2024-05',
+                                                                  '200-R-R_Customer')
@@ -0,0 +1,50 @@
+import os
+import time
+
+import pytest
+
+from scripts import engine
+from scripts import printers
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, 'HELD_JOBS_FOLDER', str(tmp_path / 'held_jobs'))
+    monkeypatch.setattr(printers, '_paused', {})
+    printed = []
+    monkeypatch.setattr(engine, 'print_with_sumatra',
+                        lambda file_path, printer_name, print_settings=None: printed.append(
+                            (os.path.basename(file_path).split('_', 3)[3], printer_name, print_settings)))
+    return printed
+
+
+def _job(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(b'%PDF-1.4')
+    return str(path)
+
+
+def test_paused_printers_and_their_jobs_survive_a_restart(registry, tmp_path, monkeypatch):
+    printer = '\\\\shop-server\\Labels'
+    engine.pause_printer(printer)
+    engine.pause_printer('Body')
+    assert engine._hold_job(_job(tmp_path, 'label.pdf'), printer, 'noscale')
+    assert engine._hold_job(_job(tmp_path, 'email_body.pdf'), printer, 'fit')
+
+    monkeypatch.setattr(printers, '_paused', {})
+    assert engine.load_held_jobs() == {printer: 2, 'Body': 0}
+    assert printers.paused_printers() == {printer: 2, 'Body': 0}
+
+    assert engine.resume_printer(printer) == 2
+    deadline = time.monotonic() + 10
+    while len(registry) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert registry == [('label.pdf', printer, 'noscale'), ('email_body.pdf', printer, 'fit')]
+
+
+def test_a_resumed_printer_is_not_paused_after_a_restart(registry, monkeypatch):
+    engine.pause_printer('Body')
+    engine.resume_printer('Body')
+
+    monkeypatch.setattr(printers, '_paused', {})
+    assert engine.load_held_jobs() == {}
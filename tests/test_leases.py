@@ -0,0 +1,51 @@
+import pytest
+
+from scripts import leases
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'leases.db')
+    leases.configure(path, 'station1')
+    yield path
+    leases.configure('', None)
+
+
+def test_a_lease_held_by_another_station_is_not_acquired(database):
+    assert leases.acquire('order/1', 60)
+    leases.configure(database, 'station2')
+    assert not leases.acquire('order/1', 60)
+    assert leases.acquire('order/2', 60)
+
+
+def test_an_expired_lease_is_taken_over(database):
+    assert leases.acquire('order/1', -1)
+    leases.configure(database, 'station2')
+    assert leases.acquire('order/1', 60)
+    assert leases.active() == [{'key': 'order/1', 'station': 'station2', 'expires_in': pytest.approx(60, abs=5),
+                                'attempts': 2}]
+
+
+def test_renew_returns_only_the_leases_still_held(database):
+    leases.acquire('order/1', -1)
+    leases.acquire('order/2', 60)
+    leases.configure(database, 'station2')
+    leases.acquire('order/1', 60)
+    leases.configure(database, 'station1')
+    assert leases.renew(['order/1', 'order/2'], 60) == {'order/2'}
+
+
+def test_a_completed_lease_is_never_taken_again(database):
+    leases.acquire('order/1', 60)
+    leases.complete('order/1')
+    assert leases.active() == []
+    assert leases.renew(['order/1'], 60) == set()
+    leases.configure(database, 'station2')
+    assert not leases.acquire('order/1', 60)
+
+
+def test_a_released_lease_can_be_taken_at_once(database):
+    leases.acquire('order/1', 60)
+    leases.release('order/1')
+    leases.configure(database, 'station2')
+    assert leases.acquire('order/1', 60)
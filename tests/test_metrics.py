@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from scripts import metrics
+from scripts.leases import LeaseLost
+
+
+@pytest.fixture(autouse=True)
+def counters(monkeypatch):
+    monkeypatch.setattr(metrics, '_counters', {})
+
+
+def test_a_failing_order_counts_one_failure_however_many_spans_fail():
+    with pytest.raises(ValueError):
+        with metrics.order_scope(), metrics.span('process_single_email'):
+            with metrics.span('parse_order'):
+                raise ValueError("broken order")
+
+    counters = metrics.counters()
+    assert counters['failures'] == 1
+    assert counters['parse_order_failures'] == 1
+    assert counters['process_single_email_failures'] == 1
+
+
+def test_failures_recorded_by_a_stage_that_handled_them_count_once_per_order():
+    with metrics.order_scope():
+        metrics.record_failure('download_and_save_attachment')
+        metrics.record_failure('print_with_sumatra')
+    metrics.record_failure('convert_html_to_pdf')
+
+    assert metrics.counters()['failures'] == 2
+
+
+@pytest.mark.parametrize('error', [asyncio.CancelledError(), metrics.NotAFailure(), LeaseLost("taken over")])
+def test_cancellation_and_lost_leases_are_not_failures(error):
+    with pytest.raises(type(error)):
+        with metrics.order_scope(), metrics.span('process_single_email'):
+            raise error
+
+    assert 'failures' not in metrics.counters()
+    assert 'process_single_email_failures' not in metrics.counters()
@@ -0,0 +1,69 @@
+import json
+import os
+
+import pytest
+
+from scripts import order_index
+
+
+@pytest.fixture(autouse=True)
+def index_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'order_index.jsonl')
+    monkeypatch.setattr(order_index, 'INDEX_PATH', path)
+    monkeypatch.setattr(order_index, '_index', None)
+    return path
+
+
+def _entries(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_a_claimed_order_is_a_duplicate_until_released():
+    plan = order_index.claim('100', 'body', ['label'])
+    assert plan['print_body'] and plan['new_items'] == {'label'}
+    assert order_index.claim('100-R', 'body', ['label'])['duplicate']
+
+    order_index.release(plan)
+    again = order_index.claim('100', 'body', ['label'])
+    assert again['print_body'] and again['new_items'] == {'label'}
+
+
+def test_release_keeps_what_was_printed_before():
+    order_index.commit(order_index.claim('100', 'body', ['label']))
+    plan = order_index.claim('100', 'body', ['label', 'new label'])
+    assert not plan['print_body'] and plan['new_items'] == {'new label'}
+
+    order_index.release(plan)
+    assert order_index.printed_items('100') == {'label'}
+    assert order_index.claim('100', 'body', ['label'])['duplicate']
+
+
+def test_commit_persists_only_what_printed(index_path):
+    plan = order_index.claim('100', 'body', ['label', 'other label'])
+    order_index.commit(plan, printed_body=False, printed_items={'label'})
+
+    assert _entries(index_path)[0]['bodies'] == [] and _entries(index_path)[0]['items'] == ['label']
+    retry = order_index.claim('100', 'body', ['label', 'other label'])
+    assert retry['print_body'] and retry['new_items'] == {'other label'}
+
+
+def test_commit_of_nothing_printed_writes_nothing(index_path):
+    order_index.commit(order_index.claim('100', 'body', ['label']), printed_body=False, printed_items=())
+    assert not order_index.claim('100', 'body', ['label'])['duplicate']
+    assert not os.path.exists(index_path)
+
+
+def test_committed_entries_survive_a_restart(monkeypatch):
+    order_index.commit(order_index.claim('100', 'body', ['label']))
+    monkeypatch.setattr(order_index, '_index', None)
+    assert order_index.claim('100', 'body', ['label'])['duplicate']
+
+
+def test_force_plans_the_whole_order_without_forgetting_it_on_release():
+    order_index.commit(order_index.claim('100', 'body', ['label']))
+    plan = order_index.claim('100', 'body', ['label'], force=True)
+    assert plan['print_body'] and plan['new_items'] == {'label'}
+
+    order_index.release(plan)
+    assert order_index.claim('100', 'body', ['label'])['duplicate']
@@ -0,0 +1,61 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from scripts import printers
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(printers, '_printers', {'Body': {'paper_sizes': [], 'dpi': []}})
+    monkeypatch.setattr(printers, '_last_refresh', time.monotonic())
+    monkeypatch.setattr(printers, '_listeners', [])
+    refreshes = []
+    monkeypatch.setattr(printers, 'refresh_printers', lambda: refreshes.append(True))
+    return refreshes
+
+
+def test_a_failed_query_raises():
+    with pytest.raises(subprocess.CalledProcessError):
+        printers._run([sys.executable, '-c', 'import sys; sys.exit(1)'])
+
+
+def test_a_failed_refresh_keeps_the_previous_printers(monkeypatch):
+    error = subprocess.CalledProcessError(1, ['lpstat', '-p'])
+
+    def discover_printers():
+        raise error
+
+    monkeypatch.setattr(printers, 'discover_printers', discover_printers)
+    events = []
+    printers.add_listener(lambda added, removed, failure: events.append((added, removed, failure)))
+
+    printers._refresh()
+
+    assert printers.get_capabilities('Body') is not None
+    assert events == [([], [], error)]
+
+
+def test_only_printers_missing_from_a_discovery_are_unavailable(monkeypatch):
+    assert printers.is_available('Body')
+    assert not printers.is_available('Labels')
+
+    monkeypatch.setattr(printers, 'discover_printers', dict)
+    printers._refresh()
+    assert printers.is_available('Labels')
+
+
+def test_a_stale_cache_is_refreshed_when_a_printer_is_checked(registry, monkeypatch):
+    assert printers.is_available('Body')
+    assert not registry
+
+    monkeypatch.setattr(printers, '_last_refresh', time.monotonic() - printers.PRINTER_CACHE_TTL - 1)
+    assert printers.is_available('Body')
+    assert registry
+
+
+def test_a_printer_missing_from_the_cache_starts_a_refresh(registry):
+    assert not printers.is_available('Labels')
+    assert registry
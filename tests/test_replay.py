@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from benchmarks.orders import build_order
+from scripts import config_store
+from scripts import engine
+from scripts import order_index
+from scripts import replay
+from scripts.sources import FolderSource
+
+
+def _replay(folder, print_orders):
+    config = replay.replay_config(config_store.get_config(), print_orders, 2)
+    with engine.executors(config):
+        return asyncio.run(replay.replay(config, FolderSource(str(folder)), print_orders=print_orders))
+
+
+@pytest.mark.parametrize('print_orders', [False, True])
+def test_only_printing_replays_record_orders_in_the_index(engine_run, tmp_path, print_orders):
+    folder = tmp_path / 'saved_orders'
+    folder.mkdir()
+    (folder / 'order.eml').write_bytes(build_order(0, 'small', engine_run.artwork_server.base_url))
+
+    assert _replay(folder, print_orders)['replayed'] == 1
+    assert bool(order_index.printed_items('100000')) == print_orders
+    assert bool(order_index._load()['100000']['bodies']) == print_orders
@@ -0,0 +1,152 @@
+import threading
+
+import pytest
+
+from scripts import config_store
+from scripts import resilience
+
+
+class FakeClock:
+    """Stands in for the time module: sleep() only moves monotonic() forward."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeFunc:
+    """Raises the queued errors one per call, then returns 'ok'."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(resilience, 'time', clock)
+    # The upper bound of every jittered delay, so the expected delays are exact.
+    monkeypatch.setattr(resilience.random, 'uniform', lambda low, high: high)
+    monkeypatch.setattr(config_store, 'get_config', lambda: {'circuit_failure_threshold': 2, 'retry_max_delay': 8})
+    monkeypatch.setattr(resilience, '_breakers', {})
+    monkeypatch.setattr(resilience, '_listeners', [])
+    return clock
+
+
+def test_circuit_opens_after_the_threshold_and_closes_after_a_successful_probe(clock):
+    events = []
+    resilience.add_listener(lambda endpoint, state: events.append(state))
+    breaker = resilience.get_breaker('imap:example.com')
+
+    breaker.record_failure()
+    assert breaker.state == resilience.CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == resilience.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == resilience.BASE_DELAY
+
+    clock.now += resilience.BASE_DELAY
+    assert breaker.allow()
+    assert breaker.state == resilience.HALF_OPEN
+    # Only the probe goes ahead while half-open.
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == resilience.CLOSED and breaker.retry_after() == 0
+    assert events == [resilience.OPEN, resilience.CLOSED]
+
+
+def test_a_failed_probe_reopens_the_circuit_for_longer(clock):
+    breaker = resilience.get_breaker('artwork.example.com')
+    for _ in range(2):
+        breaker.record_failure()
+    first_delay = breaker.retry_after()
+
+    clock.now += first_delay
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state == resilience.OPEN
+    assert breaker.retry_after() == 2 * first_delay
+
+
+def test_probe_now_ends_the_open_period(clock):
+    breaker = resilience.get_breaker('imap:example.com')
+    breaker.probe_now()
+    assert breaker.state == resilience.CLOSED
+
+    for _ in range(4):
+        breaker.record_failure()
+    assert not breaker.allow()
+    breaker.probe_now()
+    assert breaker.retry_after() == 0
+    assert breaker.allow() and breaker.state == resilience.HALF_OPEN
+
+
+def test_call_with_retry_retries_transient_failures_with_backoff(clock):
+    func = FakeFunc(ConnectionError("reset"))
+
+    assert resilience.call_with_retry('artwork.example.com', func) == 'ok'
+    assert func.calls == 2
+    assert clock.sleeps == [resilience.BASE_DELAY]
+    assert resilience.get_breaker('artwork.example.com').failures == 0
+
+
+def test_call_with_retry_raises_the_last_error_once_attempts_run_out(clock):
+    func = FakeFunc(ConnectionError("first"), TimeoutError("second"), ConnectionError("third"))
+
+    with pytest.raises(ConnectionError, match="third"):
+        resilience.call_with_retry('artwork.example.com', func)
+    assert func.calls == 3
+    # The third attempt waited for the circuit opened by the second failure, then probed it.
+    assert clock.sleeps == [resilience.BASE_DELAY, 2 * resilience.BASE_DELAY]
+    assert resilience.get_breaker('artwork.example.com').state == resilience.OPEN
+
+
+def test_call_with_retry_does_not_call_an_endpoint_whose_circuit_is_open(clock):
+    breaker = resilience.get_breaker('artwork.example.com')
+    for _ in range(2):
+        breaker.record_failure()
+    func = FakeFunc()
+
+    with pytest.raises(resilience.CircuitOpenError):
+        resilience.call_with_retry('artwork.example.com', func, attempts=1)
+    assert func.calls == 0
+
+
+def test_a_non_transient_error_is_raised_at_once_and_counts_as_an_answer(clock):
+    breaker = resilience.get_breaker('artwork.example.com')
+    breaker.record_failure()
+    func = FakeFunc(ValueError("404"))
+
+    with pytest.raises(ValueError):
+        resilience.call_with_retry('artwork.example.com', func,
+                                   is_transient=lambda e: not isinstance(e, ValueError))
+    assert func.calls == 1
+    assert clock.sleeps == []
+    assert breaker.failures == 0 and breaker.state == resilience.CLOSED
+
+
+def test_cancelling_stops_the_retries_and_raises_the_last_error(clock):
+    cancel_event = threading.Event()
+    func = FakeFunc(ConnectionError("reset"))
+    cancel_event.set()
+
+    with pytest.raises(ConnectionError):
+        resilience.call_with_retry('artwork.example.com', func, cancel_event=cancel_event)
+    assert func.calls == 1
+    assert clock.sleeps == []
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from scripts.scheduler import PriorityScheduler
+
+
+async def _hold_slot(scheduler, entered, release, label='holder'):
+    async with scheduler.slot(0, label):
+        entered.set()
+        await release.wait()
+
+
+def test_slots_are_handed_out_by_priority():
+    order = []
+
+    async def scenario():
+        scheduler = PriorityScheduler(1, 0)
+        entered, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(_hold_slot(scheduler, entered, release))
+        await entered.wait()
+
+        async def wait_for_slot(priority, label):
+            async with scheduler.slot(priority, label):
+                order.append(label)
+
+        waiters = [asyncio.create_task(wait_for_slot(priority, label))
+                   for priority, label in ((0, 'routine'), (100, 'rush'), (50, 'soon'))]
+        await asyncio.sleep(0)
+        assert [entry['label'] for entry in scheduler.pending()] == ['rush', 'soon', 'routine']
+        release.set()
+        await asyncio.gather(holder, *waiters)
+        assert scheduler.free_slots == 1
+
+    asyncio.run(scenario())
+    assert order == ['rush', 'soon', 'routine']
+
+
+def test_cancelled_waiter_already_dropped_by_release():
+    async def scenario():
+        scheduler = PriorityScheduler(1, 0)
+        entered, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(_hold_slot(scheduler, entered, release))
+        await entered.wait()
+
+        async def waiter():
+            async with scheduler.slot(0, 'waiter'):
+                pass
+
+        waiting = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        assert len(scheduler.pending()) == 1
+        # The holder wakes up first and its _release() pops and drops the cancelled entry; the waiter then
+        # handles its cancellation with the entry already gone.
+        release.set()
+        waiting.cancel()
+        await holder
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler.pending() == []
+        assert scheduler.free_slots == 1
+
+        # The slot is still usable afterwards.
+        async with scheduler.slot(0, 'next'):
+            assert scheduler.free_slots == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        scheduler = PriorityScheduler(1, 0)
+        entered, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(_hold_slot(scheduler, entered, release))
+        await entered.wait()
+
+        async def waiter():
+            async with scheduler.slot(0, 'waiter'):
+                pass
+
+        waiting = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler.pending() == []
+        release.set()
+        await holder
+        assert scheduler.free_slots == 1
+
+    asyncio.run(scenario())
+
+
+def test_resize_applies_to_waiting_and_finishing_orders():
+    async def scenario():
+        scheduler = PriorityScheduler(1, 0)
+        entered, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(_hold_slot(scheduler, entered, release))
+        await entered.wait()
+        second_entered, second_release = asyncio.Event(), asyncio.Event()
+        second = asyncio.create_task(_hold_slot(scheduler, second_entered, second_release, 'second'))
+        await asyncio.sleep(0)
+        assert not second_entered.is_set()
+
+        scheduler.resize(2, 0)
+        await second_entered.wait()
+
+        scheduler.resize(1, 0)
+        third_entered, third_release = asyncio.Event(), asyncio.Event()
+        third = asyncio.create_task(_hold_slot(scheduler, third_entered, third_release, 'third'))
+        release.set()
+        await holder
+        await asyncio.sleep(0)
+        # The first finished order only gave back the slot the lower limit took away.
+        assert not third_entered.is_set()
+        second_release.set()
+        await third_entered.wait()
+        third_release.set()
+        await asyncio.gather(second, third)
+        assert scheduler.free_slots == 1
+
+    asyncio.run(scenario())